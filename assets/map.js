@@ -2,6 +2,11 @@ var map = null;
 var polyline = null;
 var circles = null;
 var tracks = null;
+var currentTrack = null;
+var currentLevel = null;
+var index = null;
+var nextPage = -1;
+var loadingPage = false;
 
 function zoomFit() {
     if (!map || !polyline) {
@@ -60,7 +65,8 @@ L.sidebar = function(selector) {
 
 L.tracks = function (options) {
     var control = L.control(options),
-        tracksList = null;
+        tracksList = null,
+        $more = null;
 
 
     control.onAdd = function (map) {
@@ -94,42 +100,17 @@ L.tracks = function (options) {
             .attr('class', 'track-items')
             .appendTo($ui);
 
-        data.forEach(function(track) {
-            var $li = $('<li>')
-                .attr('class', 'track-item')
-                .attr('data-id', track.hash)
-                .on('click', (function() {
-                    var hash = track.hash;
-                    return function(e) {
-                        e.stopPropagation();
-                        e.preventDefault();
-                        load(hash, track.pois);
-                    }
-                 })())
-                .appendTo(tracksList);
+        $more = $('<li>')
+            .attr('class', 'track-item more')
+            .text('more…')
+            .on('click', function(e) {
+                e.stopPropagation();
+                e.preventDefault();
+                loadNextPage(null);
+            })
+            .hide()
+            .appendTo(tracksList);
 
-            $('<span>')
-                .text(track.start_time)
-                .appendTo($li);
-            $('<br>').appendTo($li);
-            $('<span>')
-                .text(track.type)
-                .appendTo($li);
-            $('<br>').appendTo($li);
-            $('<span>')
-                .text(track.location)
-                .appendTo($li);
-            if (track.pois.length > 0) {
-                $('<br>').appendTo($li);
-                $('<span>')
-                    .text(track.pois.map(p => p.name).join(', '))
-                    .appendTo($li);
-            }
-            $('<br>').appendTo($li);
-            $('<span>')
-                .text(track.distance)
-                .appendTo($li);
-        });
         options.sidebar.addPane($ui);
 
         $ui
@@ -142,11 +123,21 @@ L.tracks = function (options) {
 
         function shown() {
             map.on('zoomend baselayerchange', update);
+            $ui.parent().on('scroll', scrolled);
             //$section.load('/key', update);
         }
 
         function hidden() {
             map.off('zoomend baselayerchange', update);
+            $ui.parent().off('scroll', scrolled);
+        }
+
+        // fetch older tracks when the end of the list comes into view
+        function scrolled() {
+            var $parent = $ui.parent();
+            if ($parent.scrollTop() + $parent.innerHeight() >= $parent[0].scrollHeight - 200) {
+                loadNextPage(null);
+            }
         }
 
         function toggle(e) {
@@ -167,6 +158,50 @@ L.tracks = function (options) {
         return $container[0];
     };
 
+    control.addTracks = function (newTracks, more) {
+        newTracks.forEach(function(track) {
+            var $li = $('<li>')
+                .attr('class', 'track-item')
+                .attr('data-id', track.hash)
+                .toggleClass('active', currentTrack !== null && currentTrack.hash == track.hash)
+                .on('click', function(e) {
+                    e.stopPropagation();
+                    e.preventDefault();
+                    load(track);
+                })
+                .insertBefore($more);
+
+            $('<span>')
+                .text(track.start_time)
+                .appendTo($li);
+            $('<br>').appendTo($li);
+            $('<span>')
+                .text(track.type)
+                .appendTo($li);
+            $('<br>').appendTo($li);
+            $('<span>')
+                .text(track.location)
+                .appendTo($li);
+            if (track.pois.length > 0) {
+                $('<br>').appendTo($li);
+                $('<span>')
+                    .text(track.pois.map(p => p.name).join(', '))
+                    .appendTo($li);
+            }
+            $('<br>').appendTo($li);
+            $('<span>')
+                .text(track.distance)
+                .appendTo($li);
+            if (track.stats) {
+                $('<br>').appendTo($li);
+                $('<span>')
+                    .text(formatStats(track.stats))
+                    .appendTo($li);
+            }
+        });
+        $more.toggle(more);
+    };
+
     control.activateTrack = function (hash) {
         tracksList.children('li').each(function (i) {
             var li_hash = $(this).data('id');
@@ -261,6 +296,32 @@ L.layers = function (options) {
         return $container[0];
     };
 
+    // overlays are toggled independently of the base layers
+    control.addOverlay = function (name, layer) {
+        var map = control._map;
+        var $li = $('<li>')
+            .attr('class', 'layers-item')
+            .on('click', function(e) {
+                e.stopPropagation();
+                e.preventDefault();
+                if (map.hasLayer(layer)) {
+                    map.removeLayer(layer);
+                } else {
+                    map.addLayer(layer);
+                }
+            })
+            .appendTo(layersList);
+
+        $('<span>')
+            .text(name)
+            .appendTo($li);
+
+        map.on('layeradd layerremove', function() {
+            $li.toggleClass('active', map.hasLayer(layer));
+        });
+        $li.toggleClass('active', map.hasLayer(layer));
+    };
+
     control.activateTrack = function (hash) {
         tracksList.children('li').each(function (i) {
             var li_hash = $(this).data('id');
@@ -331,39 +392,152 @@ L.zoom = function (options) {
 };
 
 
-function load(hash, pois) {
-    url = '/assets/tracks/' + hash + '.json';
-    $.getJSON(url)
+// the index is split into pages in ascending start time; they are fetched
+// from the last one (newest tracks) on
+function loadNextPage(done) {
+    if (index === null || nextPage < 0 || loadingPage) {
+        return;
+    }
+    loadingPage = true;
+    var page = index.pages[nextPage];
+    $.getJSON('/' + page.file)
+        .done(function(data) {
+            nextPage -= 1;
+            var pageTracks = data.tracks.slice().reverse();
+            tracks.addTracks(pageTracks, nextPage >= 0);
+            if (done) {
+                done(pageTracks);
+            }
+        })
+        .fail(function() {
+            console.log("error");
+        })
+        .always(function() {
+            loadingPage = false;
+        });
+}
+
+function formatDuration(seconds) {
+    seconds = Math.round(seconds);
+    var minutes = Math.floor(seconds / 60) % 60;
+    var hours = Math.floor(seconds / 3600);
+    seconds = seconds % 60;
+    return hours + ':' + String(minutes).padStart(2, '0') + ':' + String(seconds).padStart(2, '0');
+}
+
+function formatStats(stats) {
+    return '\u2191' + Math.round(stats.elevation_gain) + ' m \u2193' + Math.round(stats.elevation_loss) + ' m, ' +
+        (stats.avg_speed * 3.6).toFixed(1) + ' km/h (max ' + (stats.max_speed * 3.6).toFixed(1) + '), ' +
+        'moving ' + formatDuration(stats.moving_time);
+}
+
+// track files are named by their content; digests has one entry per level of
+// detail and a last one for the full resolution
+function trackUrl(track, level) {
+    var lods = track.lods || [];
+    if (level === null) {
+        return '/assets/tracks/' + track.hash + '.' + track.digests[lods.length] + '.json';
+    }
+    return '/assets/tracks/' + track.hash + '.z' + level + '.' + track.digests[lods.indexOf(level)] + '.json';
+}
+
+// coarsest level of detail that is still accurate at the given zoom; null means full resolution
+function levelForZoom(track, zoom) {
+    var lods = track.lods || [];
+    for (var i = 0; i < lods.length; ++i) {
+        if (lods[i] >= zoom) {
+            return lods[i];
+        }
+    }
+    return null;
+}
+
+// decodes a polyline string of Google's encoded polyline algorithm (precision 5)
+function decodePolyline(encoded) {
+    var latlngs = [],
+        index = 0,
+        lat = 0,
+        lng = 0;
+    while (index < encoded.length) {
+        var deltas = [0, 0];
+        for (var i = 0; i < 2; ++i) {
+            var shift = 0,
+                value = 0,
+                b;
+            do {
+                b = encoded.charCodeAt(index++) - 63;
+                value |= (b & 0x1f) << shift;
+                shift += 5;
+            } while (b >= 0x20);
+            deltas[i] = (value & 1) ? ~(value >> 1) : (value >> 1);
+        }
+        lat += deltas[0];
+        lng += deltas[1];
+        latlngs.push([lat * 1e-5, lng * 1e-5]);
+    }
+    return latlngs;
+}
+
+function fetchLevel(track, level, done) {
+    $.getJSON(trackUrl(track, level))
         .done(function(data) {
-            tracks.activateTrack(hash);
+            if (track !== currentTrack) {
+                return;
+            }
+            currentLevel = level;
+            var latlngs = data.segments ? data.segments.map(decodePolyline) : data.polyline;
             if (polyline === null) {
-                polyline = L.polyline(data.polyline, {color: 'red'});
+                polyline = L.polyline(latlngs, {color: 'red'});
                 polyline.addTo(map);
             } else {
-                polyline.setLatLngs(data.polyline);
+                polyline.setLatLngs(latlngs);
             }
-
-            if (circles) {
-                circles.forEach(function(circle) {
-                    map.removeLayer(circle);
-                });
-                circles = null;
+            if (done) {
+                done();
             }
-
-            circles = [];
-            pois.forEach(function(poi) {
-                circle = L.circle(L.latLng(poi.lat, poi.lng), {radius: 100, color: 'blue'});
-                circle.addTo(map);
-                circles.push(circle);
-            });
-
-            zoomFit();
         })
         .fail(function() {
             console.log("error");
         });
 }
 
+function refine() {
+    if (!currentTrack || currentLevel === null) {
+        return;
+    }
+    var level = levelForZoom(currentTrack, map.getZoom());
+    if (level === null || level > currentLevel) {
+        fetchLevel(currentTrack, level, null);
+    }
+}
+
+function load(track) {
+    currentTrack = track;
+    currentLevel = null;
+    var lods = track.lods || [];
+    var level = (lods.length > 0) ? lods[0] : null;
+    fetchLevel(track, level, function() {
+        tracks.activateTrack(track.hash);
+
+        if (circles) {
+            circles.forEach(function(circle) {
+                map.removeLayer(circle);
+            });
+            circles = null;
+        }
+
+        circles = [];
+        track.pois.forEach(function(poi) {
+            circle = L.circle(L.latLng(poi.lat, poi.lng), {radius: 100, color: 'blue'});
+            circle.addTo(map);
+            circles.push(circle);
+        });
+
+        zoomFit();
+        refine();
+    });
+}
+
 function init() {
     map = L.map('map', {zoomControl: false, zoomDelta: 0.25, zoomSnap: 0});
 
@@ -394,16 +568,43 @@ function init() {
          sidebar: sidebar
     }).addTo(map);
 
-    L.layers({
+    var layers = L.layers({
         position: 'topright',
         sidebar: sidebar,
         layers: baseLayers
     }).addTo(map);
 
+    // heatmap of all tracks, if it was exported (--heatmap)
+    $.getJSON('/assets/heatmap/tiles.json')
+        .done(function(info) {
+            var heatmap = L.tileLayer('/assets/heatmap/{z}/{x}/{y}.png?' + info.updated, {
+                minZoom: info.min_zoom,
+                maxNativeZoom: info.max_zoom,
+                maxZoom: 19,
+                opacity: 0.8
+            });
+            heatmap.addTo(map);
+            layers.addOverlay('Heatmap', heatmap);
+        });
+
     L.zoom({
          position: 'topright',
          sidebar: sidebar
     }).addTo(map);
 
-    load(data[0].hash, data[0].pois);
+    map.on('zoomend', refine);
+
+    $.ajax({url: '/assets/index/manifest.json', dataType: 'json', cache: false})
+        .done(function(data) {
+            index = data;
+            nextPage = index.pages.length - 1;
+            loadNextPage(function(pageTracks) {
+                if (pageTracks.length > 0) {
+                    load(pageTracks[0]);
+                }
+            });
+        })
+        .fail(function() {
+            console.log("error");
+        });
 }
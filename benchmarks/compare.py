@@ -0,0 +1,42 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+# Compares two result files of benchmarks.run:
+#   python -m benchmarks.compare OLD.json NEW.json
+
+import argparse
+import json
+
+
+def main():
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("old", metavar="OLD", type=str)
+    args_parser.add_argument("new", metavar="NEW", type=str)
+    args = args_parser.parse_args()
+
+    with open(args.old, "r") as f:
+        old = json.load(f)
+    with open(args.new, "r") as f:
+        new = json.load(f)
+    if old.get("parameters") != new.get("parameters"):
+        print("warning: the runs used different parameters")
+
+    old_results = {(r["benchmark"], r["scale"]): r for r in old["results"]}
+    print(f"{'scale':>6} {'benchmark':<14} {'old s':>9} {'new s':>9} {'speedup':>8}")
+    for result in new["results"]:
+        key = (result["benchmark"], result["scale"])
+        if key not in old_results:
+            continue
+        old_seconds = old_results[key]["seconds"]
+        new_seconds = result["seconds"]
+        speedup = old_seconds / new_seconds if new_seconds > 0 else float("inf")
+        print(
+            f"{key[1]:>6} {key[0]:<14} "
+            f"{old_seconds:9.3f} {new_seconds:9.3f} {speedup:7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+# Compares the fitparse based FIT loader with the fast path decoder, after
+# checking that both read the same points:
+#   python -m benchmarks.fit_parse [--points N] [--files N] [--repeat N]
+
+import argparse
+import math
+import os
+import tempfile
+import time
+
+from src.track import Track
+from .synthetic import write_fit
+
+
+def best_time(function, file_names, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for file_name in file_names:
+            function(Track(), file_name)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def check_same_points(file_name):
+    expected = Track()
+    expected._load_fit_fitparse(file_name)
+    actual = Track()
+    actual._load_fit_fast(file_name)
+    for name in ["_start_time", "_end_time", "_base_time", "_type", "_distance"]:
+        assert getattr(actual, name) == getattr(expected, name), name
+    for name in ["_times", "_lats", "_lngs", "_segment_ends"]:
+        assert list(getattr(actual, name)) == list(getattr(expected, name)), name
+    assert len(actual._altitudes) == len(expected._altitudes)
+    for a, b in zip(actual._altitudes, expected._altitudes):
+        assert a == b or (math.isnan(a) and math.isnan(b)), "_altitudes"
+
+
+def main():
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("--points", metavar="N", type=int, default=7200)
+    args_parser.add_argument("--files", metavar="N", type=int, default=5)
+    args_parser.add_argument("--repeat", metavar="N", type=int, default=3)
+    args = args_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_names = []
+        for seed in range(args.files):
+            file_name = os.path.join(directory, f"{seed}.fit")
+            write_fit(file_name, points=args.points, seed=seed)
+            file_names.append(file_name)
+        size = sum(os.path.getsize(file_name) for file_name in file_names)
+        print(f"{args.files} files, {args.points} records each, {size / 1024:.0f} KiB")
+        for file_name in file_names:
+            check_same_points(file_name)
+        for name, function in [
+            ("fitparse", Track._load_fit_fitparse),
+            ("fast path", Track._load_fit_fast),
+        ]:
+            elapsed = best_time(function, file_names, args.repeat)
+            print(
+                f"{name:>10}: {elapsed / args.files * 1000:8.1f} ms/file, "
+                f"{args.files * args.points / elapsed:10.0f} records/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
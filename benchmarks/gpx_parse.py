@@ -0,0 +1,74 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+# Compares the gpxpy based GPX loader with the streaming reader (time and
+# peak Python heap), after checking that both read the same times and points
+# from a track with a UTC offset:
+#   python -m benchmarks.gpx_parse [--points N]
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+import tracemalloc
+
+from src.track import Track
+from .synthetic import write_gpx
+
+_OFFSET_START = datetime.datetime(
+    2019, 6, 1, 10, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=2))
+)
+
+
+def check_same_points(file_name):
+    expected = Track()
+    expected._load_gpx_gpxpy(file_name)
+    actual = Track()
+    actual._load_gpx_streaming(file_name)
+    # the first point is a second after the start
+    assert expected._base_time == int(_OFFSET_START.timestamp()) + 1, "_base_time"
+    for name in ["_start_time", "_end_time", "_base_time", "_type"]:
+        assert getattr(actual, name) == getattr(expected, name), name
+    for name in ["_times", "_lats", "_lngs", "_segment_ends"]:
+        assert list(getattr(actual, name)) == list(getattr(expected, name)), name
+
+
+def main():
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("--points", metavar="N", type=int, default=100000)
+    args = args_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "offset.gpx")
+        write_gpx(file_name, points=1000, start=_OFFSET_START)
+        check_same_points(file_name)
+
+        file_name = os.path.join(directory, "track.gpx")
+        write_gpx(file_name, points=args.points)
+        print(
+            f"{args.points} points, {os.path.getsize(file_name) / 1024 / 1024:.1f} MiB"
+        )
+        for name, function in [
+            ("gpxpy", Track._load_gpx_gpxpy),
+            ("streaming", Track._load_gpx_streaming),
+        ]:
+            start = time.perf_counter()
+            function(Track(), file_name)
+            elapsed = time.perf_counter() - start
+            # separate run, tracing slows down the parsers
+            tracemalloc.start()
+            function(Track(), file_name)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(
+                f"{name:>10}: {elapsed:6.2f} s, "
+                f"{args.points / elapsed:8.0f} points/s, "
+                f"peak heap {peak / 1024 / 1024:7.1f} MiB"
+            )
+
+
+if __name__ == "__main__":
+    main()
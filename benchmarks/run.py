@@ -0,0 +1,313 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+# Benchmark suite on synthetic activities, results are written as JSON:
+#   python -m benchmarks.run [--scales 100,1000,10000] [--output results.json]
+# Compare two result files with `python -m benchmarks.compare OLD NEW`.
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import s2sphere
+
+from src import geometry
+from src.coverage import Coverage, track_cells
+from src.geocoder import Geocoder
+from src.pois import Pois
+from src.track import Track
+from src.tracks import Tracks
+from .synthetic import start_position, write_activities, write_pois
+
+BENCHMARKS = ["parse", "cache", "pois", "coverage", "geocoder", "export"]
+
+
+class Dataset:
+    def __init__(self, directory: str, scale: int, args: argparse.Namespace):
+        self.directory = directory
+        self.scale = scale
+        self.activity_dir = os.path.join(directory, "activities")
+        self.poi_file = os.path.join(directory, "pois.txt")
+        params = {
+            "scale": scale,
+            "points": args.points,
+            "segments": args.segments,
+            "interval": args.interval,
+            "fit_share": args.fit_share,
+            "pois": args.pois_per_track * scale,
+        }
+        params_file = os.path.join(directory, "params.json")
+        if os.path.isfile(params_file):
+            with open(params_file, "r") as f:
+                if json.load(f) == params:
+                    self.file_names = sorted(
+                        os.path.join(self.activity_dir, name)
+                        for name in os.listdir(self.activity_dir)
+                    )
+                    return
+            shutil.rmtree(directory)
+        print(f"generating {scale} activities in {directory}")
+        self.file_names = write_activities(
+            self.activity_dir,
+            scale,
+            args.points,
+            args.segments,
+            args.interval,
+            args.fit_share,
+        )
+        write_pois(self.poi_file, params["pois"])
+        with open(params_file, "w") as f:
+            json.dump(params, f)
+
+    def work_dir(self, name: str) -> str:
+        directory = os.path.join(self.directory, "work", name)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        return directory
+
+
+class _FixedBackend:
+    # stands in for Nominatim to fill the geocoder cache without network access
+    persistent = True
+
+    def reverse(self, lat: float, lng: float) -> Optional[str]:
+        return f"{lat:.1f}/{lng:.1f}, Benchmark"
+
+
+def _result(name: str, items: int, seconds: float) -> Dict[str, Any]:
+    return {
+        "benchmark": name,
+        "items": items,
+        "seconds": seconds,
+        "per_item_ms": seconds / items * 1000 if items else None,
+    }
+
+
+def bench_parse(data: Dataset) -> List[Dict[str, Any]]:
+    start = time.perf_counter()
+    for file_name in data.file_names:
+        Track().load(file_name)
+    return [_result("parse", len(data.file_names), time.perf_counter() - start)]
+
+
+def _write_cache(data: Dataset, cache_dir: str) -> float:
+    seconds = 0.0
+    for i, file_name in enumerate(data.file_names):
+        t = Track()
+        t.load(file_name)
+        start = time.perf_counter()
+        t.save_to_cache(os.path.join(cache_dir, str(i)))
+        seconds += time.perf_counter() - start
+    return seconds
+
+
+def bench_cache(data: Dataset) -> List[Dict[str, Any]]:
+    cache_dir = data.work_dir("cache")
+    save_seconds = _write_cache(data, cache_dir)
+    start = time.perf_counter()
+    for i, file_name in enumerate(data.file_names):
+        Track().load_from_cache(os.path.join(cache_dir, str(i)), file_name)
+    load_seconds = time.perf_counter() - start
+    return [
+        _result("cache_save", len(data.file_names), save_seconds),
+        _result("cache_load", len(data.file_names), load_seconds),
+    ]
+
+
+def bench_pois(data: Dataset) -> List[Dict[str, Any]]:
+    cache_dir = data.work_dir("pois")
+    _write_cache(data, cache_dir)
+    pois = Pois()
+    start = time.perf_counter()
+    pois.set_poi_file(data.poi_file)
+    load_seconds = time.perf_counter() - start
+    seconds = 0.0
+    matches = 0
+    for i, file_name in enumerate(data.file_names):
+        t = Track()
+        t.load_from_cache(os.path.join(cache_dir, str(i)), file_name)
+        start = time.perf_counter()
+        matches += len(pois.get_pois(t))
+        seconds += time.perf_counter() - start
+    result = _result("pois", len(data.file_names), seconds)
+    result["poi_file_seconds"] = load_seconds
+    result["matches"] = matches
+    return [result]
+
+
+def bench_coverage(data: Dataset) -> List[Dict[str, Any]]:
+    cache_dir = data.work_dir("coverage")
+    coverage = Coverage()
+    coverage.open(os.path.join(cache_dir, "coverage.sqlite"))
+    add_seconds = 0.0
+    for i, file_name in enumerate(data.file_names):
+        t = Track()
+        t.load(file_name)
+        start = time.perf_counter()
+        coverage.add_track(str(i), track_cells(t))
+        add_seconds += time.perf_counter() - start
+    coverage.save()
+    positions = [
+        s2sphere.LatLng.from_degrees(*start_position(seed))
+        for seed in range(min(data.scale, 100))
+    ]
+    matches = 0
+    start = time.perf_counter()
+    for position in positions:
+        matches += len(coverage.query_cap(position, 1000))
+    result = _result("coverage_query", len(positions), time.perf_counter() - start)
+    result["matches"] = matches
+    coverage.close()
+    return [_result("coverage_add", len(data.file_names), add_seconds), result]
+
+
+def bench_geocoder(data: Dataset) -> List[Dict[str, Any]]:
+    cache_dir = data.work_dir("geocoder")
+    positions = [
+        s2sphere.LatLng.from_degrees(*start_position(seed))
+        for seed in range(data.scale)
+    ]
+    geocoder = Geocoder()
+    geocoder.set_cache_dir(cache_dir)
+    geocoder.set_backends([_FixedBackend()])
+    for position in positions:
+        geocoder.get_location(position)
+    geocoder.set_cache_dir(cache_dir)  # closes the database
+
+    geocoder = Geocoder()
+    geocoder.set_cache_dir(cache_dir)
+    geocoder.set_backends([])
+    start = time.perf_counter()
+    for position in positions:
+        geocoder.get_location(position)
+    return [_result("geocoder_hits", len(positions), time.perf_counter() - start)]
+
+
+def _export(data: Dataset, cache_dir: str, export_dir: str):
+    tracks = Tracks()
+    tracks.set_cache_dir(cache_dir)
+    tracks.set_export_dir(export_dir)
+    tracks.set_poi_file(data.poi_file)
+    tracks.set_geocoder_backends(None, False)
+    tracks.load_tracks(data.activity_dir)
+
+
+def bench_export(data: Dataset) -> List[Dict[str, Any]]:
+    cache_dir = data.work_dir("export-cache")
+    export_dir = data.work_dir("export")
+    results = []
+    for name in ["export_cold", "export_warm"]:
+        start = time.perf_counter()
+        _export(data, cache_dir, export_dir)
+        results.append(_result(name, len(data.file_names), time.perf_counter() - start))
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("--scales", type=str, default="100,1000,10000")
+    args_parser.add_argument(
+        "--benchmarks", type=str, default=",".join(BENCHMARKS), metavar="NAMES"
+    )
+    args_parser.add_argument("--points", metavar="N", type=int, default=1000)
+    args_parser.add_argument("--segments", metavar="N", type=int, default=2)
+    args_parser.add_argument("--interval", metavar="SECONDS", type=int, default=1)
+    args_parser.add_argument("--fit-share", dest="fit_share", type=float, default=0.5)
+    args_parser.add_argument(
+        "--pois-per-track", dest="pois_per_track", type=int, default=1
+    )
+    args_parser.add_argument(
+        "--data-dir",
+        dest="data_dir",
+        metavar="DIR",
+        type=str,
+        help="keep the generated activities here and reuse them in later runs",
+    )
+    args_parser.add_argument(
+        "--output", metavar="FILE", type=str, default="benchmark-results.json"
+    )
+    args = args_parser.parse_args()
+
+    functions: Dict[str, Callable[[Dataset], List[Dict[str, Any]]]] = {
+        "parse": bench_parse,
+        "cache": bench_cache,
+        "pois": bench_pois,
+        "coverage": bench_coverage,
+        "geocoder": bench_geocoder,
+        "export": bench_export,
+    }
+    names = [name for name in args.benchmarks.split(",") if name]
+    for name in names:
+        if name not in functions:
+            args_parser.error(f"unknown benchmark: {name}")
+    scales = [int(scale) for scale in args.scales.split(",")]
+
+    results = []
+    with contextlib.ExitStack() as stack:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        for scale in scales:
+            data = Dataset(os.path.join(data_dir, str(scale)), scale, args)
+            for name in names:
+                with open(os.devnull, "w") as devnull:
+                    with contextlib.redirect_stdout(devnull):
+                        scale_results = functions[name](data)
+                for result in scale_results:
+                    result["scale"] = scale
+                    print(
+                        f"{scale:>6} {result['benchmark']:<14} "
+                        f"{result['seconds']:9.3f} s "
+                        f"{result['per_item_ms']:9.3f} ms/item"
+                    )
+                results.extend(scale_results)
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "commit": _git_commit(),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "numpy": geometry.numpy is not None,
+                "parameters": {
+                    "points": args.points,
+                    "segments": args.segments,
+                    "interval": args.interval,
+                    "fit_share": args.fit_share,
+                    "pois_per_track": args.pois_per_track,
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import math
+import os
+import random
+import struct
+from typing import List, Sequence, Tuple
+
+# Deterministic synthetic activity files for benchmarks.
+
+_FIT_EPOCH = datetime.datetime(1989, 12, 31, tzinfo=datetime.timezone.utc)
+_CRC_TABLE = (
+    0x0000,
+    0xCC01,
+    0xD801,
+    0x1400,
+    0xF001,
+    0x3C00,
+    0x2800,
+    0xE401,
+    0xA001,
+    0x6C00,
+    0x7800,
+    0xB401,
+    0x5000,
+    0x9C01,
+    0x8801,
+    0x4400,
+)
+
+
+def start_position(seed: int) -> Tuple[float, float]:
+    # activities start somewhere in a ~50 km wide area
+    rng = random.Random(seed)
+    return 47.8 + rng.uniform(0, 0.45), 7.6 + rng.uniform(0, 0.65)
+
+
+def random_walk(
+    points: int, seed: int, interval: float = 1.0
+) -> List[Tuple[float, float, float]]:
+    # (lat, lng, altitude) of a ~3 m/s walk sampled every `interval` seconds
+    rng = random.Random(seed)
+    lat, lng = start_position(seed)
+    heading = rng.uniform(0, 2 * math.pi)
+    altitude = rng.uniform(200, 1200)
+    step = 3.0 * interval
+    result = []
+    for _ in range(points):
+        heading += rng.gauss(0, 0.15)
+        lat += step * math.cos(heading) / 111000.0
+        lng += step * math.sin(heading) / (111000.0 * math.cos(math.radians(lat)))
+        altitude += rng.gauss(0, 0.5)
+        result.append((lat, lng, altitude))
+    return result
+
+
+def fit_crc(data: bytes, crc: int = 0) -> int:
+    for byte in data:
+        tmp = _CRC_TABLE[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ _CRC_TABLE[byte & 0xF]
+        tmp = _CRC_TABLE[crc & 0xF]
+        crc = (crc >> 4) & 0x0FFF
+        crc = crc ^ tmp ^ _CRC_TABLE[(byte >> 4) & 0xF]
+    return crc
+
+
+class _FitWriter:
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._formats = {}
+
+    def define(
+        self,
+        local: int,
+        mesg_num: int,
+        fields: Sequence[Tuple[int, int, int]],
+        developer_fields: Sequence[Tuple[int, int, int]] = (),
+        big_endian: bool = False,
+    ):
+        # fields: (field number, size, base type)
+        header = 0x40 | local | (0x20 if developer_fields else 0)
+        endian = ">" if big_endian else "<"
+        data = struct.pack(
+            endian + "BBBHB", header, 0, int(big_endian), mesg_num, len(fields)
+        )
+        for field in fields:
+            data += struct.pack("BBB", *field)
+        if developer_fields:
+            data += struct.pack("B", len(developer_fields))
+            for field in developer_fields:
+                data += struct.pack("BBB", *field)
+        codes = {0x00: "B", 0x02: "B", 0x84: "H", 0x85: "i", 0x86: "I"}
+        self._formats[local] = endian + "".join(
+            codes[base_type] if base_type in codes else f"{size}s"
+            for _, size, base_type in fields
+        )
+        self._chunks.append(data)
+
+    def write(self, local: int, *values, developer_data: bytes = b""):
+        data = struct.pack("B", local) + struct.pack(self._formats[local], *values)
+        self._chunks.append(data + developer_data)
+
+    def write_compressed(self, local: int, time_offset: int, *values):
+        header = 0x80 | (local << 5) | (time_offset & 0x1F)
+        self._chunks.append(
+            struct.pack("B", header) + struct.pack(self._formats[local], *values)
+        )
+
+    def to_bytes(self) -> bytes:
+        data = b"".join(self._chunks)
+        header = struct.pack("<BBHI4s", 14, 0x20, 2132, len(data), b".FIT")
+        header += struct.pack("<H", fit_crc(header))
+        return header + data + struct.pack("<H", fit_crc(header + data))
+
+
+def write_fit(
+    file_name: str,
+    points: int = 3600,
+    seed: int = 0,
+    start: datetime.datetime = datetime.datetime(
+        2019, 6, 1, 8, 0, tzinfo=datetime.timezone.utc
+    ),
+    segments: int = 2,
+    interval: int = 1,
+):
+    # A running activity with a record every `interval` seconds, split into
+    # `segments` by 5 minute pauses. It contains a GPS outage, invalid
+    # altitudes, compressed timestamp headers, a developer field and a big
+    # endian message.
+    rng = random.Random(seed)
+    walk = random_walk(points, seed, interval)
+    t0 = int((start - _FIT_EPOCH).total_seconds())
+    w = _FitWriter()
+
+    w.define(0, 0, [(0, 1, 0x00), (4, 4, 0x86)])  # file_id
+    w.write(0, 4, t0)
+    w.define(1, 207, [(1, 16, 0x0D), (3, 1, 0x02)])  # developer_data_id
+    w.write(1, bytes(range(16)), 0)
+    w.define(1, 206, [(0, 1, 0x02), (1, 1, 0x02), (2, 1, 0x02), (3, 16, 0x07)])
+    w.write(1, 0, 0, 0x84, b"power_estimate\0\0")  # field_description
+    w.define(1, 12, [(0, 1, 0x00), (1, 1, 0x00)])  # sport
+    w.write(1, 1, 3)
+    w.define(2, 21, [(253, 4, 0x86), (0, 1, 0x00), (1, 1, 0x00)])  # event
+    w.write(2, t0, 0, 0)
+    record_fields = [
+        (253, 4, 0x86),
+        (0, 4, 0x85),
+        (1, 4, 0x85),
+        (2, 2, 0x84),
+        (3, 1, 0x02),
+        (5, 4, 0x86),
+        (6, 2, 0x84),
+    ]
+    w.define(0, 20, record_fields, developer_fields=[(0, 2, 0)])
+    # records without timestamp field, used with compressed timestamp headers
+    w.define(3, 20, record_fields[1:])
+
+    pauses = {k * points // segments for k in range(1, segments)}
+    outage = range(points // 4, points // 4 + 30)
+    t = t0
+    paused = 0
+    compressed = 0
+    distance = 0.0
+    for i, (lat, lng, altitude) in enumerate(walk):
+        if i in pauses:
+            w.write(2, t, 0, 4)  # timer stop_all
+            t += 300
+            paused += 300
+            w.write(2, t, 0, 0)  # timer start
+            compressed = 5 if interval < 32 else 0
+        t += interval
+        distance += 3.0 * interval
+        lat_value = int(lat / 180.0 * 0x7FFFFFFF)
+        lng_value = int(lng / 180.0 * 0x7FFFFFFF)
+        if i in outage:
+            lat_value = lng_value = 0x7FFFFFFF
+        altitude_value = int(round((altitude + 500) * 5))
+        if i % 97 == 0:
+            altitude_value = 0xFFFF
+        values = (
+            lat_value,
+            lng_value,
+            altitude_value,
+            rng.randint(90, 180),
+            int(distance * 100),
+            3000,
+        )
+        if compressed > 0:
+            w.write_compressed(3, t, *values)
+            compressed -= 1
+        else:
+            w.write(
+                0, t, *values, developer_data=struct.pack("<H", rng.randint(0, 400))
+            )
+
+    elapsed = (t - t0) * 1000
+    timer = (t - t0 - paused) * 1000
+    lap_fields = [(253, 4, 0x86), (7, 4, 0x86), (8, 4, 0x86), (9, 4, 0x86)]
+    w.define(1, 19, lap_fields + [(25, 1, 0x00), (39, 1, 0x00)], big_endian=True)
+    w.write(1, t, elapsed, timer, int(distance * 100), 1, 3)
+    w.define(1, 18, lap_fields + [(5, 1, 0x00), (6, 1, 0x00)])  # session
+    w.write(1, t, elapsed, timer, int(distance * 100), 1, 3)
+
+    with open(file_name, "wb") as f:
+        f.write(w.to_bytes())
+
+
+def write_gpx(
+    file_name: str,
+    points: int = 3600,
+    seed: int = 0,
+    start: datetime.datetime = datetime.datetime(2019, 6, 1, 8, 0),
+    segments: int = 2,
+    interval: int = 1,
+):
+    # A GPX 1.1 running track with a point every `interval` seconds, split into
+    # `segments` by 5 minute pauses; written incrementally, so that huge files
+    # can be generated.
+    walk = random_walk(points, seed, interval)
+    pauses = {k * points // segments for k in range(1, segments)}
+    with open(file_name, "w") as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" '
+            'creator="benchmarks">\n<trk>\n<type>running</type>\n<trkseg>\n'
+        )
+        time = start
+        for i, (lat, lng, altitude) in enumerate(walk):
+            if i in pauses:
+                f.write("</trkseg>\n<trkseg>\n")
+                time += datetime.timedelta(minutes=5)
+            time += datetime.timedelta(seconds=interval)
+            f.write(
+                f'<trkpt lat="{lat:.7f}" lon="{lng:.7f}">'
+                f"<ele>{altitude:.1f}</ele>"
+                f"<time>{_gpx_time(time)}</time></trkpt>\n"
+            )
+        f.write("</trkseg>\n</trk>\n</gpx>\n")
+
+
+def _gpx_time(time: datetime.datetime) -> str:
+    # UTC with "Z", or local time with its offset if `time` is aware
+    if time.tzinfo is None:
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    return time.isoformat()
+
+
+def write_pois(file_name: str, count: int, seed: int = 0):
+    # "lat;lng;name" lines spread over the area of the activities
+    rng = random.Random(seed)
+    with open(file_name, "w") as f:
+        for i in range(count):
+            lat = 47.75 + rng.uniform(0, 0.6)
+            lng = 7.5 + rng.uniform(0, 0.85)
+            f.write(f"{lat:.6f};{lng:.6f};Poi{i}\n")
+
+
+def write_activities(
+    directory: str,
+    count: int,
+    points: int = 1000,
+    segments: int = 2,
+    interval: int = 1,
+    fit_share: float = 0.5,
+) -> List[str]:
+    # `count` activities on consecutive days, a `fit_share` of them as FIT
+    # files and the rest as GPX files
+    os.makedirs(directory, exist_ok=True)
+    file_names = []
+    fit_count = int(round(count * fit_share))
+    for i in range(count):
+        start = datetime.datetime(2010, 1, 1, 8, 0) + datetime.timedelta(days=i)
+        if i < fit_count:
+            file_name = os.path.join(directory, f"activity{i:05}.fit")
+            write_fit(
+                file_name,
+                points,
+                i,
+                start.replace(tzinfo=datetime.timezone.utc),
+                segments,
+                interval,
+            )
+        else:
+            file_name = os.path.join(directory, f"activity{i:05}.gpx")
+            write_gpx(file_name, points, i, start, segments, interval)
+        file_names.append(file_name)
+    return file_names
@@ -7,41 +7,114 @@
 
 
 import argparse
-import datetime
+import cProfile
+import functools
+import json
 import os
+import pstats
 import time
+import traceback
+import tracemalloc
 
+from src.metrics import metrics
+from src.sync import SyncFeed, Syncer
 from src.tracks import Tracks
-from vendor.garminexport.garminexport import backup, garminclient, retryer
+from src.watch import create_watcher
+from vendor.garminexport.garminexport import garminclient
 
 
-def sync(directory, username, password):
-    os.makedirs(directory, exist_ok=True)
-    retry = retryer.Retryer(
-        delay_strategy=retryer.ExponentialBackoffDelayStrategy(
-            initial_delay=datetime.timedelta(seconds=1)
-        ),
-        stop_strategy=retryer.MaxRetriesStopStrategy(2),
-    )
-    formats = ["fit"]
+def sync(
+    directory, username, password, journal_file, jobs=1, rate=None, on_download=None
+):
     with garminclient.GarminClient(username, password) as client:
-        activities = set(retry.call(client.list_activities))
-        print(f"{username} has {len(activities)} activities")
-        missing_activities = backup.need_backup(activities, directory, formats)
-        print(f"missing activities: {len(missing_activities)}")
-        for activity in missing_activities:
-            activity_id, start = activity
-            print(f"fetching: {activity_id} / {start}")
-            backup.download(client, activity, retry, directory, formats)
-
-
-def copy_file(source, target, timestamp):
-    os.makedirs(os.path.dirname(target), exist_ok=True)
-    with open(source, "r") as f:
-        data = f.read()
-    data = data.replace("{{TIMESTAMP}}", timestamp)
-    with open(target, "w") as f:
-        f.write(data)
+        syncer = Syncer(client, directory, journal_file)
+        syncer.set_jobs(jobs)
+        syncer.set_rate(rate)
+        print(f"syncing {username}")
+        return syncer.sync(on_download)
+
+
+def profile(function, *args):
+    # prints the functions with the most cumulative time and the lines that
+    # allocated the most memory still in use at the end; worker processes are
+    # not profiled
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(function, *args)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+        print(f"peak traced memory: {peak / 1024 / 1024:.1f} MiB")
+        for stat in snapshot.statistics("lineno")[:20]:
+            print(stat)
+
+
+def watch(t, watcher, directory, debounce):
+    # re-exports batches of changed files until interrupted
+    print(f"watching {directory} ({watcher.name})")
+    try:
+        while True:
+            changed = watcher.next_batch(debounce)
+            try:
+                if changed is None:
+                    print("changes may have been missed, rescanning")
+                    t.load_tracks(directory)
+                elif changed:
+                    print(f"{len(changed)} changed files")
+                    t.update_tracks(changed)
+            except Exception as e:
+                print(f"Error while updating: {e}")
+                traceback.print_exc()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def numbers(count):
+    # argparse type for `count` comma separated numbers
+    def parse(value):
+        try:
+            values = [float(v) for v in value.split(",")]
+        except ValueError:
+            values = []
+        if len(values) != count:
+            raise argparse.ArgumentTypeError(f"expected {count} numbers: {value}")
+        return values
+
+    return parse
+
+
+def query(args):
+    # prints the exported activities passing through the area
+    t = Tracks()
+    if args.cache_dir:
+        t.set_cache_dir(args.cache_dir)
+    t.set_export_dir(args.export_dir)
+    start = time.perf_counter()
+    if args.query_bbox is not None:
+        records = t.query_bbox(*args.query_bbox)
+    else:
+        records = t.query_radius(*args.query_radius)
+    milliseconds = 1000 * (time.perf_counter() - start)
+    for record in records:
+        print(
+            f"{record['start_time']}  {record['type']}  {record['distance']}  "
+            f"{record['location']}  {record['hash']}"
+        )
+    print(f"{len(records)} activities ({milliseconds:.1f} ms)")
+
+
+def write_metrics(file_name, seconds):
+    summary = metrics.summary()
+    summary["time"] = int(time.time())
+    summary["seconds"] = round(seconds, 6)
+    with open(file_name, "w") as f:
+        json.dump(summary, f, indent=2)
+        f.write("\n")
 
 
 def main():
@@ -52,13 +125,86 @@ def main():
     )
     args_parser.add_argument("--poi-file", dest="poi_file", metavar="FILE", type=str)
     args_parser.add_argument("--sync", dest="sync", action="store_true")
+    args_parser.add_argument(
+        "--sync-jobs", dest="sync_jobs", metavar="N", type=int, default=1
+    )
+    args_parser.add_argument(
+        "--sync-rate", dest="sync_rate", metavar="REQUESTS_PER_SECOND", type=float
+    )
+    args_parser.add_argument("--pipeline", dest="pipeline", action="store_true")
     args_parser.add_argument("--clear-cache", dest="clear_cache", action="store_true")
+    args_parser.add_argument("--jobs", dest="jobs", metavar="N", type=int, default=1)
+    args_parser.add_argument("--compact", dest="compact", action="store_true")
+    args_parser.add_argument("--full-hash", dest="full_hash", action="store_true")
+    args_parser.add_argument("--heatmap", dest="heatmap", action="store_true")
+    args_parser.add_argument("--precompress", dest="precompress", action="store_true")
+    args_parser.add_argument(
+        "--gazetteer", dest="gazetteer_file", metavar="FILE", type=str
+    )
+    args_parser.add_argument("--no-nominatim", dest="no_nominatim", action="store_true")
+    args_parser.add_argument(
+        "--refresh-unknown-locations-days",
+        dest="unknown_location_ttl_days",
+        metavar="DAYS",
+        type=float,
+    )
+    args_parser.add_argument("--watch", dest="watch", action="store_true")
+    args_parser.add_argument(
+        "--watch-debounce",
+        dest="watch_debounce",
+        metavar="SECONDS",
+        type=float,
+        default=2.0,
+    )
+    args_parser.add_argument(
+        "--query-bbox",
+        dest="query_bbox",
+        metavar="LAT1,LNG1,LAT2,LNG2",
+        type=numbers(4),
+    )
+    args_parser.add_argument(
+        "--query-radius",
+        dest="query_radius",
+        metavar="LAT,LNG,METERS",
+        type=numbers(3),
+    )
+    args_parser.add_argument("--profile", dest="profile", action="store_true")
+    args_parser.add_argument(
+        "--metrics-json", dest="metrics_json", metavar="FILE", type=str
+    )
     args = args_parser.parse_args()
 
+    if args.query_bbox is not None or args.query_radius is not None:
+        query(args)
+        return
+
+    start = time.perf_counter()
+    if args.profile:
+        profile(build, args)
+    else:
+        build(args)
+    seconds = time.perf_counter() - start
+    if args.profile:
+        metrics.print_report()
+    if args.metrics_json:
+        write_metrics(args.metrics_json, seconds)
+
+
+def build(args):
     t = Tracks()
     if args.poi_file:
         t.set_poi_file(args.poi_file)
     t.set_export_dir(args.export_dir)
+    t.set_jobs(args.jobs)
+    t.set_compact_export(args.compact)
+    t.set_full_hash(args.full_hash)
+    t.set_heatmap(args.heatmap)
+    t.set_assets_dir("assets")
+    t.set_precompress(args.precompress)
+    if args.gazetteer_file or args.no_nominatim:
+        t.set_geocoder_backends(args.gazetteer_file, not args.no_nominatim)
+    if args.unknown_location_ttl_days is not None:
+        t.set_unknown_location_ttl(args.unknown_location_ttl_days * 24 * 3600)
     if args.cache_dir:
         t.set_cache_dir(args.cache_dir)
     if args.clear_cache:
@@ -67,27 +213,38 @@ def main():
     tracks_data_dir = os.path.join(t._cache_dir, "garmin-connect")
     os.makedirs(tracks_data_dir, exist_ok=True)
 
+    watcher = None
+    if args.watch:
+        # started before the first export, so no file can slip through
+        watcher = create_watcher(tracks_data_dir, [".fit", ".gpx"])
+
+    incoming = None
     if args.sync:
-        print("syncing")
         GARMIN_ACCOUNT = os.environ["GARMIN_ACCOUNT"]
         GARMIN_PASSWORD = os.environ["GARMIN_PASSWORD"]
-        sync(tracks_data_dir, GARMIN_ACCOUNT, GARMIN_PASSWORD)
+        journal_file = os.path.join(t._cache_dir, "sync-journal.jsonl")
+        run_sync = functools.partial(
+            sync,
+            tracks_data_dir,
+            GARMIN_ACCOUNT,
+            GARMIN_PASSWORD,
+            journal_file,
+            args.sync_jobs,
+            args.sync_rate,
+        )
+        if args.pipeline:
+            # download while loading & exporting the already present files
+            incoming = SyncFeed(run_sync)
+        else:
+            print("syncing")
+            with metrics.stage("sync"):
+                run_sync()
 
     print("loading & exporting")
-    t.load_tracks(tracks_data_dir)
+    t.load_tracks(tracks_data_dir, incoming)
 
-    timestamp = f"{int(time.time())}"
-    copy_file(
-        "assets/index.html", os.path.join(args.export_dir, "index.html"), timestamp
-    )
-    copy_file(
-        "assets/style.css",
-        os.path.join(args.export_dir, "assets", "style.css"),
-        timestamp,
-    )
-    copy_file(
-        "assets/map.js", os.path.join(args.export_dir, "assets", "map.js"), timestamp
-    )
+    if watcher is not None:
+        watch(t, watcher, tracks_data_dir, args.watch_debounce)
 
 
 if __name__ == "__main__":
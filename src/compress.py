@@ -0,0 +1,79 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import concurrent.futures
+import gzip
+import os
+from typing import List
+
+from .metrics import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Precompressed siblings of exported files (`name.gz`, and `name.br` if the
+# brotli module is available), so that web servers can send them as they are
+# (e.g. nginx' gzip_static). Siblings are written with fixed headers, so the
+# same content always gives the same files.
+
+COMPRESSIBLE_EXTENSIONS = (".css", ".html", ".js", ".json")
+SIBLING_EXTENSIONS = (".gz", ".br")
+_BATCH = 32
+
+
+def is_compressible(file_name: str) -> bool:
+    return file_name.endswith(COMPRESSIBLE_EXTENSIONS)
+
+
+def has_siblings(file_name: str) -> bool:
+    if not os.path.isfile(f"{file_name}.gz"):
+        return False
+    return brotli is None or os.path.isfile(f"{file_name}.br")
+
+
+def remove_siblings(file_name: str):
+    for extension in SIBLING_EXTENSIONS:
+        if os.path.isfile(file_name + extension):
+            os.remove(file_name + extension)
+
+
+def _compress_file(file_name: str) -> int:
+    with open(file_name, "rb") as file:
+        data = file.read()
+    with open(f"{file_name}.gz", "wb") as file:
+        with gzip.GzipFile(
+            filename="", mode="wb", compresslevel=9, fileobj=file, mtime=0
+        ) as gz:
+            gz.write(data)
+        size = file.tell()
+    if brotli is not None:
+        compressed = brotli.compress(data)
+        with open(f"{file_name}.br", "wb") as file:
+            file.write(compressed)
+        size += len(compressed)
+    elif os.path.isfile(f"{file_name}.br"):
+        # would be outdated
+        os.remove(f"{file_name}.br")
+    return size
+
+
+def _compress_files(file_names: List[str]) -> int:
+    return sum(_compress_file(file_name) for file_name in file_names)
+
+
+def compress_files(file_names: List[str], jobs: int = 1) -> int:
+    # writes the siblings of the given files; returns their total size
+    batches = [file_names[i : i + _BATCH] for i in range(0, len(file_names), _BATCH)]
+    with metrics.stage("compress"):
+        if jobs > 1 and len(batches) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+                size = sum(pool.map(_compress_files, batches))
+        else:
+            size = sum(_compress_files(batch) for batch in batches)
+    metrics.count("files_compressed", len(file_names))
+    metrics.count("bytes_compressed", size)
+    return size
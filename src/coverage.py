@@ -0,0 +1,210 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Optional, Set
+
+import s2sphere
+
+from . import geometry
+from .track import Track
+from .utils import EARTH_RADIUS
+
+# Inverted index of the S2 cells (at LEVEL, about 600 m wide) visited by the
+# exported tracks, kept in a sqlite database in the cache. Cell ids are stored
+# as signed 64 bit integers, which keeps the order of the cells of one face, so
+# all cells below a cell of a query's covering are found with a range lookup.
+
+LEVEL = 14
+_MAX_QUERY_CELLS = 16
+
+
+def track_cells(t: Track) -> List[int]:
+    # sorted ids of the cells at LEVEL visited by the track's points
+    return sorted(set(geometry.cell_ids(t._lats, t._lngs, LEVEL)))
+
+
+def _signed(cell_id: int) -> int:
+    return cell_id - (1 << 64) if cell_id >= (1 << 63) else cell_id
+
+
+def _unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def _intersects(
+    region, cell_id: int, level: int, relations: Dict[int, Optional[bool]]
+) -> bool:
+    # whether the cell at LEVEL may intersect the region; decided by the
+    # first of its ancestors from `level` on that is contained in the region
+    # or disjoint from it, so most cells need no geometry
+    for ancestor_level in range(level, LEVEL + 1):
+        lsb = 1 << (2 * (s2sphere.CellId.MAX_LEVEL - ancestor_level))
+        ancestor = (cell_id & -lsb) | lsb
+        if ancestor not in relations:
+            cell = s2sphere.Cell(s2sphere.CellId(ancestor))
+            if region.contains(cell):
+                relations[ancestor] = True
+            elif not region.may_intersect(cell):
+                relations[ancestor] = False
+            else:
+                relations[ancestor] = None
+        relation = relations[ancestor]
+        if relation is not None:
+            return relation
+    return True
+
+
+class Coverage:
+    # The database may be used from the thread feeding the worker processes,
+    # too. Changes are committed by save().
+    VERSION = 1
+
+    def __init__(self):
+        self._db = None
+        self._lock = threading.Lock()
+
+    def open(self, file_name: str):
+        self.close()
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        self._db = sqlite3.connect(file_name, check_same_thread=False)
+        if self._get_meta("version") == f"{self.VERSION}":
+            return
+        with self._db:
+            self._db.execute("DROP TABLE IF EXISTS tracks")
+            self._db.execute("DROP TABLE IF EXISTS cells")
+            self._db.execute("DROP TABLE IF EXISTS meta")
+            self._db.execute(
+                "CREATE TABLE tracks (id INTEGER PRIMARY KEY, hash TEXT NOT NULL UNIQUE)"
+            )
+            self._db.execute(
+                "CREATE TABLE cells (cell INTEGER, track INTEGER, PRIMARY KEY (cell, track)) WITHOUT ROWID"
+            )
+            self._db.execute("CREATE INDEX cells_track ON cells (track)")
+            self._db.execute(
+                "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self._set_meta("version", f"{self.VERSION}")
+
+    def close(self):
+        if self._db is not None:
+            self._db.rollback()
+            self._db.close()
+            self._db = None
+
+    def save(self):
+        with self._lock:
+            self._db.commit()
+
+    def hashes(self) -> Iterator[str]:
+        return (row[0] for row in self._db.execute("SELECT hash FROM tracks"))
+
+    def has_track(self, track_hash: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM tracks WHERE hash = ?", (track_hash,)
+            ).fetchone()
+        return row is not None
+
+    def add_track(self, track_hash: str, cells: List[int]):
+        self.remove_track(track_hash)
+        with self._lock:
+            track_id = self._db.execute(
+                "INSERT INTO tracks (hash) VALUES (?)", (track_hash,)
+            ).lastrowid
+            self._db.executemany(
+                "INSERT OR IGNORE INTO cells (cell, track) VALUES (?, ?)",
+                ((_signed(cell), track_id) for cell in cells),
+            )
+
+    def remove_track(self, track_hash: str):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id FROM tracks WHERE hash = ?", (track_hash,)
+            ).fetchone()
+            if row is None:
+                return
+            self._db.execute("DELETE FROM cells WHERE track = ?", (row[0],))
+            self._db.execute("DELETE FROM tracks WHERE id = ?", (row[0],))
+
+    def query_rect(
+        self, lat1: float, lng1: float, lat2: float, lng2: float
+    ) -> Set[str]:
+        # hashes of the tracks visiting cells that intersect the rectangle
+        # between the latitudes and from `lng1` eastwards to `lng2` (in degrees)
+        return self._query(
+            s2sphere.LatLngRect(
+                s2sphere.LatLng.from_degrees(min(lat1, lat2), lng1),
+                s2sphere.LatLng.from_degrees(max(lat1, lat2), lng2),
+            )
+        )
+
+    def query_cap(self, lat_lng: s2sphere.LatLng, meters: float) -> Set[str]:
+        # hashes of the tracks visiting cells within `meters` of `lat_lng`
+        return self._query(
+            s2sphere.Cap.from_axis_angle(
+                lat_lng.to_point(),
+                s2sphere.Angle.from_radians(meters / EARTH_RADIUS),
+            )
+        )
+
+    def _query(self, region) -> Set[str]:
+        coverer = s2sphere.RegionCoverer()
+        coverer.max_level = LEVEL
+        coverer.max_cells = _MAX_QUERY_CELLS
+        track_ids: Set[int] = set()
+        # cell id -> whether the region contains it (True), does not intersect
+        # it (False) or partly intersects it (None)
+        relations: Dict[int, Optional[bool]] = {}
+        with self._lock:
+            for cell_id in coverer.get_covering(region):
+                rows = self._db.execute(
+                    "SELECT cell, track FROM cells WHERE cell BETWEEN ? AND ?",
+                    (
+                        _signed(cell_id.range_min().id()),
+                        _signed(cell_id.range_max().id()),
+                    ),
+                )
+                if region.contains(s2sphere.Cell(cell_id)):
+                    track_ids.update(row[1] for row in rows)
+                    continue
+                for cell, track_id in rows:
+                    if track_id not in track_ids and _intersects(
+                        region, _unsigned(cell), cell_id.level() + 1, relations
+                    ):
+                        track_ids.add(track_id)
+            return self._get_hashes(track_ids)
+
+    def _get_hashes(self, track_ids: Set[int]) -> Set[str]:
+        hashes: Set[str] = set()
+        ids = sorted(track_ids)
+        for i in range(0, len(ids), 500):
+            batch = ids[i : i + 500]
+            hashes.update(
+                row[0]
+                for row in self._db.execute(
+                    f"SELECT hash FROM tracks WHERE id IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+            )
+        return hashes
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT value FROM meta WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key: str, value: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+            )
@@ -0,0 +1,84 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import array
+import math
+import s2sphere
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import geometry
+from .utils import distance
+
+# Fingerprints identify the same activity in different files (e.g. the FIT and
+# the GPX export of a Garmin activity, or a re-download under another name):
+# start time, duration, start and end point and the S2 cells visited. Only
+# activities that started within start_range() can be duplicates, so finding
+# one compares against very few candidates.
+
+_CELL_LEVEL = 13  # ~1 km
+_MAX_SAMPLES = 512
+_MAX_START_DIFFERENCE = 60  # seconds
+_MAX_DURATION_DIFFERENCE = 60  # seconds, or 5% of the duration
+_MAX_POINT_DISTANCE = 250.0  # meters
+_MIN_CELL_SIMILARITY = 0.7
+
+
+def compute_fingerprint(t) -> Optional[Dict[str, Any]]:
+    # `t` is a Track with points
+    count = t.point_count()
+    if count == 0:
+        return None
+    step = max(1, int(math.ceil(count / _MAX_SAMPLES)))
+    indices = list(range(0, count, step))
+    if indices[-1] != count - 1:
+        indices.append(count - 1)
+    cells = {
+        # like s2sphere.CellId.to_token
+        format(cell, "016x").rstrip("0")
+        for cell in geometry.cell_ids(
+            array.array("i", (t._lats[i] for i in indices)),
+            array.array("i", (t._lngs[i] for i in indices)),
+            _CELL_LEVEL,
+        )
+    }
+    return {
+        "start": t._base_time + t._times[0],
+        "duration": t._times[-1] - t._times[0],
+        "start_point": [t._lats[0], t._lngs[0]],
+        "end_point": [t._lats[-1], t._lngs[-1]],
+        "cells": sorted(cells),
+    }
+
+
+def start_range(fingerprint: Dict[str, Any]) -> Tuple[int, int]:
+    # start times of possible duplicates
+    return (
+        fingerprint["start"] - _MAX_START_DIFFERENCE,
+        fingerprint["start"] + _MAX_START_DIFFERENCE,
+    )
+
+
+def is_duplicate(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    if abs(a["start"] - b["start"]) > _MAX_START_DIFFERENCE:
+        return False
+    max_duration_difference = max(
+        _MAX_DURATION_DIFFERENCE, 0.05 * max(a["duration"], b["duration"])
+    )
+    if abs(a["duration"] - b["duration"]) > max_duration_difference:
+        return False
+    for key in ["start_point", "end_point"]:
+        if _point_distance(a[key], b[key]) > _MAX_POINT_DISTANCE:
+            return False
+    cells_a = set(a["cells"])
+    cells_b = set(b["cells"])
+    similarity = len(cells_a & cells_b) / max(1, len(cells_a | cells_b))
+    return similarity >= _MIN_CELL_SIMILARITY
+
+
+def _point_distance(a: List[int], b: List[int]) -> float:
+    return distance(
+        s2sphere.LatLng.from_degrees(a[0] / 1000000.0, a[1] / 1000000.0),
+        s2sphere.LatLng.from_degrees(b[0] / 1000000.0, b[1] / 1000000.0),
+    )
@@ -0,0 +1,283 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import array
+import math
+import struct
+from typing import Dict, List, Optional, Tuple
+
+from fitparse.profile import FIELD_TYPES
+
+# Single pass FIT decoder for the few messages Track needs. Definitions of
+# other messages are only used to skip their data (and to follow the
+# timestamps for compressed timestamp headers); developer fields are skipped.
+
+_MESG_SESSION = 18
+_MESG_LAP = 19
+_MESG_RECORD = 20
+_MESG_EVENT = 21
+_MESG_SPORT = 12
+_FIELD_TIMESTAMP = 253
+
+# message number -> field numbers to decode (besides the timestamp)
+_WANTED_FIELDS = {
+    _MESG_RECORD: (0, 1, 2),  # position_lat, position_long, altitude
+    _MESG_SESSION: (7, 8, 9),  # total_elapsed_time, total_timer_time, total_distance
+    _MESG_SPORT: (0, 1),  # sport, sub_sport
+    _MESG_LAP: (25, 39),  # sport, sub_sport
+    _MESG_EVENT: (0, 1),  # event, event_type
+}
+
+_EVENT_TIMER = 0
+_EVENT_TYPES_STOP = (1, 4)  # stop, stop_all
+
+# base type number -> (struct code, size, invalid value)
+_BASE_TYPES = {
+    0x00: ("B", 1, 0xFF),  # enum
+    0x01: ("b", 1, 0x7F),  # sint8
+    0x02: ("B", 1, 0xFF),  # uint8
+    0x03: ("h", 2, 0x7FFF),  # sint16
+    0x04: ("H", 2, 0xFFFF),  # uint16
+    0x05: ("i", 4, 0x7FFFFFFF),  # sint32
+    0x06: ("I", 4, 0xFFFFFFFF),  # uint32
+    0x08: ("f", 4, None),  # float32
+    0x09: ("d", 8, None),  # float64
+    0x0A: ("B", 1, 0x00),  # uint8z
+    0x0B: ("H", 2, 0x0000),  # uint16z
+    0x0C: ("I", 4, 0x00000000),  # uint32z
+    0x0D: ("B", 1, 0xFF),  # byte
+    0x0E: ("q", 8, 0x7FFFFFFFFFFFFFFF),  # sint64
+    0x0F: ("Q", 8, 0xFFFFFFFFFFFFFFFF),  # uint64
+    0x10: ("Q", 8, 0x0000000000000000),  # uint64z
+}
+
+# FIT timestamps count seconds since 1989-12-31 00:00 UTC; smaller values are
+# relative times
+UTC_REFERENCE = 631065600
+_MIN_TIMESTAMP = 0x10000000
+
+_FILE_HEADER = struct.Struct("<BBHI4s")
+
+
+class FitActivity:
+    def __init__(self):
+        # raw values of all record messages with timestamp and position
+        self.timestamps = array.array("I")
+        self.lats = array.array("i")  # semicircles
+        self.lngs = array.array("i")  # semicircles
+        self.altitudes = array.array("f")  # meters, NaN if unknown
+        self.segment_ends = array.array("I")
+        # unix times
+        self.start_time: Optional[int] = None
+        self.end_time: Optional[int] = None
+        self.elapsed_time: Optional[float] = None
+        self.timer_time: Optional[float] = None
+        self.distance: Optional[float] = None
+        # (sport, sub_sport) of all sport and lap messages, as named by fitparse
+        self.sports: List[Tuple[object, object]] = []
+
+    def end_segment(self):
+        begin = self.segment_ends[-1] if len(self.segment_ends) > 0 else 0
+        if len(self.timestamps) > begin:
+            self.segment_ends.append(len(self.timestamps))
+
+
+class _Definition:
+    def __init__(self, mesg_num: int, size: int):
+        self.mesg_num = mesg_num
+        self.size = size
+        # struct covering the whole message if it is decoded, else None
+        self.struct: Optional[struct.Struct] = None
+        # field number -> (index into the unpacked tuple, invalid value)
+        self.fields: Dict[int, Tuple[int, Optional[int]]] = {}
+        # offset of a scalar timestamp field in messages that are skipped
+        self.timestamp_offset: Optional[int] = None
+        self.timestamp_struct: Optional[struct.Struct] = None
+
+
+def read_fit(file_name: str) -> FitActivity:
+    with open(file_name, "rb") as f:
+        data = f.read()
+    activity = FitActivity()
+    pos = 0
+    # chained FIT files are simply concatenated
+    while pos + 12 <= len(data):
+        header_size, _, _, data_size, signature = _FILE_HEADER.unpack_from(data, pos)
+        if signature != b".FIT" or header_size < 12:
+            raise Exception(f"Invalid FIT file header in {file_name}")
+        begin = pos + header_size
+        end = begin + data_size
+        if end > len(data):
+            raise Exception(f"Truncated FIT file {file_name}")
+        _read_messages(data, begin, end, activity)
+        pos = end + 2  # CRC
+    activity.end_segment()
+    return activity
+
+
+def _read_messages(data: bytes, pos: int, end: int, activity: FitActivity):
+    definitions: Dict[int, _Definition] = {}
+    last_timestamp = 0
+    timestamps = activity.timestamps
+    lats = activity.lats
+    lngs = activity.lngs
+    altitudes = activity.altitudes
+    start_time = activity.start_time
+    end_time = activity.end_time
+    while pos < end:
+        header = data[pos]
+        pos += 1
+        timestamp = None
+        if header & 0x80:
+            # compressed timestamp header
+            local = (header >> 5) & 0x3
+            offset = header & 0x1F
+            timestamp = (last_timestamp & ~0x1F) + offset
+            if offset < (last_timestamp & 0x1F):
+                timestamp += 0x20
+            last_timestamp = timestamp
+        elif header & 0x40:
+            local = header & 0xF
+            pos = _read_definition(data, pos, header & 0x20, local, definitions)
+            continue
+        else:
+            local = header & 0xF
+
+        definition = definitions.get(local)
+        if definition is None:
+            raise Exception(f"Missing FIT definition for local message {local}")
+        if definition.struct is None:
+            if (
+                definition.timestamp_struct is not None
+                and definition.timestamp_offset is not None
+            ):
+                (value,) = definition.timestamp_struct.unpack_from(
+                    data, pos + definition.timestamp_offset
+                )
+                if value != 0xFFFFFFFF:
+                    last_timestamp = value
+            pos += definition.size
+            continue
+
+        values = definition.struct.unpack_from(data, pos)
+        pos += definition.size
+        fields = definition.fields
+        if _FIELD_TIMESTAMP in fields:
+            value = _get(values, fields, _FIELD_TIMESTAMP)
+            if value is not None:
+                last_timestamp = value
+                timestamp = value
+
+        mesg_num = definition.mesg_num
+        if mesg_num == _MESG_RECORD:
+            if timestamp is None or timestamp < _MIN_TIMESTAMP:
+                continue
+            time = timestamp + UTC_REFERENCE
+            if start_time is None:
+                start_time = end_time = time
+            elif time < start_time:
+                start_time = time
+            elif time > start_time:
+                end_time = time
+            lat = _get(values, fields, 0)
+            lng = _get(values, fields, 1)
+            if lat is None or lng is None:
+                continue
+            altitude = _get(values, fields, 2)
+            timestamps.append(timestamp)
+            lats.append(lat)
+            lngs.append(lng)
+            altitudes.append(
+                float(altitude) / 5 - 500 if altitude is not None else math.nan
+            )
+        elif mesg_num == _MESG_EVENT:
+            if _get(values, fields, 0) == _EVENT_TIMER and (
+                _get(values, fields, 1) in _EVENT_TYPES_STOP
+            ):
+                activity.end_segment()
+        elif mesg_num == _MESG_SESSION:
+            value = _get(values, fields, 7)
+            if value is not None:
+                activity.elapsed_time = float(value) / 1000
+            value = _get(values, fields, 8)
+            if value is not None:
+                activity.timer_time = float(value) / 1000
+            value = _get(values, fields, 9)
+            if value is not None:
+                activity.distance = float(value) / 100
+        else:
+            # sport or lap
+            sport_field, sub_sport_field = _WANTED_FIELDS[mesg_num]
+            activity.sports.append(
+                (
+                    _enum_name("sport", _get(values, fields, sport_field)),
+                    _enum_name("sub_sport", _get(values, fields, sub_sport_field)),
+                )
+            )
+    activity.start_time = start_time
+    activity.end_time = end_time
+
+
+def _read_definition(
+    data: bytes, pos: int, developer_data: int, local: int, definitions
+) -> int:
+    architecture = data[pos + 1]
+    endian = ">" if architecture else "<"
+    (mesg_num,) = struct.unpack_from(endian + "H", data, pos + 2)
+    field_count = data[pos + 4]
+    pos += 5
+    wanted = _WANTED_FIELDS.get(mesg_num, ())
+    codes = [endian]
+    fields = {}
+    timestamp = None
+    size = 0
+    for i in range(field_count):
+        field_num, field_size, base_type = data[pos], data[pos + 1], data[pos + 2]
+        pos += 3
+        code, type_size, invalid = _BASE_TYPES.get(base_type & 0x1F, ("B", 1, None))
+        if field_size == type_size:
+            if field_num in wanted or field_num == _FIELD_TIMESTAMP:
+                fields[field_num] = (len(codes) - 1, invalid)
+            if field_num == _FIELD_TIMESTAMP and code == "I":
+                timestamp = size
+            codes.append(code)
+        else:
+            # arrays and strings
+            codes.append(f"{field_size}s")
+        size += field_size
+    if developer_data:
+        developer_size = 0
+        for i in range(data[pos]):
+            developer_size += data[pos + 2 + 3 * i]
+        pos += 1 + 3 * data[pos]
+        if developer_size > 0:
+            codes.append(f"{developer_size}x")
+        size += developer_size
+
+    definition = _Definition(mesg_num, size)
+    if wanted:
+        definition.struct = struct.Struct("".join(codes))
+        definition.fields = fields
+    elif timestamp is not None:
+        definition.timestamp_offset = timestamp
+        definition.timestamp_struct = struct.Struct(endian + "I")
+    definitions[local] = definition
+    return pos
+
+
+def _get(values: tuple, fields: Dict[int, Tuple[int, Optional[int]]], field_num: int):
+    field = fields.get(field_num)
+    if field is None:
+        return None
+    value = values[field[0]]
+    if value == field[1]:
+        return None
+    return value
+
+
+def _enum_name(type_name: str, value: Optional[int]):
+    if value is None:
+        return None
+    return FIELD_TYPES[type_name].values.get(value, value)
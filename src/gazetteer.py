@@ -0,0 +1,136 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import math
+import os
+from typing import Dict, List, Optional, Tuple
+
+from .utils import EARTH_RADIUS
+
+_CELL_DEGREES = 0.1
+_COLUMNS = int(round(360 / _CELL_DEGREES))
+
+
+class Gazetteer:
+    # Offline reverse geocoder: returns "Place, Country" of the nearest place of
+    # a local gazetteer file. Supported formats are GeoNames dumps (e.g.
+    # cities1000.txt, tab separated; country names are taken from a
+    # countryInfo.txt in the same directory if present) and "place;country;lat;lng"
+    # text files.
+    persistent = False
+
+    def __init__(self, max_distance: float = 50000.0):
+        self._max_distance = max_distance
+        self._grid: Dict[Tuple[int, int], List[Tuple[float, float, str]]] = {}
+        self._size = 0
+
+    def load(self, file_name: str):
+        self._grid = {}
+        self._size = 0
+        countries = self._load_country_names(
+            os.path.join(os.path.dirname(file_name), "countryInfo.txt")
+        )
+        with open(file_name, encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\r\n")
+                if line == "" or line.startswith("#"):
+                    continue
+                columns = line.split("\t")
+                if len(columns) >= 9:
+                    place, lat, lng = columns[1], columns[4], columns[5]
+                    country = countries.get(columns[8], columns[8])
+                else:
+                    columns = line.split(";")
+                    if len(columns) != 4:
+                        continue
+                    place, country, lat, lng = columns
+                try:
+                    self._add(float(lat), float(lng), place, country)
+                except ValueError:
+                    continue
+
+    def size(self) -> int:
+        return self._size
+
+    def reverse(self, lat: float, lng: float) -> Optional[str]:
+        if self._size == 0:
+            return None
+        lat_radians = math.radians(lat)
+        lng_radians = math.radians(lng)
+        row, column = _cell(lat, lng)
+        best_distance = self._max_distance
+        best = None
+        # cells of ring r are at least (r - 1) * ring_distance away from any point
+        # of the center cell
+        max_lat = (
+            abs(lat) + math.degrees(self._max_distance / EARTH_RADIUS) + _CELL_DEGREES
+        )
+        ring_distance = (
+            math.radians(_CELL_DEGREES)
+            * EARTH_RADIUS
+            * max(math.cos(math.radians(min(90.0, max_lat))), 0.01)
+        )
+        ring = 0
+        while (ring - 1) * ring_distance <= best_distance:
+            for r, c in _ring(row, column, ring):
+                for entry in self._grid.get((r, c), []):
+                    d = _distance(lat_radians, lng_radians, entry[0], entry[1])
+                    if d <= best_distance:
+                        best_distance = d
+                        best = entry[2]
+            ring += 1
+        return best
+
+    def _add(self, lat: float, lng: float, place: str, country: str):
+        label = ", ".join(x for x in [place, country] if x != "")
+        if label == "":
+            return
+        self._grid.setdefault(_cell(lat, lng), []).append(
+            (math.radians(lat), math.radians(lng), label)
+        )
+        self._size += 1
+
+    @staticmethod
+    def _load_country_names(file_name: str) -> Dict[str, str]:
+        countries = {}
+        if os.path.isfile(file_name):
+            with open(file_name, encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("#"):
+                        continue
+                    columns = line.rstrip("\r\n").split("\t")
+                    if len(columns) > 4:
+                        countries[columns[0]] = columns[4]
+        return countries
+
+
+def _cell(lat: float, lng: float) -> Tuple[int, int]:
+    return (
+        int(math.floor(lat / _CELL_DEGREES)),
+        _wrap(int(math.floor(lng / _CELL_DEGREES))),
+    )
+
+
+def _ring(row: int, column: int, ring: int):
+    if ring == 0:
+        yield row, column
+        return
+    for c in range(column - ring, column + ring + 1):
+        yield row - ring, _wrap(c)
+        yield row + ring, _wrap(c)
+    for r in range(row - ring + 1, row + ring):
+        yield r, _wrap(column - ring)
+        yield r, _wrap(column + ring)
+
+
+def _wrap(column: int) -> int:
+    return (column + _COLUMNS // 2) % _COLUMNS - _COLUMNS // 2
+
+
+def _distance(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    dlat = math.sin(0.5 * (lat2 - lat1))
+    dlng = math.sin(0.5 * (lng2 - lng1))
+    x = dlat * dlat + dlng * dlng * math.cos(lat1) * math.cos(lat2)
+    return 2 * math.atan2(math.sqrt(x), math.sqrt(max(0.0, 1.0 - x))) * EARTH_RADIUS
@@ -6,65 +6,157 @@
 import geopy
 import os
 import s2sphere
+import sqlite3
+import time
+from typing import List, Optional
 
 from .config import __agent__
+from .metrics import metrics
 
 
-class Geocoder:
+class NominatimBackend:
+    # results of online lookups are stored in the location cache
+    persistent = True
+
     def __init__(self):
         self._geocoder = geopy.geocoders.Nominatim(user_agent=__agent__)
+
+    def reverse(self, lat: float, lng: float) -> Optional[str]:
+        metrics.count("network_calls")
+        location = self._geocoder.reverse(f"{lat:f}, {lng:f}")
+        if location is None or "address" not in location.raw:
+            return None
+        address = location.raw["address"]
+        country = address["country"] if "country" in address else None
+        city = None
+        for city_key in ["hamlet", "village", "town", "city"]:
+            if city_key in address:
+                city = address[city_key]
+                break
+        a = []
+        if city is not None:
+            a.append(city)
+        if country is not None:
+            a.append(country)
+        if len(a) > 0:
+            return ", ".join(a)
+        return None
+
+
+class Geocoder:
+    def __init__(self):
+        self._backends: List = [NominatimBackend()]
         self._cache_dir = None
         self._cache = {}
+        self._db = None
+        self._unknown_ttl = None
 
     def set_cache_dir(self, directory: str):
         self._cache_dir = directory
+        self._cache = {}
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def set_backends(self, backends: List):
+        # backends are queried in order until one of them knows the location
+        self._backends = backends
+
+    def set_unknown_ttl(self, seconds: Optional[float]):
+        # "Unknown" results older than this are looked up again
+        self._unknown_ttl = seconds
 
     def get_location(self, latlng: s2sphere.LatLng) -> str:
+        with metrics.stage("geocode"):
+            return self._get_location(latlng)
+
+    def _get_location(self, latlng: s2sphere.LatLng) -> str:
         lat1000 = int(round(latlng.lat().degrees * 1000))
         lng1000 = int(round(latlng.lng().degrees * 1000))
         key = f"{lat1000}:{lng1000}"
 
-        if key in self._cache:
-            return self._cache[key]
+        if self._db is None:
+            self._load_cache()
 
-        if self._load_cache(key):
+        if key in self._cache:
+            metrics.count("geocoder_cache_hits")
             return self._cache[key]
 
-        location = self._geocoder.reverse(f"{lat1000 * 0.001:f}, {lng1000 * 0.001:f}")
-        if "address" in location.raw:
-            address = location.raw["address"]
-            country = address["country"] if "country" in address else None
-            city = None
-            for city_key in ["hamlet", "village", "town", "city"]:
-                if city_key in address:
-                    city = address[city_key]
-                    break
-            a = []
-            if city is not None:
-                a.append(city)
-            if country is not None:
-                a.append(country)
-            if len(a) > 0:
-                self._cache[key] = ", ".join(a)
-            else:
-                self._cache[key] = "Unknown"
-        else:
-            self._cache[key] = "Unknown"
-
-        self._store_cache(key)
+        metrics.count("geocoder_lookups")
+        location = None
+        persistent = False
+        for backend in self._backends:
+            location = backend.reverse(lat1000 * 0.001, lng1000 * 0.001)
+            persistent = persistent or backend.persistent
+            if location is not None:
+                break
+        self._cache[key] = location if location is not None else "Unknown"
+        if persistent:
+            self._store_cache(key)
 
         return self._cache[key]
 
-    def _load_cache(self, key: str) -> bool:
-        cache_file_name = os.path.join(self._cache_dir, "location", key)
-        if os.path.isfile(cache_file_name):
-            with open(cache_file_name) as file:
-                self._cache[key] = file.read()
-            return True
-        return False
+    def import_file_cache(self, directory: str) -> int:
+        # imports a cache directory with one file per location, as written by
+        # earlier versions
+        if self._db is None:
+            self._load_cache()
+        rows = []
+        for key in os.listdir(directory):
+            file_name = os.path.join(directory, key)
+            if os.path.isfile(file_name):
+                with open(file_name) as file:
+                    rows.append((key, file.read(), os.path.getmtime(file_name)))
+        with self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO locations (key, location, updated) VALUES (?, ?, ?)",
+                rows,
+            )
+        for key, location, _ in rows:
+            self._cache.setdefault(key, location)
+        return len(rows)
+
+    def _load_cache(self):
+        os.makedirs(self._cache_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self._cache_dir, "locations.sqlite"))
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS locations (key TEXT PRIMARY KEY, location TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+        self._cache = {}
+        min_unknown_time = (
+            time.time() - self._unknown_ttl if self._unknown_ttl is not None else None
+        )
+        for key, location, updated in self._db.execute(
+            "SELECT key, location, updated FROM locations"
+        ):
+            if (
+                location == "Unknown"
+                and min_unknown_time is not None
+                and updated < min_unknown_time
+            ):
+                continue
+            self._cache[key] = location
+
+        legacy_dir = os.path.join(self._cache_dir, "location")
+        imported = self._db.execute(
+            "SELECT value FROM meta WHERE key = 'file_cache_imported'"
+        ).fetchone()
+        if imported is None and os.path.isdir(legacy_dir):
+            print(f"importing location cache: {legacy_dir}")
+            self.import_file_cache(legacy_dir)
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('file_cache_imported', ?)",
+                    (f"{time.time()}",),
+                )
 
     def _store_cache(self, key: str):
-        cache_file_name = os.path.join(self._cache_dir, "location", key)
-        os.makedirs(os.path.dirname(cache_file_name), exist_ok=True)
-        with open(cache_file_name, "w") as file:
-            file.write(self._cache[key])
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO locations (key, location, updated) VALUES (?, ?, ?)",
+                (key, self._cache[key], time.time()),
+            )
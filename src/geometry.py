@@ -0,0 +1,200 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import array
+import s2sphere
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+from .utils import EARTH_RADIUS, distance
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # type: ignore
+
+# coordinates in microdegrees: arrays of a Track or int32 numpy arrays (e.g.
+# slices of them)
+Microdegrees = Union[array.array, "numpy.ndarray"]
+
+# Batch kernels for coordinate arrays in microdegrees (as stored by Track). They
+# use numpy if it is available and fall back to per point s2sphere code.
+
+if numpy is not None:
+    # per face: axes and signs of the numerators of u and v, see
+    # s2sphere.sphere.valid_face_xyz_to_uv
+    _U_AXES = numpy.array([1, 0, 0, 2, 2, 1])
+    _U_SIGNS = numpy.array([1.0, -1.0, -1.0, 1.0, 1.0, -1.0])
+    _V_AXES = numpy.array([2, 2, 1, 1, 0, 0])
+    _V_SIGNS = numpy.array([1.0, 1.0, -1.0, 1.0, -1.0, -1.0])
+    _LOOKUP_POS = numpy.array(s2sphere.sphere.LOOKUP_POS, dtype=numpy.int64)
+    # of the 4 bit groups of i and j, from the most significant one
+    _SHIFTS = numpy.arange(28, -1, -4)[:, None]
+
+
+def bbox(
+    lats: array.array, lngs: array.array
+) -> Optional[Tuple[float, float, float, float]]:
+    # (min lat, min lng, max lat, max lng) in degrees
+    if len(lats) == 0:
+        return None
+    if numpy is not None:
+        lat_values = numpy.frombuffer(lats, dtype=numpy.int32)
+        lng_values = numpy.frombuffer(lngs, dtype=numpy.int32)
+        return (
+            int(lat_values.min()) / 1000000.0,
+            int(lng_values.min()) / 1000000.0,
+            int(lat_values.max()) / 1000000.0,
+            int(lng_values.max()) / 1000000.0,
+        )
+    return (
+        min(lats) / 1000000.0,
+        min(lngs) / 1000000.0,
+        max(lats) / 1000000.0,
+        max(lngs) / 1000000.0,
+    )
+
+
+def step_distances(lats: array.array, lngs: array.array) -> Sequence[float]:
+    # distances in meters between consecutive points
+    if len(lats) < 2:
+        return []
+    if numpy is not None:
+        lat_radians, lng_radians = _to_radians(lats, lngs)
+        return _haversine(
+            lat_radians[:-1], lng_radians[:-1], lat_radians[1:], lng_radians[1:]
+        )
+    lat_lngs = _to_lat_lngs(lats, lngs)
+    return [distance(p0, p1) for p0, p1 in zip(lat_lngs[:-1], lat_lngs[1:])]
+
+
+def distances_to(
+    lats: Microdegrees, lngs: Microdegrees, lat_lng: s2sphere.LatLng
+) -> Sequence[float]:
+    # distances in meters of all points to `lat_lng`
+    if numpy is not None:
+        lat_radians, lng_radians = _to_radians(lats, lngs)
+        return _haversine(
+            lat_radians, lng_radians, lat_lng.lat().radians, lat_lng.lng().radians
+        )
+    return [distance(lat_lng, p) for p in _to_lat_lngs(lats, lngs)]
+
+
+def path_length(
+    lats: array.array, lngs: array.array, ranges: Iterable[Tuple[int, int]]
+) -> float:
+    # total length in meters of all (begin, end) index ranges
+    steps = step_distances(lats, lngs)
+    length = 0.0
+    for begin, end in ranges:
+        if end - begin >= 2:
+            length += float(sum(steps[begin : end - 1]))
+    return length
+
+
+def semicircles_to_microdegrees(values: array.array) -> array.array:
+    # FIT positions: 2^31 semicircles = 180 degrees
+    result = array.array("i")
+    if numpy is not None:
+        degrees = 180.0 * (numpy.frombuffer(values, dtype=numpy.int32) / 2147483647.0)
+        result.frombytes(numpy.rint(degrees * 1000000.0).astype(numpy.int32).tobytes())
+        return result
+    result.extend(
+        int(round(180.0 * (float(value) / 2147483647.0) * 1000000.0))
+        for value in values
+    )
+    return result
+
+
+def cell_ids(lats: array.array, lngs: array.array, level: int) -> List[int]:
+    # ids of the S2 cells at `level` containing the points (same as
+    # s2sphere.CellId.from_lat_lng(...).parent(level))
+    if len(lats) == 0:
+        return []
+    if numpy is not None:
+        lat_radians, lng_radians = _to_radians(lats, lngs)
+        return _cell_ids(lat_radians, lng_radians, level).tolist()
+    return [
+        s2sphere.CellId.from_lat_lng(lat_lng).parent(level).id()
+        for lat_lng in _to_lat_lngs(lats, lngs)
+    ]
+
+
+def _to_radians(lats, lngs):
+    return (
+        numpy.radians(_as_numpy(lats) / 1000000.0),
+        numpy.radians(_as_numpy(lngs) / 1000000.0),
+    )
+
+
+def _as_numpy(values):
+    if isinstance(values, numpy.ndarray):
+        return values
+    return numpy.frombuffer(values, dtype=numpy.int32)
+
+
+def _to_lat_lngs(lats: array.array, lngs: array.array) -> List[s2sphere.LatLng]:
+    return [
+        s2sphere.LatLng.from_degrees(lat / 1000000.0, lng / 1000000.0)
+        for lat, lng in zip(lats, lngs)
+    ]
+
+
+def _haversine(from_lat, from_lng, to_lat, to_lng):
+    # same formula as s2sphere.LatLng.get_distance
+    dlat = numpy.sin(0.5 * (to_lat - from_lat))
+    dlng = numpy.sin(0.5 * (to_lng - from_lng))
+    x = dlat * dlat + dlng * dlng * numpy.cos(from_lat) * numpy.cos(to_lat)
+    return (
+        2
+        * numpy.arctan2(numpy.sqrt(x), numpy.sqrt(numpy.maximum(0.0, 1.0 - x)))
+        * EARTH_RADIUS
+    )
+
+
+def _uv_to_st(u):
+    st = 0.5 * numpy.sqrt(1 + 3 * numpy.abs(u))
+    return numpy.where(u >= 0, st, 1 - st)
+
+
+def _cell_ids(lat, lng, level: int):
+    # vectorized s2sphere.CellId.from_point with the quadratic projection
+    cos_lat = numpy.cos(lat)
+    xyz = numpy.stack(
+        [numpy.cos(lng) * cos_lat, numpy.sin(lng) * cos_lat, numpy.sin(lat)]
+    )
+    magnitudes = numpy.abs(xyz)
+    axis = numpy.where(
+        magnitudes[0] > magnitudes[1],
+        numpy.where(magnitudes[0] > magnitudes[2], 0, 2),
+        numpy.where(magnitudes[1] > magnitudes[2], 1, 2),
+    )
+    columns = numpy.arange(len(lat))
+    denominator = xyz[axis, columns]
+    face = axis + 3 * (denominator < 0)
+    u = _U_SIGNS[face] * xyz[_U_AXES[face], columns]
+    v = _V_SIGNS[face] * xyz[_V_AXES[face], columns]
+    size = 1 << s2sphere.CellId.MAX_LEVEL
+    i, j = (
+        numpy.clip(numpy.floor(size * _uv_to_st(w / denominator)), 0, size - 1).astype(
+            numpy.int64
+        )
+        for w in (u, v)
+    )
+    # Hilbert curve position from 4 bits of i and j per step, like
+    # s2sphere.CellId.from_face_ij
+    keys = (((i >> _SHIFTS) & 15) << 6) | (((j >> _SHIFTS) & 15) << 2)
+    position = numpy.zeros(len(lat), dtype=numpy.int64)
+    bits = face & 1
+    for key in keys:
+        bits = _LOOKUP_POS[key | bits]
+        position = (position << 8) | (bits >> 2)
+        bits &= 3
+    ids = (
+        (face.astype(numpy.uint64) << numpy.uint64(61))
+        | (position.astype(numpy.uint64) << numpy.uint64(1))
+        | numpy.uint64(1)
+    )
+    lsb = numpy.uint64(1 << (2 * (s2sphere.CellId.MAX_LEVEL - level)))
+    return (ids & ~(lsb - numpy.uint64(1))) | lsb
@@ -0,0 +1,187 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import array
+import datetime
+import math
+import xml.parsers.expat
+from typing import List, Optional
+
+import gpxpy.geo
+import gpxpy.gpx
+import gpxpy.gpxfield
+
+from .utils import time_to_seconds
+
+# Streaming GPX reader: track points go straight into arrays while the file is
+# read in chunks, and gpxpy's moving time/distance (GPX.get_moving_data) is
+# accumulated on the fly, so the document is never held in memory.
+
+_CHUNK_SIZE = 1 << 16
+
+
+class GpxActivity:
+    def __init__(self):
+        self.base_time = 0
+        self.times = array.array("i")  # seconds relative to base_time
+        self.lats = array.array("i")  # microdegrees
+        self.lngs = array.array("i")  # microdegrees
+        self.altitudes = array.array("f")  # meters, NaN if unknown
+        self.segment_ends = array.array("I")
+        self.start_time: Optional[datetime.datetime] = None
+        self.end_time: Optional[datetime.datetime] = None
+        self.types: List[str] = []
+        self.moving_time = 0.0
+        self.stopped_time = 0.0
+        self.moving_distance = 0.0
+        self.stopped_distance = 0.0
+
+
+class _Reader:
+    def __init__(self, activity: GpxActivity):
+        self._activity = activity
+        self._path: List[str] = []
+        self._text: List[str] = []
+        # like gpxpy, track types are only read from GPX 1.1 files
+        self._read_types = False
+        self._track_type: Optional[str] = None
+        # current point
+        self._lat = 0.0
+        self._lng = 0.0
+        self._elevation: Optional[float] = None
+        self._time: Optional[datetime.datetime] = None
+        self._start_utc: Optional[int] = None
+        # previous point of the current segment
+        self._previous = None
+        # moving data sums per segment and per track, as gpxpy adds them up
+        self._segment_sums = [0.0, 0.0, 0.0, 0.0]
+        self._track_sums = [0.0, 0.0, 0.0, 0.0]
+
+    def start(self, name: str, attributes):
+        name = name.rpartition(":")[2]
+        parent = self._path[-1] if self._path else None
+        self._path.append(name)
+        if parent is None and name == "gpx":
+            self._read_types = attributes.get("version") == "1.1"
+        elif parent == "trk" and name == "trkseg":
+            self._previous = None
+            self._segment_sums = [0.0, 0.0, 0.0, 0.0]
+        elif parent == "trkseg" and name == "trkpt":
+            self._lat = float(attributes["lat"].strip())
+            self._lng = float(attributes["lon"].strip())
+            self._elevation = None
+            self._time = None
+        elif parent == "gpx" and name == "trk":
+            self._track_sums = [0.0, 0.0, 0.0, 0.0]
+            self._track_type = None
+        self._text = []
+
+    def characters(self, data: str):
+        self._text.append(data)
+
+    def end(self, name: str):
+        name = self._path.pop()
+        parent = self._path[-1] if self._path else None
+        if parent == "trkpt":
+            # the first <ele> and <time> count
+            if name == "ele" and self._elevation is None:
+                text = "".join(self._text)
+                self._elevation = float(text.strip()) if text else None
+            elif name == "time" and self._time is None:
+                self._time = gpxpy.gpxfield.parse_time("".join(self._text))
+        elif parent == "trkseg" and name == "trkpt":
+            self._add_point()
+        elif parent == "trk" and name == "trkseg":
+            self._end_segment()
+        elif parent == "trk" and name == "type":
+            if self._read_types and self._track_type is None:
+                self._track_type = "".join(self._text)
+        elif parent == "gpx" and name == "trk":
+            activity = self._activity
+            if self._track_type is not None:
+                activity.types.append(self._track_type)
+            activity.moving_time += self._track_sums[0]
+            activity.stopped_time += self._track_sums[1]
+            activity.moving_distance += self._track_sums[2]
+            activity.stopped_distance += self._track_sums[3]
+        self._text = []
+
+    def _add_point(self):
+        activity = self._activity
+        time = self._time
+        if time is not None:
+            # seconds since the epoch in UTC, like the times of gpxpy's loader
+            seconds = time_to_seconds(time)
+            # microseconds since the epoch, to compare and subtract times cheaply
+            utc = seconds * 1000000 + time.microsecond
+            if self._start_utc is None:
+                activity.start_time = time
+                activity.end_time = time
+                self._start_utc = utc
+            elif utc < self._start_utc:
+                activity.start_time = time
+                self._start_utc = utc
+            elif utc > self._start_utc:
+                activity.end_time = time
+        else:
+            seconds = activity.base_time
+            utc = None
+        if len(activity.times) == 0:
+            activity.base_time = seconds
+        activity.times.append(seconds - activity.base_time)
+        activity.lats.append(int(round(self._lat * 1000000.0)))
+        activity.lngs.append(int(round(self._lng * 1000000.0)))
+        activity.altitudes.append(
+            self._elevation if self._elevation is not None else math.nan
+        )
+
+        previous = self._previous
+        point = (self._lat, self._lng, self._elevation, utc)
+        self._previous = point
+        if previous is None or utc is None or previous[3] is None:
+            return
+        # same as gpxpy's GPXTrackSegment.get_moving_data
+        if point[2] and previous[2]:
+            distance = gpxpy.geo.distance(*point[:3], *previous[:3])
+        else:
+            distance = gpxpy.geo.distance(
+                point[0], point[1], None, previous[0], previous[1], None
+            )
+        seconds = (utc - previous[3]) / 1000000
+        if seconds > 0 and distance:
+            sums = self._segment_sums
+            speed_kmh = (distance / 1000) / (seconds / 60**2)
+            if speed_kmh <= gpxpy.gpx.DEFAULT_STOPPED_SPEED_THRESHOLD:
+                sums[1] += seconds
+                sums[3] += distance
+            else:
+                sums[0] += seconds
+                sums[2] += distance
+
+    def _end_segment(self):
+        for i in range(4):
+            self._track_sums[i] += self._segment_sums[i]
+        activity = self._activity
+        begin = activity.segment_ends[-1] if len(activity.segment_ends) > 0 else 0
+        if len(activity.times) > begin:
+            activity.segment_ends.append(len(activity.times))
+
+
+def read_gpx(file_name: str) -> GpxActivity:
+    activity = GpxActivity()
+    reader = _Reader(activity)
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = reader.start
+    parser.EndElementHandler = reader.end
+    parser.CharacterDataHandler = reader.characters
+    with open(file_name, "rb") as f:
+        while True:
+            chunk = f.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.Parse(chunk, False)
+    parser.Parse(b"", True)
+    return activity
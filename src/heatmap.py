@@ -0,0 +1,359 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import array
+import concurrent.futures
+import json
+import math
+import os
+import shutil
+import sqlite3
+import struct
+import time
+import uuid
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .metrics import metrics
+from .track import Track
+
+# Heatmap tile pyramid of all tracks. Tracks are rasterized at MAX_ZOOM into
+# global pixel coordinates (x << 24 | y); a pixel's count at any zoom is the
+# number of tracks passing through it. The pixels of every track and the
+# sparse counts of every tile are kept in a sqlite database in the cache, so
+# adding or removing a track only touches (and re-renders) the tiles it covers.
+
+MIN_ZOOM = 0
+MAX_ZOOM = 16
+TILE_SIZE = 256
+# tile pyramid id, zoom levels and time of the last change, read by the map
+INFO_FILE = "tiles.json"
+_WORLD_PIXELS = TILE_SIZE << MAX_ZOOM
+_MAX_LAT = 85.0511287798
+# consecutive points further apart (in pixels at MAX_ZOOM) are not connected
+_MAX_STEP = 1024
+# tiles kept in memory while adding/removing tracks before writing them back
+_MAX_CACHED_TILES = 4096
+# counts from here on get the hottest color
+_SATURATION = 32
+_RENDER_BATCH = 64
+
+TileKey = Tuple[int, int, int]  # zoom, x, y
+
+
+def _project(lat: float, lng: float) -> Tuple[int, int]:
+    lat = max(-_MAX_LAT, min(_MAX_LAT, lat))
+    x = (lng + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return (
+        min(_WORLD_PIXELS - 1, max(0, int(x * _WORLD_PIXELS))),
+        min(_WORLD_PIXELS - 1, max(0, int(y * _WORLD_PIXELS))),
+    )
+
+
+def track_pixels(t: Track) -> Set[int]:
+    # pixels at MAX_ZOOM covered by the track's segments
+    pixels = set()
+    lats = t._lats
+    lngs = t._lngs
+    for begin, end in t.segment_ranges():
+        previous: Optional[Tuple[int, int]] = None
+        for i in range(begin, end):
+            x, y = _project(lats[i] / 1000000.0, lngs[i] / 1000000.0)
+            if previous is None:
+                pixels.add(x << 24 | y)
+            else:
+                x0, y0 = previous
+                dx = x - x0
+                dy = y - y0
+                steps = max(abs(dx), abs(dy))
+                if steps > _MAX_STEP:
+                    pixels.add(x << 24 | y)
+                else:
+                    for k in range(1, steps + 1):
+                        pixels.add(
+                            (x0 + (dx * k + steps // 2) // steps) << 24
+                            | (y0 + (dy * k + steps // 2) // steps)
+                        )
+            previous = (x, y)
+    return pixels
+
+
+def _pack_counts(counts: Dict[int, int]) -> bytes:
+    values = array.array("I")
+    for index, count in counts.items():
+        values.append(index)
+        values.append(count)
+    return values.tobytes()
+
+
+def _unpack_counts(data: bytes) -> Dict[int, int]:
+    values = array.array("I")
+    values.frombytes(data)
+    return dict(zip(values[0::2], values[1::2]))
+
+
+def _make_palette() -> List[bytes]:
+    # transparent for 0, then dark red over yellow to white
+    palette = [bytes(4)]
+    for count in range(1, _SATURATION + 1):
+        t = math.log1p(count) / math.log1p(_SATURATION)
+        palette.append(
+            bytes(
+                (
+                    int(160 + 95 * min(1.0, 2 * t)),
+                    int(255 * max(0.0, min(1.0, 2 * t - 0.5))),
+                    int(255 * max(0.0, 4 * t - 3)),
+                    int(128 + 127 * t),
+                )
+            )
+        )
+    return palette
+
+
+_PALETTE = _make_palette()
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data))
+    )
+
+
+def encode_tile(counts: Dict[int, int]) -> bytes:
+    # 256x256 RGBA PNG; `counts` maps (y << 8 | x) to the number of tracks
+    stride = 1 + 4 * TILE_SIZE
+    raw = bytearray(stride * TILE_SIZE)  # filter type 0 for every row
+    for index, count in counts.items():
+        offset = (index >> 8) * stride + 1 + 4 * (index & 0xFF)
+        raw[offset : offset + 4] = _PALETTE[min(count, _SATURATION)]
+    header = struct.pack(">IIBBBBB", TILE_SIZE, TILE_SIZE, 8, 6, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(bytes(raw), 6))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def _tile_file_name(directory: str, tile: TileKey) -> str:
+    zoom, x, y = tile
+    return os.path.join(directory, str(zoom), str(x), f"{y}.png")
+
+
+def _render_tiles(db_file_name: str, directory: str, tiles: List[TileKey]) -> int:
+    db = sqlite3.connect(db_file_name)
+    try:
+        for tile in tiles:
+            row = db.execute(
+                "SELECT counts FROM tiles WHERE zoom = ? AND x = ? AND y = ?", tile
+            ).fetchone()
+            file_name = _tile_file_name(directory, tile)
+            if row is None:
+                if os.path.isfile(file_name):
+                    os.remove(file_name)
+                continue
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            with open(file_name, "wb") as file:
+                file.write(encode_tile(_unpack_counts(row[0])))
+    finally:
+        db.close()
+    return len(tiles)
+
+
+class Heatmap:
+    VERSION = 1
+
+    def __init__(self):
+        self._file_name = None
+        self._db = None
+        self._id = None
+        self._tiles: Dict[TileKey, Dict[int, int]] = {}
+        self._dirty: Set[TileKey] = set()
+
+    def open(self, file_name: str):
+        self._file_name = file_name
+        self._tiles = {}
+        self._dirty = set()
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        self._db = sqlite3.connect(file_name)
+        version = self._get_meta("version")
+        if version != f"{self.VERSION}":
+            with self._db:
+                self._db.execute("DROP TABLE IF EXISTS tracks")
+                self._db.execute("DROP TABLE IF EXISTS tiles")
+                self._db.execute("DROP TABLE IF EXISTS meta")
+                self._db.execute(
+                    "CREATE TABLE tracks (hash TEXT PRIMARY KEY, pixels BLOB NOT NULL)"
+                )
+                self._db.execute(
+                    "CREATE TABLE tiles (zoom INTEGER, x INTEGER, y INTEGER, counts BLOB NOT NULL, PRIMARY KEY (zoom, x, y))"
+                )
+                self._db.execute(
+                    "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+                )
+                self._set_meta("version", f"{self.VERSION}")
+                # identifies the tiles in an export directory as rendered from
+                # this database
+                self._set_meta("id", uuid.uuid4().hex)
+        self._id = self._get_meta("id")
+
+    def close(self):
+        if self._db is not None:
+            self._db.rollback()
+            self._db.close()
+            self._db = None
+        self._tiles = {}
+        self._dirty = set()
+
+    def hashes(self) -> Iterator[str]:
+        return (row[0] for row in self._db.execute("SELECT hash FROM tracks"))
+
+    def has_track(self, track_hash: str) -> bool:
+        row = self._db.execute(
+            "SELECT 1 FROM tracks WHERE hash = ?", (track_hash,)
+        ).fetchone()
+        return row is not None
+
+    def add_track(self, track_hash: str, t: Track):
+        pixels = track_pixels(t)
+        data = array.array("Q", sorted(pixels)).tobytes()
+        self._db.execute(
+            "INSERT OR REPLACE INTO tracks (hash, pixels) VALUES (?, ?)",
+            (track_hash, zlib.compress(data)),
+        )
+        self._update(pixels, 1)
+
+    def remove_track(self, track_hash: str):
+        row = self._db.execute(
+            "SELECT pixels FROM tracks WHERE hash = ?", (track_hash,)
+        ).fetchone()
+        if row is None:
+            return
+        values = array.array("Q")
+        values.frombytes(zlib.decompress(row[0]))
+        self._db.execute("DELETE FROM tracks WHERE hash = ?", (track_hash,))
+        self._update(values, -1)
+
+    def render(self, directory: str, jobs: int = 1) -> int:
+        # writes all tiles changed since open() (or all of them if `directory`
+        # was not rendered from this database) and commits the changes; the
+        # info file, whose "updated" time the map appends to the tile URLs, is
+        # only rewritten if tiles changed
+        self._flush()
+        self._db.commit()
+        info_file_name = os.path.join(directory, INFO_FILE)
+        tiles = self._dirty
+        rerender = self._read_id(info_file_name) != self._id
+        if rerender:
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+            tiles = {
+                (zoom, x, y)
+                for zoom, x, y in self._db.execute("SELECT zoom, x, y FROM tiles")
+            }
+        batches = _batches(sorted(tiles), _RENDER_BATCH)
+        os.makedirs(directory, exist_ok=True)
+        with metrics.stage("heatmap_render"):
+            if jobs > 1 and len(batches) > 1:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+                    futures = [
+                        pool.submit(_render_tiles, self._file_name, directory, batch)
+                        for batch in batches
+                    ]
+                    rendered = sum(future.result() for future in futures)
+            else:
+                rendered = sum(
+                    _render_tiles(self._file_name, directory, batch)
+                    for batch in batches
+                )
+        metrics.count("heatmap_tiles", rendered)
+        if rendered > 0 or rerender:
+            with open(info_file_name, "w") as file:
+                json.dump(
+                    {
+                        "id": self._id,
+                        "updated": int(time.time()),
+                        "min_zoom": MIN_ZOOM,
+                        "max_zoom": MAX_ZOOM,
+                    },
+                    file,
+                )
+        self._dirty = set()
+        return rendered
+
+    def _update(self, pixels: Iterable[int], delta: int):
+        current = set(pixels)
+        for zoom in range(MAX_ZOOM, MIN_ZOOM - 1, -1):
+            if zoom < MAX_ZOOM:
+                current = {(p >> 25) << 24 | (p & 0xFFFFFF) >> 1 for p in current}
+            for pixel in current:
+                x = pixel >> 24
+                y = pixel & 0xFFFFFF
+                counts = self._get_tile((zoom, x >> 8, y >> 8))
+                index = (y & 0xFF) << 8 | (x & 0xFF)
+                count = counts.get(index, 0) + delta
+                if count > 0:
+                    counts[index] = count
+                else:
+                    counts.pop(index, None)
+        if len(self._tiles) > _MAX_CACHED_TILES:
+            self._flush()
+
+    def _get_tile(self, tile: TileKey) -> Dict[int, int]:
+        counts = self._tiles.get(tile)
+        if counts is None:
+            row = self._db.execute(
+                "SELECT counts FROM tiles WHERE zoom = ? AND x = ? AND y = ?", tile
+            ).fetchone()
+            counts = _unpack_counts(row[0]) if row is not None else {}
+            self._tiles[tile] = counts
+            self._dirty.add(tile)
+        return counts
+
+    def _flush(self):
+        for tile, counts in self._tiles.items():
+            if counts:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO tiles (zoom, x, y, counts) VALUES (?, ?, ?, ?)",
+                    tile + (_pack_counts(counts),),
+                )
+            else:
+                self._db.execute(
+                    "DELETE FROM tiles WHERE zoom = ? AND x = ? AND y = ?", tile
+                )
+        self._tiles = {}
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        try:
+            row = self._db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key: str, value: str):
+        self._db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    @staticmethod
+    def _read_id(file_name: str) -> Optional[str]:
+        if not os.path.isfile(file_name):
+            return None
+        try:
+            with open(file_name, "r") as file:
+                return json.load(file).get("id")
+        except ValueError:
+            return None
+
+
+def _batches(items: List[TileKey], size: int) -> List[List[TileKey]]:
+    return [items[i : i + size] for i in range(0, len(items), size)]
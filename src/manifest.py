@@ -0,0 +1,256 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class Manifest:
+    # The exported tracks (by hash) with their source, outputs and index
+    # record, kept in a sqlite database next to the export. Records are indexed
+    # by start time, so the activity index is written in order without holding
+    # all records in memory, and exported tracks by the start time of their
+    # fingerprint to find duplicates. Changes are committed by save(). The
+    # database may be used from the thread feeding the worker processes, too.
+    VERSION = 4
+
+    def __init__(self):
+        self._file_name = None
+        self._db = None
+        self._lock = threading.Lock()
+
+    def load(self, file_name: str):
+        # `file_name` is the database; a JSON manifest with the same base name
+        # written by earlier versions is imported
+        self.close()
+        self._file_name = file_name
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        self._db = sqlite3.connect(file_name, check_same_thread=False)
+        if self._get_meta("version") == f"{self.VERSION}":
+            return
+        with self._db:
+            self._db.execute("DROP TABLE IF EXISTS tracks")
+            self._db.execute("DROP TABLE IF EXISTS meta")
+            self._db.execute(
+                "CREATE TABLE tracks (hash TEXT PRIMARY KEY, source TEXT NOT NULL, entry TEXT NOT NULL, record TEXT, start_time TEXT, fingerprint_start INTEGER, duplicate_of TEXT)"
+            )
+            self._db.execute("CREATE INDEX tracks_source ON tracks (source)")
+            self._db.execute(
+                "CREATE INDEX tracks_start_time ON tracks (start_time, hash) WHERE record IS NOT NULL"
+            )
+            self._db.execute(
+                "CREATE INDEX tracks_fingerprint_start ON tracks (fingerprint_start) WHERE fingerprint_start IS NOT NULL"
+            )
+            self._db.execute(
+                "CREATE INDEX tracks_duplicate_of ON tracks (duplicate_of) WHERE duplicate_of IS NOT NULL"
+            )
+            self._db.execute(
+                "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self._set_meta("version", f"{self.VERSION}")
+        self._import_json(f"{os.path.splitext(file_name)[0]}.json")
+
+    def close(self):
+        if self._db is not None:
+            self._db.rollback()
+            self._db.close()
+            self._db = None
+
+    def save(self):
+        with self._lock:
+            self._db.commit()
+
+    def get(self, track_hash: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT entry, record FROM tracks WHERE hash = ?", (track_hash,)
+            ).fetchone()
+        if row is None:
+            return None
+        entry = json.loads(row[0])
+        entry["record"] = json.loads(row[1]) if row[1] is not None else None
+        return entry
+
+    def set(self, track_hash: str, entry: Dict[str, Any]):
+        entry = dict(entry)
+        record = entry.pop("record")
+        fingerprint_start = None
+        if record is not None and entry.get("fingerprint") is not None:
+            fingerprint_start = entry["fingerprint"]["start"]
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO tracks (hash, source, entry, record, start_time, fingerprint_start, duplicate_of) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    track_hash,
+                    entry["source"],
+                    json.dumps(entry, sort_keys=True),
+                    json.dumps(record, sort_keys=True) if record is not None else None,
+                    record["start_time"] if record is not None else None,
+                    fingerprint_start,
+                    entry.get("duplicate_of"),
+                ),
+            )
+
+    def remove(self, track_hash: str):
+        with self._lock:
+            self._db.execute("DELETE FROM tracks WHERE hash = ?", (track_hash,))
+
+    def find_source(self, file_name: str) -> Optional[str]:
+        # hash of the track exported from `file_name`
+        with self._lock:
+            row = self._db.execute(
+                "SELECT hash FROM tracks WHERE source = ?", (file_name,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        # index records by ascending start time; read in batches, so the
+        # manifest must not be changed meanwhile
+        cursor = self._db.execute(
+            "SELECT record FROM tracks WHERE record IS NOT NULL ORDER BY start_time, hash"
+        )
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                yield json.loads(row[0])
+
+    def get_records(self, track_hashes: Iterable[str]) -> List[Dict[str, Any]]:
+        # index records of the given tracks that are exported, by start time
+        track_hashes = list(track_hashes)
+        records: List[Dict[str, Any]] = []
+        with self._lock:
+            for i in range(0, len(track_hashes), 500):
+                batch = track_hashes[i : i + 500]
+                rows = self._db.execute(
+                    f"SELECT record FROM tracks WHERE record IS NOT NULL AND hash IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                records.extend(json.loads(row[0]) for row in rows)
+        records.sort(key=lambda record: (record["start_time"], record["hash"]))
+        return records
+
+    def exported_hashes(self) -> Iterator[str]:
+        # hashes of tracks with records
+        cursor = self._db.execute("SELECT hash FROM tracks WHERE record IS NOT NULL")
+        return (row[0] for row in cursor)
+
+    def is_exported(self, track_hash: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM tracks WHERE hash = ? AND record IS NOT NULL",
+                (track_hash,),
+            ).fetchone()
+        return row is not None
+
+    def get_candidates(
+        self, first_start: int, last_start: int
+    ) -> List[Tuple[str, Dict[str, Any]]]:
+        # (hash, fingerprint) of exported tracks whose fingerprint starts
+        # within the range
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT hash, entry FROM tracks WHERE fingerprint_start BETWEEN ? AND ?",
+                (first_start, last_start),
+            ).fetchall()
+        return [(row[0], json.loads(row[1])["fingerprint"]) for row in rows]
+
+    def orphaned_duplicates(self) -> List[Tuple[str, str]]:
+        # (hash, source) of duplicates of tracks that are gone
+        with self._lock:
+            return self._db.execute(
+                "SELECT hash, source FROM tracks WHERE duplicate_of IS NOT NULL AND duplicate_of NOT IN (SELECT hash FROM tracks)"
+            ).fetchall()
+
+    def start_scan(self):
+        # tracks not marked as seen until unseen_hashes() are gone
+        with self._lock:
+            self._db.execute("DROP TABLE IF EXISTS temp.seen")
+            self._db.execute("CREATE TEMP TABLE seen (hash TEXT PRIMARY KEY)")
+
+    def mark_seen(self, track_hash: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO temp.seen (hash) VALUES (?)", (track_hash,)
+            )
+
+    def is_seen(self, track_hash: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM temp.seen WHERE hash = ?", (track_hash,)
+            ).fetchone()
+        return row is not None
+
+    def unseen_hashes(self) -> List[str]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT hash FROM tracks WHERE hash NOT IN (SELECT hash FROM temp.seen)"
+            ).fetchall()
+            self._db.execute("DROP TABLE temp.seen")
+        return [row[0] for row in rows]
+
+    def get_index_outputs(self) -> Dict[str, str]:
+        # name -> digest of the index files
+        return json.loads(self._get_meta("index_outputs") or "{}")
+
+    def set_index_outputs(self, outputs: Dict[str, str]):
+        self._set_meta("index_outputs", json.dumps(outputs, sort_keys=True))
+
+    def get_static_outputs(self) -> Dict[str, str]:
+        # name -> digest of index.html and the files it references
+        return json.loads(self._get_meta("static_outputs") or "{}")
+
+    def set_static_outputs(self, outputs: Dict[str, str]):
+        self._set_meta("static_outputs", json.dumps(outputs, sort_keys=True))
+
+    def get_poi_digest(self) -> Optional[str]:
+        # of the POI file the tracks were matched with
+        return self._get_meta("poi_digest")
+
+    def get_poi_entries(self) -> List[Tuple[str, float, float]]:
+        # (name, lat, lng) of the POIs the tracks were matched with
+        return [tuple(entry) for entry in json.loads(self._get_meta("pois") or "[]")]
+
+    def set_pois(self, digest: str, entries: List[Tuple[str, float, float]]):
+        self._set_meta("poi_digest", digest)
+        self._set_meta("pois", json.dumps(entries))
+
+    def _import_json(self, file_name: str):
+        if not os.path.isfile(file_name):
+            return
+        try:
+            with open(file_name, "r") as file:
+                data = json.load(file)
+        except ValueError as e:
+            print(f"Ignoring broken manifest {file_name}: {e}")
+            data = {}
+        if data.get("version") == 3:
+            print(f"importing manifest: {file_name}")
+            for track_hash, entry in data["tracks"].items():
+                self.set(track_hash, entry)
+            self.set_index_outputs(data.get("index_outputs", {}))
+            self.set_static_outputs(data.get("static_outputs", {}))
+            self.save()
+        os.remove(file_name)
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT value FROM meta WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key: str, value: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+            )
@@ -0,0 +1,122 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import contextlib
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+# Build instrumentation: time spent per stage, counters and time spent loading
+# every track. Stages may nest (e.g. "hash" runs within "discover"). Worker
+# processes collect their own numbers, which are merged into the main process'
+# instance via take() and merge(). Only the times of the slowest tracks are
+# kept, so memory use does not grow with the number of tracks.
+
+# tracks kept; pruned when twice as many were timed
+_KEPT_TRACKS = 1000
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, List[float]] = {}  # name -> [seconds, calls]
+        self._counters: Dict[str, int] = {}
+        self._tracks: Dict[str, float] = {}  # file name -> seconds
+        self._track_count = 0
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+            self._tracks = {}
+            self._track_count = 0
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float, calls: int = 1):
+        with self._lock:
+            stage = self._stages.setdefault(name, [0.0, 0])
+            stage[0] += seconds
+            stage[1] += calls
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def add_track_time(self, file_name: str, seconds: float):
+        with self._lock:
+            if file_name not in self._tracks:
+                self._track_count += 1
+            self._tracks[file_name] = self._tracks.get(file_name, 0.0) + seconds
+            if len(self._tracks) > 2 * _KEPT_TRACKS:
+                slowest = sorted(self._tracks.items(), key=lambda t: t[1])
+                self._tracks = dict(slowest[-_KEPT_TRACKS:])
+
+    def take(self) -> Dict[str, Any]:
+        # the raw numbers collected so far; they are reset
+        with self._lock:
+            data = {
+                "stages": self._stages,
+                "counters": self._counters,
+                "tracks": self._tracks,
+            }
+            self._stages = {}
+            self._counters = {}
+            self._tracks = {}
+            self._track_count = 0
+        return data
+
+    def merge(self, data: Dict[str, Any]):
+        for name, (seconds, calls) in data["stages"].items():
+            self.add_time(name, seconds, calls)
+        for name, value in data["counters"].items():
+            self.count(name, value)
+        for file_name, seconds in data["tracks"].items():
+            self.add_track_time(file_name, seconds)
+
+    def slowest_tracks(self, count: int = 10) -> List[Tuple[str, float]]:
+        with self._lock:
+            tracks = sorted(self._tracks.items(), key=lambda t: t[1], reverse=True)
+        return tracks[:count]
+
+    def summary(self, slowest: int = 10) -> Dict[str, Any]:
+        with self._lock:
+            stages = {
+                name: {"seconds": round(seconds, 6), "calls": calls}
+                for name, (seconds, calls) in sorted(self._stages.items())
+            }
+            counters = dict(sorted(self._counters.items()))
+            track_count = self._track_count
+        return {
+            "stages": stages,
+            "counters": counters,
+            "tracks": track_count,
+            "slowest_tracks": [
+                {"file": file_name, "seconds": round(seconds, 6)}
+                for file_name, seconds in self.slowest_tracks(slowest)
+            ],
+        }
+
+    def print_report(self, slowest: int = 10):
+        summary = self.summary(slowest)
+        print("stages:")
+        for name, stage in summary["stages"].items():
+            print(f"  {name:<16} {stage['seconds']:10.3f}s {stage['calls']:>8} calls")
+        print("counters:")
+        for name, value in summary["counters"].items():
+            print(f"  {name:<16} {value:>12}")
+        if summary["slowest_tracks"]:
+            print(f"slowest tracks (of {summary['tracks']}):")
+            for track in summary["slowest_tracks"]:
+                print(f"  {track['seconds']:10.3f}s {track['file']}")
+
+
+metrics = Metrics()
@@ -3,61 +3,195 @@
 # Use of this source code is governed by a MIT-style
 # license that can be found in the LICENSE file.
 
+import collections
+import itertools
+import math
 import s2sphere
-from typing import List, Optional
+from typing import Dict, List, Optional, Sequence, Set, Tuple
 
+from .coverage import Coverage
 from .track import Track
-from .utils import distance
+from . import geometry
+from .metrics import metrics
+from .utils import EARTH_RADIUS, compute_digest, distance
+
+# Grid cells are 0.001 degrees (about 111 m of latitude), larger than the matching
+# distance; along the longitude axis neighboring columns are added depending on
+# the latitude.
+MATCH_DISTANCE = 100
+_CELL_DEGREES = 0.001
+_GRID_COLUMNS = 360000
+_MATCH_DEGREES = math.degrees(MATCH_DISTANCE / EARTH_RADIUS)
 
 
 class Pois:
     def __init__(self):
         self._pois = []
+        self._digest = ""
+        self._grid: Dict[Tuple[int, int], List[int]] = {}
+        self._coordinates: Dict[str, s2sphere.LatLng] = {}
 
     def set_poi_file(self, file_name: str):
         self._pois = []
-        with open(file_name) as f:
-            for line in f:
-                line = line.strip()
-                split_line = line.split(";")
-                if len(split_line) != 3:
-                    continue
-                self._pois.append(
-                    (
-                        split_line[2],
-                        s2sphere.LatLng.from_degrees(
-                            float(split_line[0]), float(split_line[1])
-                        ),
+        self._grid = {}
+        self._coordinates = {}
+        with open(file_name, "rb") as f:
+            data = f.read()
+        self._digest = compute_digest(data)
+        for line in data.decode("utf-8").splitlines():
+            line = line.strip()
+            split_line = line.split(";")
+            if len(split_line) != 3:
+                continue
+            name = split_line[2]
+            lat = float(split_line[0])
+            lng = float(split_line[1])
+            lat_lng = s2sphere.LatLng.from_degrees(lat, lng)
+            self._grid.setdefault(_cell(lat, lng), []).append(len(self._pois))
+            self._coordinates.setdefault(name, lat_lng)
+            self._pois.append((name, lat_lng))
+
+    def get_digest(self) -> str:
+        return self._digest
+
+    def get_entries(self) -> List[Tuple[str, float, float]]:
+        # (name, lat, lng) of all POIs in the order of the file
+        return [
+            (name, lat_lng.lat().degrees, lat_lng.lng().degrees)
+            for name, lat_lng in self._pois
+        ]
+
+    def get_affected(
+        self, previous: Sequence[Tuple[str, float, float]], coverage: Coverage
+    ) -> Set[str]:
+        # hashes of the tracks in `coverage` whose POIs may differ from those
+        # matched with the `previous` entries: tracks near added or removed
+        # POIs, and near all POIs of names whose coordinates changed
+        current = self.get_entries()
+        changed = (collections.Counter(previous) - collections.Counter(current)) + (
+            collections.Counter(current) - collections.Counter(previous)
+        )
+        previous_coordinates = _first_coordinates(previous)
+        current_coordinates = _first_coordinates(current)
+        moved = {
+            name
+            for name in set(previous_coordinates) | set(current_coordinates)
+            if previous_coordinates.get(name) != current_coordinates.get(name)
+        }
+        positions = {
+            (lat, lng)
+            for name, lat, lng in itertools.chain(previous, current)
+            if name in moved or (name, lat, lng) in changed
+        }
+        affected = set()
+        with metrics.stage("poi"):
+            for lat, lng in positions:
+                affected.update(
+                    coverage.query_cap(
+                        s2sphere.LatLng.from_degrees(lat, lng), MATCH_DISTANCE
                     )
                 )
+        return affected
 
     def get_pois(self, track: Track) -> List[str]:
-        if track._bbox is None:
-            return []
-        candidates = []
-        for poi in self._pois:
-            latlng = poi[1]
-            if track._bbox.contains(latlng):
-                candidates.append(poi)
-        if len(candidates) == 0:
+        if track._bbox is None or len(self._grid) == 0:
             return []
+        with metrics.stage("poi"):
+            if geometry.numpy is not None:
+                return self._get_pois_vectorized(track)
+            return self._get_pois_grid(track)
+
+    def _get_pois_grid(self, track: Track) -> List[str]:
         pois = []
-        for segment in track._segments:
-            for point in segment:
-                new_candidates = []
-                for poi in candidates:
-                    if distance(poi[1], point._lat_lng) <= 100:
-                        pois.append(poi[0])
-                    else:
-                        new_candidates.append(poi)
-                if len(new_candidates) < len(candidates):
-                    candidates = new_candidates
-                    if len(candidates) == 0:
-                        return pois
+        matched = set()
+        last_cell = None
+        nearby: List[int] = []
+        for index in range(track.point_count()):
+            lat = track._lats[index] / 1000000.0
+            lng = track._lngs[index] / 1000000.0
+            cell = _cell(lat, lng)
+            if cell != last_cell:
+                last_cell = cell
+                nearby = self._get_nearby(cell)
+            candidates = [i for i in nearby if i not in matched]
+            if len(candidates) == 0:
+                continue
+            lat_lng = track.get_lat_lng(index)
+            for i in candidates:
+                poi = self._pois[i]
+                if distance(poi[1], lat_lng) <= MATCH_DISTANCE and track._bbox.contains(
+                    poi[1]
+                ):
+                    matched.add(i)
+                    pois.append(poi[0])
         return pois
 
+    def _get_pois_vectorized(self, track: Track) -> List[str]:
+        numpy = geometry.numpy
+        lats = numpy.frombuffer(track._lats, dtype=numpy.int32)
+        lngs = numpy.frombuffer(track._lngs, dtype=numpy.int32)
+        rows = numpy.floor((lats / 1000000.0) / _CELL_DEGREES).astype(numpy.int64)
+        columns = numpy.floor((lngs / 1000000.0) / _CELL_DEGREES).astype(numpy.int64)
+        cells = numpy.unique(numpy.stack([rows, columns], axis=1), axis=0)
+        candidates = set()
+        for row, column in cells.tolist():
+            candidates.update(self._get_nearby((row, _wrap_column(column))))
+
+        # (index of the first matching track point, POI index) of all matched POIs
+        matches = []
+        window = int(math.ceil(_MATCH_DEGREES * 1000000.0)) + 1
+        for i in sorted(candidates):
+            poi = self._pois[i]
+            if not track._bbox.contains(poi[1]):
+                continue
+            near = numpy.flatnonzero(
+                numpy.abs(lats - int(round(poi[1].lat().degrees * 1000000.0))) <= window
+            )
+            if len(near) == 0:
+                continue
+            hits = numpy.flatnonzero(
+                numpy.asarray(geometry.distances_to(lats[near], lngs[near], poi[1]))
+                <= MATCH_DISTANCE
+            )
+            if len(hits) > 0:
+                matches.append((int(near[hits[0]]), i))
+        matches.sort()
+        return [self._pois[i][0] for _, i in matches]
+
     def get_coordinates(self, name: str) -> Optional[s2sphere.LatLng]:
-        for poi in self._pois:
-            if poi[0] == name:
-                return poi[1]
-        return None
+        return self._coordinates.get(name)
+
+    def _get_nearby(self, cell: Tuple[int, int]) -> List[int]:
+        # all POIs in cells that may contain points within MATCH_DISTANCE of a
+        # point in `cell`, ordered like the POI file
+        row, column = cell
+        max_lat = min(90.0, max(abs(row - 1), abs(row + 2)) * _CELL_DEGREES)
+        lng_radius = _MATCH_DEGREES / max(math.cos(math.radians(max_lat)), 1e-6)
+        columns = min(_GRID_COLUMNS // 2, int(math.ceil(lng_radius / _CELL_DEGREES)))
+        nearby = []
+        for r in range(row - 1, row + 2):
+            for c in range(column - columns, column + columns + 1):
+                nearby.extend(self._grid.get((r, _wrap_column(c)), []))
+        nearby.sort()
+        return nearby
+
+
+def _wrap_column(column: int) -> int:
+    return (column + _GRID_COLUMNS // 2) % _GRID_COLUMNS - _GRID_COLUMNS // 2
+
+
+def _cell(lat: float, lng: float) -> Tuple[int, int]:
+    return (
+        int(math.floor(lat / _CELL_DEGREES)),
+        _wrap_column(int(math.floor(lng / _CELL_DEGREES))),
+    )
+
+
+def _first_coordinates(
+    entries: Sequence[Tuple[str, float, float]],
+) -> Dict[str, Tuple[float, float]]:
+    # like Pois.get_coordinates, the first POI of a name counts
+    coordinates: Dict[str, Tuple[float, float]] = {}
+    for name, lat, lng in entries:
+        coordinates.setdefault(name, (lat, lng))
+    return coordinates
@@ -0,0 +1,33 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+from typing import Iterable, List, Sequence
+
+
+def encode(lats: Sequence[int], lngs: Sequence[int], indices: Iterable[int]) -> str:
+    # Google's encoded polyline algorithm (precision 5) for microdegree coordinates
+    chunks: List[str] = []
+    last_lat = 0
+    last_lng = 0
+    for index in indices:
+        lat = _round_e5(lats[index])
+        lng = _round_e5(lngs[index])
+        _encode_value(lat - last_lat, chunks)
+        _encode_value(lng - last_lng, chunks)
+        last_lat = lat
+        last_lng = lng
+    return "".join(chunks)
+
+
+def _round_e5(microdegrees: int) -> int:
+    return (microdegrees + 5) // 10
+
+
+def _encode_value(value: int, chunks: List[str]):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
@@ -0,0 +1,126 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import array
+import math
+from typing import Iterable, List, Tuple
+
+from .utils import EARTH_RADIUS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # type: ignore
+
+# Zoom levels for which simplified polylines are exported; the full
+# resolution polyline is used beyond the finest level.
+LEVELS_OF_DETAIL = [8, 11, 14]
+
+_METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180.0
+
+
+def tolerance_for_zoom(zoom: int, lat: float) -> float:
+    # size of a single web mercator pixel in meters
+    return 156543.03 * math.cos(math.radians(lat)) / (2**zoom)
+
+
+def simplify(
+    lats: array.array,
+    lngs: array.array,
+    ranges: Iterable[Tuple[int, int]],
+    tolerance: float,
+) -> List[int]:
+    # Douglas-Peucker on each range; returns the indices of the points to keep
+    if len(lats) == 0:
+        return []
+    lng_scale = math.cos(math.radians(lats[0] / 1000000.0))
+    if numpy is not None:
+        ys = numpy.frombuffer(lats, dtype=numpy.int32) * (_METERS_PER_DEGREE * 1e-6)
+        xs = numpy.frombuffer(lngs, dtype=numpy.int32) * (
+            _METERS_PER_DEGREE * 1e-6 * lng_scale
+        )
+        return _simplify_numpy(xs, ys, ranges, tolerance).tolist()
+
+    ys = [lat * (_METERS_PER_DEGREE * 1e-6) for lat in lats]
+    xs = [lng * (_METERS_PER_DEGREE * 1e-6 * lng_scale) for lng in lngs]
+    indices = []
+    for begin, end in ranges:
+        indices.extend(_simplify_python(xs, ys, begin, end, tolerance))
+    return indices
+
+
+def _simplify_numpy(xs, ys, ranges: Iterable[Tuple[int, int]], tolerance: float):
+    # Breadth-first Douglas-Peucker: each round splits all open intervals of all
+    # ranges at their farthest point at once, which yields the same points as
+    # the recursive formulation.
+    keep = numpy.zeros(len(xs), dtype=bool)
+    in_range = numpy.zeros(len(xs), dtype=bool)
+    for begin, end in ranges:
+        if end > begin:
+            keep[begin] = keep[end - 1] = True
+            in_range[begin:end] = True
+    tolerance2 = tolerance * tolerance
+    while True:
+        kept = numpy.flatnonzero(keep)
+        interval = numpy.cumsum(keep) - 1
+        first = kept[interval]
+        last = kept[numpy.minimum(interval + 1, len(kept) - 1)]
+        dx = xs[last] - xs[first]
+        dy = ys[last] - ys[first]
+        px = xs - xs[first]
+        py = ys - ys[first]
+        length2 = dx * dx + dy * dy
+        t = numpy.clip(
+            (px * dx + py * dy) / numpy.where(length2 > 0, length2, 1.0), 0.0, 1.0
+        )
+        px -= t * dx
+        py -= t * dy
+        distances2 = numpy.where(in_range, px * px + py * py, 0.0)
+        maxima = numpy.maximum.reduceat(distances2, kept)
+        candidates = numpy.flatnonzero(
+            (distances2 == maxima[interval]) & (distances2 > tolerance2)
+        )
+        if len(candidates) == 0:
+            return kept
+        candidate_intervals = interval[candidates]
+        is_first = numpy.ones(len(candidates), dtype=bool)
+        is_first[1:] = candidate_intervals[1:] != candidate_intervals[:-1]
+        keep[candidates[is_first]] = True
+
+
+def _simplify_python(
+    xs: List[float], ys: List[float], begin: int, end: int, tolerance: float
+) -> List[int]:
+    if end <= begin:
+        return []
+    keep = {begin, end - 1}
+    tolerance2 = tolerance * tolerance
+    stack = [(begin, end - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        x0, y0 = xs[first], ys[first]
+        dx = xs[last] - x0
+        dy = ys[last] - y0
+        length2 = dx * dx + dy * dy
+        max_distance2 = -1.0
+        max_index = first
+        for index in range(first + 1, last):
+            px = xs[index] - x0
+            py = ys[index] - y0
+            if length2 > 0:
+                t = min(1.0, max(0.0, (px * dx + py * dy) / length2))
+                px -= t * dx
+                py -= t * dy
+            distance2 = px * px + py * py
+            if distance2 > max_distance2:
+                max_distance2 = distance2
+                max_index = index
+        if max_distance2 > tolerance2:
+            keep.add(max_index)
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+    return sorted(keep)
@@ -0,0 +1,126 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import os
+import sqlite3
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+from . import utils
+from .metrics import metrics
+
+
+class Sources:
+    # Persistent map of source file path -> (size, mtime_ns, hash), so files
+    # that did not change since the last run are identified by a stat call
+    # instead of reading them. Kept in a sqlite database, which may be used
+    # from the thread feeding the worker processes, too.
+    VERSION = 2
+
+    def __init__(self):
+        self._file_name = None
+        self._full_hash = False
+        self._db = None
+        self._lock = threading.Lock()
+
+    def set_full_hash(self, full_hash: bool):
+        # hash complete files instead of their first 1 KB
+        self._full_hash = full_hash
+
+    def load(self, file_name: str):
+        self.close()
+        self._file_name = file_name
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        self._db = sqlite3.connect(file_name, check_same_thread=False)
+        with self._db:
+            if self._get_meta("version") != f"{self.VERSION}":
+                self._db.execute("DROP TABLE IF EXISTS files")
+                self._db.execute("DROP TABLE IF EXISTS meta")
+                self._db.execute(
+                    "CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash TEXT NOT NULL)"
+                )
+                self._db.execute(
+                    "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+                )
+                self._set_meta("version", f"{self.VERSION}")
+            if self._get_meta("full_hash") != f"{self._full_hash}":
+                # all hashes change
+                self._db.execute("DELETE FROM files")
+                self._set_meta("full_hash", f"{self._full_hash}")
+        self._db.execute("DROP TABLE IF EXISTS temp.seen")
+        self._db.execute("CREATE TEMP TABLE seen (path TEXT PRIMARY KEY)")
+        # written by earlier versions
+        legacy_file_name = os.path.join(os.path.dirname(file_name), "sources.json")
+        if os.path.isfile(legacy_file_name):
+            os.remove(legacy_file_name)
+
+    def close(self):
+        if self._db is not None:
+            self._db.rollback()
+            self._db.close()
+            self._db = None
+
+    def save(self):
+        if self._db is None:
+            return
+        with self._lock:
+            self._db.commit()
+
+    def scan(self, directory: str, extensions: List[str]) -> Iterator[Tuple[str, str]]:
+        # (file name, hash) of all files below `directory`; entries of files
+        # that are gone are dropped
+        prefix = os.path.join(os.path.abspath(directory), "")
+        for entry in utils.scan_files(directory, extensions):
+            yield entry.path, self._get_hash(entry.path, entry.stat())
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM files WHERE substr(path, 1, ?) = ? AND path NOT IN (SELECT path FROM temp.seen)",
+                (len(prefix), prefix),
+            )
+
+    def forget(self, file_name: str):
+        with self._lock:
+            self._db.execute("DELETE FROM files WHERE path = ?", (file_name,))
+
+    def get_hash(self, file_name: str) -> str:
+        return self._get_hash(file_name, os.stat(file_name))
+
+    def _get_hash(self, file_name: str, stat: os.stat_result) -> str:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO temp.seen (path) VALUES (?)", (file_name,)
+            )
+            row = self._db.execute(
+                "SELECT size, mtime_ns, hash FROM files WHERE path = ?", (file_name,)
+            ).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            metrics.count("sources_unchanged")
+            return row[2]
+        metrics.count("sources_hashed")
+        with metrics.stage("hash"):
+            if self._full_hash:
+                file_hash = utils.compute_full_file_hash(file_name)
+            else:
+                file_hash = utils.compute_file_hash(file_name)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)",
+                (file_name, stat.st_size, stat.st_mtime_ns, file_hash),
+            )
+        return file_hash
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        try:
+            row = self._db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key: str, value: str):
+        self._db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
@@ -0,0 +1,169 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import array
+import bisect
+import math
+from typing import Any, Dict, List
+
+from . import geometry
+
+# Derived statistics of a track, computed in one pass over its point arrays
+# (vectorized if numpy is available). Steps between segments are ignored; a
+# step counts as moving if its speed is above STOPPED_SPEED, like gpxpy's
+# default threshold. Splits are the moving times per SPLIT_DISTANCE.
+
+STOPPED_SPEED = 1.0 / 3.6  # m/s
+SPLIT_DISTANCE = 1000.0  # m
+
+
+def compute_stats(
+    times: array.array,
+    lats: array.array,
+    lngs: array.array,
+    altitudes: array.array,
+    segment_ends: array.array,
+) -> Dict[str, Any]:
+    if len(times) < 2:
+        return _result(0.0, 0.0, 0.0, 0.0, 0.0, [])
+    if geometry.numpy is not None:
+        return _compute_vectorized(times, lats, lngs, altitudes, segment_ends)
+    return _compute_python(times, lats, lngs, altitudes, segment_ends)
+
+
+def _result(
+    elevation_gain: float,
+    elevation_loss: float,
+    moving_time: float,
+    moving_distance: float,
+    max_speed: float,
+    splits: List[float],
+) -> Dict[str, Any]:
+    return {
+        "elevation_gain": round(elevation_gain, 1),
+        "elevation_loss": round(elevation_loss, 1),
+        "moving_time": round(moving_time, 1),
+        "max_speed": round(max_speed, 3),
+        "avg_speed": (
+            round(moving_distance / moving_time, 3) if moving_time > 0 else 0.0
+        ),
+        "splits": [round(split, 1) for split in splits],
+    }
+
+
+def _compute_vectorized(
+    times: array.array,
+    lats: array.array,
+    lngs: array.array,
+    altitudes: array.array,
+    segment_ends: array.array,
+) -> Dict[str, Any]:
+    numpy = geometry.numpy
+    count = len(times)
+    ends = numpy.frombuffer(segment_ends, dtype=numpy.uint32).astype(numpy.int64)
+
+    # step i goes from point i to point i + 1
+    distances = numpy.asarray(geometry.step_distances(lats, lngs), dtype=numpy.float64)
+    durations = numpy.diff(numpy.frombuffer(times, dtype=numpy.int32)).astype(
+        numpy.float64
+    )
+    in_segment = numpy.ones(count - 1, dtype=bool)
+    inner_ends = ends[(ends > 0) & (ends < count)]
+    in_segment[inner_ends - 1] = False
+    distances[~in_segment] = 0.0
+    speeds = numpy.divide(
+        distances, durations, out=numpy.zeros_like(distances), where=durations > 0
+    )
+    moving = in_segment & (durations > 0) & (speeds > STOPPED_SPEED)
+    moving_time = float(durations[moving].sum())
+    moving_distance = float(distances[moving].sum())
+    max_speed = float(speeds[moving].max()) if moving.any() else 0.0
+
+    # elevation changes between consecutive known altitudes of a segment
+    altitude_values = numpy.frombuffer(altitudes, dtype=numpy.float32)
+    known = numpy.flatnonzero(numpy.isfinite(altitude_values))
+    changes = numpy.diff(altitude_values[known].astype(numpy.float64))
+    segments = numpy.searchsorted(ends, known, side="right")
+    changes = changes[segments[1:] == segments[:-1]]
+    elevation_gain = float(changes[changes > 0].sum())
+    elevation_loss = abs(float(changes[changes < 0].sum()))
+
+    total_distances = numpy.concatenate(([0.0], numpy.cumsum(distances)))
+    total_times = numpy.concatenate(
+        ([0.0], numpy.cumsum(numpy.where(moving, durations, 0.0)))
+    )
+    marks = SPLIT_DISTANCE * numpy.arange(
+        1, int(total_distances[-1] // SPLIT_DISTANCE) + 1
+    )
+    split_times = numpy.interp(marks, total_distances, total_times)
+    splits = numpy.diff(numpy.concatenate(([0.0], split_times))).tolist()
+
+    return _result(
+        elevation_gain,
+        elevation_loss,
+        moving_time,
+        moving_distance,
+        max_speed,
+        splits,
+    )
+
+
+def _compute_python(
+    times: array.array,
+    lats: array.array,
+    lngs: array.array,
+    altitudes: array.array,
+    segment_ends: array.array,
+) -> Dict[str, Any]:
+    distances = geometry.step_distances(lats, lngs)
+    boundaries = set(segment_ends)
+    moving_time = 0.0
+    moving_distance = 0.0
+    max_speed = 0.0
+    elevation_gain = 0.0
+    elevation_loss = 0.0
+    splits: List[float] = []
+    total_distance = 0.0
+    total_time = 0.0
+    split_start = 0.0
+    previous_altitude = None
+    previous_segment = None
+    for i in range(len(times)):
+        altitude = altitudes[i]
+        if not math.isnan(altitude):
+            segment = bisect.bisect_right(segment_ends, i)
+            if previous_altitude is not None and segment == previous_segment:
+                if altitude > previous_altitude:
+                    elevation_gain += altitude - previous_altitude
+                else:
+                    elevation_loss += previous_altitude - altitude
+            previous_altitude = altitude
+            previous_segment = segment
+        if i == 0 or i in boundaries:
+            continue
+        distance = distances[i - 1]
+        duration = times[i] - times[i - 1]
+        if duration > 0 and distance / duration > STOPPED_SPEED:
+            moving_time += duration
+            moving_distance += distance
+            max_speed = max(max_speed, distance / duration)
+        else:
+            duration = 0
+        # moving time at which each multiple of SPLIT_DISTANCE is passed
+        while total_distance + distance >= SPLIT_DISTANCE * (len(splits) + 1):
+            mark = SPLIT_DISTANCE * (len(splits) + 1)
+            at = total_time + duration * (mark - total_distance) / distance
+            splits.append(at - split_start)
+            split_start = at
+        total_distance += distance
+        total_time += duration
+    return _result(
+        elevation_gain,
+        elevation_loss,
+        moving_time,
+        moving_distance,
+        max_speed,
+        splits,
+    )
@@ -0,0 +1,289 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import concurrent.futures
+import datetime
+import functools
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from vendor.garminexport.garminexport import backup, retryer
+
+from .metrics import metrics
+
+Activity = Tuple[int, datetime.datetime]
+
+# syncs that try to download an activity before the journal gives up on it;
+# otherwise an activity that always fails would keep the journal, and so
+# keep new activities from being listed, forever
+_MAX_SYNC_ATTEMPTS = 3
+
+
+class RateLimiter:
+    # spaces out calls to at most `rate` per second over all threads
+    def __init__(self, rate: Optional[float]):
+        self._interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self._interval <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _RateLimitedClient:
+    # forwards to the wrapped GarminClient, every method call takes a slot
+    def __init__(self, client: Any, limiter: RateLimiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args, **kw):
+            self._limiter.wait()
+            return attribute(*args, **kw)
+
+        return call
+
+
+class Syncer:
+    # Downloads missing activities with a pool of worker threads. The activity
+    # listing and every finished download are appended to a journal file, so an
+    # interrupted sync resumes with the remaining activities without listing
+    # again; the journal is removed once everything is fetched or has failed
+    # in _MAX_SYNC_ATTEMPTS syncs.
+    def __init__(
+        self,
+        client: Any,
+        directory: str,
+        journal_file: str,
+        formats: Optional[List[str]] = None,
+    ):
+        self._directory = directory
+        self._journal_file = journal_file
+        self._formats = formats if formats is not None else ["fit"]
+        self._jobs = 1
+        self._limiter = RateLimiter(None)
+        self._client = client
+        self._retry = retryer.Retryer(
+            delay_strategy=retryer.ExponentialBackoffDelayStrategy(
+                initial_delay=datetime.timedelta(seconds=1)
+            ),
+            stop_strategy=retryer.MaxRetriesStopStrategy(2),
+        )
+        self._journal_lock = threading.Lock()
+        self._not_found_lock = threading.Lock()
+
+    def set_jobs(self, jobs: int):
+        self._jobs = max(1, jobs)
+
+    def set_rate(self, requests_per_second: Optional[float]):
+        self._limiter = RateLimiter(requests_per_second)
+
+    def sync(self, on_download: Optional[Callable[[str], None]] = None) -> List[str]:
+        # returns the names of the downloaded files; `on_download` is called with
+        # the path of every file as soon as it is complete
+        os.makedirs(self._directory, exist_ok=True)
+        client = _RateLimitedClient(self._client, self._limiter)
+        activities, done, failures = self._read_journal()
+        if activities is None:
+            activities = set(self._retry.call(client.list_activities))
+            print(f"{len(activities)} activities")
+            activities = backup.need_backup(activities, self._directory, self._formats)
+            done = set()
+            failures = {}
+            self._start_journal(activities)
+        else:
+            print(f"resuming sync: {len(done)} of {len(activities)} done")
+        pending = [
+            a
+            for a in activities
+            if a[0] not in done and failures.get(a[0], 0) < _MAX_SYNC_ATTEMPTS
+        ]
+        # files may have been fetched before they were journaled
+        missing = backup.need_backup(pending, self._directory, self._formats)
+        missing = sorted(missing, key=lambda activity: activity[1], reverse=True)
+        print(f"missing activities: {len(missing)}")
+
+        file_names: List[str] = []
+        finished = 0
+        failed: List[int] = []
+        fetched_bytes = 0
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as pool:
+            futures = {
+                pool.submit(self._download, client, activity): activity
+                for activity in missing
+            }
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    activity = futures[future]
+                    finished += 1
+                    try:
+                        names = future.result()
+                    except Exception as e:
+                        failed.append(activity[0])
+                        failures[activity[0]] = failures.get(activity[0], 0) + 1
+                        self._journal_append({"failed": activity[0]})
+                        print(f"failed to fetch {activity[0]}: {e}")
+                        continue
+                    self._journal_append({"done": activity[0]})
+                    print(f"fetched: {activity[0]} / {activity[1]}")
+                    file_names.extend(names)
+                    if on_download is not None:
+                        for name in names:
+                            on_download(os.path.join(self._directory, name))
+                    size = sum(
+                        os.path.getsize(os.path.join(self._directory, name))
+                        for name in names
+                    )
+                    fetched_bytes += size
+                    metrics.count("downloads")
+                    metrics.count("bytes_downloaded", size)
+                    if finished % 50 == 0 or finished == len(missing):
+                        self._report(finished, len(missing), fetched_bytes, start)
+            except BaseException:
+                # the queued downloads are not started, the running ones
+                # still finish
+                for future in futures:
+                    future.cancel()
+                raise
+
+        if any(failures[i] < _MAX_SYNC_ATTEMPTS for i in failed):
+            print(f"{len(failed)} activities failed; run --sync again to retry them")
+            return file_names
+        if failed:
+            print(
+                f"{len(failed)} activities failed in {_MAX_SYNC_ATTEMPTS} syncs; "
+                "they are tried again after the next listing"
+            )
+        self._remove_journal()
+        return file_names
+
+    def _download(self, client: Any, activity: Activity) -> List[str]:
+        # downloads next to the directory and moves the complete files into it,
+        # so a scan of the directory (e.g. by a pipelined export) never reads
+        # a partly written file
+        parent = os.path.dirname(os.path.abspath(self._directory))
+        with tempfile.TemporaryDirectory(prefix=".sync-", dir=parent) as staging:
+            backup.download(client, activity, self._retry, staging, self._formats)
+            names = []
+            for name in [backup.export_filename(activity, f) for f in self._formats]:
+                if os.path.isfile(os.path.join(staging, name)):
+                    os.replace(
+                        os.path.join(staging, name), os.path.join(self._directory, name)
+                    )
+                    names.append(name)
+            self._merge_not_found(os.path.join(staging, backup.not_found_file))
+        return names
+
+    def _merge_not_found(self, file_name: str):
+        # formats that do not exist for the activity are not tried again
+        with open(file_name, "r") as f:
+            lines = f.read()
+        with self._not_found_lock:
+            with open(os.path.join(self._directory, backup.not_found_file), "a") as f:
+                f.write(lines)
+
+    @staticmethod
+    def _report(count: int, total: int, fetched_bytes: int, start: float):
+        elapsed = max(time.monotonic() - start, 1e-6)
+        print(
+            f"fetched {count}/{total} activities in {elapsed:.1f}s: "
+            f"{count / elapsed:.2f} activities/s, "
+            f"{fetched_bytes / elapsed / 1024:.1f} KiB/s"
+        )
+
+    def _read_journal(
+        self,
+    ) -> Tuple[Optional[Set[Activity]], Set[int], Dict[int, int]]:
+        # listed activities, downloaded ones and the number of failed syncs
+        if not os.path.isfile(self._journal_file):
+            return None, set(), {}
+        activities = None
+        done = set()
+        failures: Dict[int, int] = {}
+        with open(self._journal_file, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line of an interrupted write
+                    continue
+                if "activities" in entry:
+                    activities = {
+                        (activity_id, datetime.datetime.fromisoformat(start))
+                        for activity_id, start in entry["activities"]
+                    }
+                elif "done" in entry:
+                    done.add(entry["done"])
+                elif "failed" in entry:
+                    failures[entry["failed"]] = failures.get(entry["failed"], 0) + 1
+        return activities, done, failures
+
+    def _start_journal(self, activities: Set[Activity]):
+        os.makedirs(os.path.dirname(self._journal_file), exist_ok=True)
+        listing = [
+            [activity_id, start.isoformat()]
+            for activity_id, start in sorted(activities)
+        ]
+        tmp_file_name = f"{self._journal_file}.tmp"
+        with open(tmp_file_name, "w") as f:
+            f.write(json.dumps({"activities": listing}) + "\n")
+        os.replace(tmp_file_name, self._journal_file)
+
+    def _journal_append(self, entry: Dict[str, int]):
+        with self._journal_lock:
+            with open(self._journal_file, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def _remove_journal(self):
+        if os.path.isfile(self._journal_file):
+            os.remove(self._journal_file)
+
+
+class SyncFeed:
+    # Iterating starts `run(on_download)` in a background thread and yields the
+    # downloaded files while the sync is still running.
+    def __init__(self, run: Callable[[Callable[[str], None]], Any]):
+        self._run = run
+
+    def __iter__(self) -> Iterator[str]:
+        files: queue.Queue = queue.Queue()
+        error: List[BaseException] = []
+
+        def run():
+            try:
+                self._run(files.put)
+            except BaseException as e:
+                error.append(e)
+            finally:
+                files.put(None)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        while True:
+            file_name = files.get()
+            if file_name is None:
+                break
+            yield file_name
+        thread.join()
+        if error:
+            raise error[0]
@@ -5,15 +5,60 @@
 # Use of this source code is governed by a MIT-style
 # license that can be found in the LICENSE file.
 
+import array
 import datetime
 import fitparse
 import gpxpy
+import json
+import math
 import os
 import s2sphere
-from typing import List, Optional
+import struct
+import sys
+from typing import BinaryIO, Iterator, Optional, Tuple
 
+from . import fitreader, geometry, gpxreader, stats
+from .metrics import metrics
 from .trackpoint import TrackPoint
-from .utils import serialize_time, deserialize_time
+from .utils import (
+    serialize_time,
+    deserialize_time,
+    time_to_seconds,
+    seconds_to_time,
+)
+
+# Binary cache layout (little endian):
+#   header: magic, version, flags, size of metadata, #points, #segments, base time
+#   metadata: "key:value" lines (utf-8), zero-padded to a multiple of 4 bytes
+#   uint32[#segments]: exclusive end index of each segment
+#   int32[#points]: time offsets in seconds relative to base time
+#   int32[#points]: latitudes in microdegrees
+#   int32[#points]: longitudes in microdegrees
+#   float32[#points]: altitudes in meters (NaN if unknown)
+# All arrays are 4-byte aligned, so they can be mapped with `array.frombytes`,
+# `memoryview.cast` or `numpy.frombuffer`.
+CACHE_MAGIC = b"TRKC"
+CACHE_VERSION = 4
+_CACHE_HEADER = struct.Struct("<4sHHIIIq")
+
+
+def _padded(size: int) -> int:
+    return (size + 3) & ~3
+
+
+def _read_array(type_code: str, data: bytes, offset: int, count: int) -> array.array:
+    values = array.array(type_code)
+    values.frombytes(data[offset : offset + values.itemsize * count])
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def _write_array(file: BinaryIO, values: array.array):
+    if sys.byteorder != "little":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    file.write(values.tobytes())
 
 
 class Track:
@@ -24,12 +69,19 @@ class Track:
         self._type = None
         self._start_time = None
         self._end_time = None
-        self._points = []
-        self._segments = []
+        self._base_time = 0
+        self._times = array.array("i")
+        self._lats = array.array("i")
+        self._lngs = array.array("i")
+        self._altitudes = array.array("f")
+        self._segment_ends = array.array("I")
         self._distance = None
         self._elapsed_time = None
         self._timer_time = None
         self._location = None
+        self._stats = None
+        self._fingerprint = None
+        self._cells = None
         self._bbox = None
         self._pois = []
 
@@ -40,12 +92,19 @@ class Track:
         self._type = None
         self._start_time = None
         self._end_time = None
-        self._points = []
-        self._segments = []
+        self._base_time = 0
+        self._times = array.array("i")
+        self._lats = array.array("i")
+        self._lngs = array.array("i")
+        self._altitudes = array.array("f")
+        self._segment_ends = array.array("I")
         self._distance = None
         self._elapsed_time = None
         self._timer_time = None
         self._location = None
+        self._stats = None
+        self._fingerprint = None
+        self._cells = None
         self._bbox = None
         self._pois = []
 
@@ -65,30 +124,98 @@ class Track:
         return title
 
     def load(self, file_name: str):
-        self._segments = []
-        if file_name.endswith(".fit"):
-            self._load_fit(file_name)
-        elif file_name.endswith(".gpx"):
-            self._load_gpx(file_name)
-        else:
-            raise Exception(f"Unknown file type: {file_name}")
+        with metrics.stage("parse"):
+            if file_name.endswith(".fit"):
+                self._load_fit(file_name)
+            elif file_name.endswith(".gpx"):
+                self._load_gpx(file_name)
+            else:
+                raise Exception(f"Unknown file type: {file_name}")
+        metrics.count("points_parsed", self.point_count())
+        if self._distance is None and self.point_count() > 0:
+            self._distance = self.get_length()
         self._file_name = file_name
         self._compute_bbox()
+        self._compute_stats()
+
+    def point_count(self) -> int:
+        return len(self._times)
+
+    def segment_ranges(self) -> Iterator[Tuple[int, int]]:
+        begin = 0
+        for end in self._segment_ends:
+            yield begin, end
+            begin = end
+
+    def get_lat_lng(self, index: int) -> s2sphere.LatLng:
+        return s2sphere.LatLng.from_degrees(
+            self._lats[index] / 1000000.0, self._lngs[index] / 1000000.0
+        )
+
+    def get_point(self, index: int) -> TrackPoint:
+        altitude = self._altitudes[index]
+        return TrackPoint(
+            seconds_to_time(self._base_time + self._times[index]),
+            self.get_lat_lng(index),
+            None if math.isnan(altitude) else altitude,
+        )
 
     def get_start_pos(self) -> Optional[s2sphere.LatLng]:
-        for segment in self._segments:
-            for point in segment:
-                return point._lat_lng
-        return None
+        if self.point_count() == 0:
+            return None
+        return self.get_lat_lng(0)
+
+    def release_points(self):
+        self._base_time = 0
+        self._times = array.array("i")
+        self._lats = array.array("i")
+        self._lngs = array.array("i")
+        self._altitudes = array.array("f")
+        self._segment_ends = array.array("I")
+
+    def get_length(self) -> float:
+        return geometry.path_length(self._lats, self._lngs, self.segment_ranges())
+
+    def _compute_stats(self):
+        with metrics.stage("stats"):
+            self._stats = stats.compute_stats(
+                self._times,
+                self._lats,
+                self._lngs,
+                self._altitudes,
+                self._segment_ends,
+            )
 
     def _compute_bbox(self):
-        self._bbox = s2sphere.LatLngRect()
-        for segment in self._segments:
-            for point in segment:
-                b = s2sphere.LatLngRect.from_point(point._lat_lng)
-                self._bbox = self._bbox.union(b)
-        if not self._bbox.is_empty():
-            self._bbox = self._bbox.expanded(s2sphere.LatLng.from_degrees(0.01, 0.01))
+        bounds = geometry.bbox(self._lats, self._lngs)
+        if bounds is None:
+            self._bbox = s2sphere.LatLngRect()
+            return
+        self._bbox = s2sphere.LatLngRect.from_point_pair(
+            s2sphere.LatLng.from_degrees(bounds[0], bounds[1]),
+            s2sphere.LatLng.from_degrees(bounds[2], bounds[3]),
+        )
+        self._bbox = self._bbox.expanded(s2sphere.LatLng.from_degrees(0.01, 0.01))
+
+    def _add_point(
+        self,
+        time: Optional[datetime.datetime],
+        lat: float,
+        lng: float,
+        altitude: Optional[float],
+    ):
+        seconds = time_to_seconds(time) if time is not None else self._base_time
+        if self.point_count() == 0:
+            self._base_time = seconds
+        self._times.append(seconds - self._base_time)
+        self._lats.append(int(round(lat * 1000000.0)))
+        self._lngs.append(int(round(lng * 1000000.0)))
+        self._altitudes.append(altitude if altitude is not None else math.nan)
+
+    def _end_segment(self):
+        begin = self._segment_ends[-1] if len(self._segment_ends) > 0 else 0
+        if self.point_count() > begin:
+            self._segment_ends.append(self.point_count())
 
     def _update_time_bounds(self, time: datetime.datetime):
         if self._start_time is None:
@@ -100,9 +227,37 @@ class Track:
             self._end_time = time
 
     def _load_fit(self, file_name: str):
+        try:
+            self._load_fit_fast(file_name)
+        except Exception as e:
+            print(f"Falling back to fitparse for {file_name}: {e}")
+            self._load_fit_fitparse(file_name)
+
+    def _load_fit_fast(self, file_name: str):
+        self.clear()
+        activity = fitreader.read_fit(file_name)
+        if activity.start_time is not None and activity.end_time is not None:
+            self._start_time = seconds_to_time(activity.start_time)
+            self._end_time = seconds_to_time(activity.end_time)
+        if activity.elapsed_time is not None:
+            self._elapsed_time = datetime.timedelta(seconds=activity.elapsed_time)
+        if activity.timer_time is not None:
+            self._timer_time = datetime.timedelta(seconds=activity.timer_time)
+        self._distance = activity.distance
+        for sport, sub_sport in activity.sports:
+            self._set_fit_sport(sport, sub_sport)
+        if len(activity.timestamps) > 0:
+            first = activity.timestamps[0]
+            self._base_time = first + fitreader.UTC_REFERENCE
+            self._times = array.array("i", (t - first for t in activity.timestamps))
+            self._lats = geometry.semicircles_to_microdegrees(activity.lats)
+            self._lngs = geometry.semicircles_to_microdegrees(activity.lngs)
+            self._altitudes = activity.altitudes
+            self._segment_ends = activity.segment_ends
+
+    def _load_fit_fitparse(self, file_name: str):
         self.clear()
         fit = fitparse.FitFile(file_name)
-        segment: List[TrackPoint] = []
         debug = False
         for message in fit.get_messages():
             if debug:
@@ -124,9 +279,7 @@ class Track:
                     event_type = message.get_values()["event_type"]
                     if event == "timer":
                         if (event_type == "stop") or (event_type == "stop_all"):
-                            if len(segment) != 0:
-                                self._segments.append(segment)
-                                segment = []
+                            self._end_segment()
                 elif message.mesg_type.name == "record":
                     time = None
                     lat = None
@@ -144,12 +297,8 @@ class Track:
                     if (time is not None) and (lat is not None) and (lng is not None):
                         lat = 180.0 * (float(lat) / float(0x7FFFFFFF))
                         lng = 180.0 * (float(lng) / float(0x7FFFFFFF))
-                        p = TrackPoint(
-                            time, s2sphere.LatLng.from_degrees(lat, lng), altitude
-                        )
-                        segment.append(p)
-        if len(segment) != 0:
-            self._segments.append(segment)
+                        self._add_point(time, lat, lng, altitude)
+        self._end_segment()
 
     def _parse_fit_session_message(self, message):
         if "total_elapsed_time" in message.get_values():
@@ -166,11 +315,14 @@ class Track:
     def _parse_fit_sport_message(self, message):
         sport = None
         sub_sport = None
-        type = None
         if "sport" in message.get_values():
             sport = message.get_values()["sport"]
         if "sub_sport" in message.get_values():
             sub_sport = message.get_values()["sub_sport"]
+        self._set_fit_sport(sport, sub_sport)
+
+    def _set_fit_sport(self, sport, sub_sport):
+        type = None
         if sport == "generic":
             if (sub_sport == "generic") or (sub_sport is None):
                 pass
@@ -221,6 +373,38 @@ class Track:
             self._type = type
 
     def _load_gpx(self, file_name: str):
+        try:
+            self._load_gpx_streaming(file_name)
+        except Exception as e:
+            print(f"Falling back to gpxpy for {file_name}: {e}")
+            self._load_gpx_gpxpy(file_name)
+
+    def _load_gpx_streaming(self, file_name: str):
+        self.clear()
+        activity = gpxreader.read_gpx(file_name)
+        track_type = None
+        for t in activity.types:
+            if track_type is not None:
+                if t != track_type:
+                    print(
+                        f'{file_name}: tracks with differing types: "{track_type}" and "{t}"'
+                    )
+            else:
+                track_type = t
+        self._type = self._map_track_type(track_type)
+        self._start_time = activity.start_time
+        self._end_time = activity.end_time
+        self._base_time = activity.base_time
+        self._times = activity.times
+        self._lats = activity.lats
+        self._lngs = activity.lngs
+        self._altitudes = activity.altitudes
+        self._segment_ends = activity.segment_ends
+        self._distance = activity.moving_distance
+        self._timer_time = datetime.timedelta(seconds=activity.moving_time)
+        self._elapsed_time = datetime.timedelta(seconds=activity.stopped_time)
+
+    def _load_gpx_gpxpy(self, file_name: str):
         self.clear()
         with open(file_name, "r") as file:
             raw_data = file.read()
@@ -236,18 +420,11 @@ class Track:
                 else:
                     track_type = t.type
             for s in t.segments:
-                segment = []
                 for p in s.points:
-                    self._update_time_bounds(p.time)
-                    segment.append(
-                        TrackPoint(
-                            p.time,
-                            s2sphere.LatLng.from_degrees(p.latitude, p.longitude),
-                            p.elevation,
-                        )
-                    )
-                if len(segment) != 0:
-                    self._segments.append(segment)
+                    if p.time is not None:
+                        self._update_time_bounds(p.time)
+                    self._add_point(p.time, p.latitude, p.longitude, p.elevation)
+                self._end_segment()
         self._type = self._map_track_type(track_type)
         (
             moving_time,
@@ -263,84 +440,167 @@ class Track:
             self._elapsed_time = datetime.timedelta(seconds=stopped_time)
 
     def load_from_cache(self, cache_file_name: str, file_name: str):
+        with metrics.stage("cache_load"):
+            self._load_from_cache(cache_file_name, file_name)
+
+    def _load_from_cache(self, cache_file_name: str, file_name: str):
         self.clear()
-        with open(cache_file_name, "r") as file:
-            segment: List[TrackPoint] = []
-            in_header = True
-            last_point = None
-            for line in file:
-                line = line.strip()
-                if in_header:
-                    if line.startswith("---"):
-                        in_header = False
-                        continue
-                    key_value = line.split(":", 1)
-                    key, value = key_value[0], key_value[1]
-                    if key == "hash":
-                        self._hash = value
-                    elif key == "start":
-                        self._start_time = deserialize_time(value)
-                    elif key == "end":
-                        self._end_time = deserialize_time(value)
-                    elif key == "distance":
-                        self._distance = float(value)
-                    elif key == "elapsed_time":
-                        self._elapsed_time = datetime.timedelta(seconds=float(value))
-                    elif key == "timer_time":
-                        self._timer_time = datetime.timedelta(seconds=float(value))
-                    elif key == "location":
-                        self._location = value
-                    elif key == "type":
-                        self._type = value
-                    elif key == "error":
-                        self._error = value
-                    else:
-                        print(f"unknown header line: {line}")
-                elif line.startswith("---"):
-                    if len(segment) != 0:
-                        self._segments.append(segment)
-                        segment = []
-                else:
-                    last_point = TrackPoint.deserialize(line, last_point)
-                    segment.append(last_point)
-            if len(segment) != 0:
-                self._segments.append(segment)
-        self._file_name = file_name
+        with open(cache_file_name, "rb") as file:
+            data = file.read()
+        if data[: len(CACHE_MAGIC)] == CACHE_MAGIC:
+            self._load_binary_cache(data)
+            self._file_name = file_name
+        else:
+            self._load_text_cache(data.decode("utf-8"))
+            self._file_name = file_name
+            self._compute_stats()
+            self.save_to_cache(cache_file_name)
         self._compute_bbox()
 
+    def _load_binary_cache(self, data: bytes):
+        (
+            magic,
+            version,
+            _,
+            header_size,
+            num_points,
+            num_segments,
+            base_time,
+        ) = _CACHE_HEADER.unpack_from(data, 0)
+        if version != CACHE_VERSION:
+            raise Exception(f"Unsupported cache version: {version}")
+        offset = _CACHE_HEADER.size
+        for line in (
+            bytes(data[offset : offset + header_size]).decode("utf-8").split("\n")
+        ):
+            if line != "":
+                self._parse_cache_header_line(line)
+        offset += _padded(header_size)
+        self._base_time = base_time
+        self._segment_ends = _read_array("I", data, offset, num_segments)
+        offset += 4 * num_segments
+        self._times = _read_array("i", data, offset, num_points)
+        offset += 4 * num_points
+        self._lats = _read_array("i", data, offset, num_points)
+        offset += 4 * num_points
+        self._lngs = _read_array("i", data, offset, num_points)
+        offset += 4 * num_points
+        self._altitudes = _read_array("f", data, offset, num_points)
+
+    def _load_text_cache(self, data: str):
+        in_header = True
+        lat, lng, altitude = 0, 0, None
+        for line in data.splitlines():
+            line = line.strip()
+            if in_header:
+                if line.startswith("---"):
+                    in_header = False
+                    continue
+                self._parse_cache_header_line(line)
+            elif line.startswith("---"):
+                self._end_segment()
+            else:
+                tokens = line.split(",")
+                if (len(tokens) != 3) and (len(tokens) != 4):
+                    raise Exception(f"cannot deserialize track point: {line}")
+                if self.point_count() == 0:
+                    self._base_time = time_to_seconds(deserialize_time(tokens[0]))
+                    time = 0
+                    lat = int(tokens[1])
+                    lng = int(tokens[2])
+                    altitude = float(tokens[3]) if len(tokens) == 4 else None
+                else:
+                    time = self._times[-1] + int(tokens[0])
+                    lat += int(tokens[1])
+                    lng += int(tokens[2])
+                    altitude = (
+                        float(tokens[3]) + altitude
+                        if len(tokens) == 4 and altitude is not None
+                        else None
+                    )
+                self._times.append(time)
+                self._lats.append(lat)
+                self._lngs.append(lng)
+                self._altitudes.append(altitude if altitude is not None else math.nan)
+        self._end_segment()
+
+    def _parse_cache_header_line(self, line: str):
+        key_value = line.split(":", 1)
+        key, value = key_value[0], key_value[1]
+        if key == "hash":
+            self._hash = value
+        elif key == "start":
+            self._start_time = deserialize_time(value)
+        elif key == "end":
+            self._end_time = deserialize_time(value)
+        elif key == "distance":
+            self._distance = float(value)
+        elif key == "elapsed_time":
+            self._elapsed_time = datetime.timedelta(seconds=float(value))
+        elif key == "timer_time":
+            self._timer_time = datetime.timedelta(seconds=float(value))
+        elif key == "location":
+            self._location = value
+        elif key == "type":
+            self._type = value
+        elif key == "error":
+            self._error = value
+        elif key == "stats":
+            self._stats = json.loads(value)
+        else:
+            print(f"unknown header line: {line}")
+
     def save_to_cache(self, cache_file_name: str):
+        with metrics.stage("cache_save"):
+            self._save_to_cache(cache_file_name)
+
+    def _save_to_cache(self, cache_file_name: str):
+        header = [
+            ("hash", self._hash),
+            ("start", serialize_time(self._start_time)),
+            ("end", serialize_time(self._end_time)),
+        ]
+        if self._error is not None:
+            header.append(("error", self._error))
+        if self._distance is not None:
+            header.append(("distance", f"{self._distance:.1f}"))
+        if self._elapsed_time is not None:
+            header.append(("elapsed_time", f"{self._elapsed_time.total_seconds():.1f}"))
+        if self._timer_time is not None:
+            header.append(("timer_time", f"{self._timer_time.total_seconds():.1f}"))
+        if self._location is not None:
+            header.append(("location", self._location))
+        if self._type is not None:
+            header.append(("type", self._type))
+        if self._stats is not None:
+            header.append(("stats", json.dumps(self._stats, separators=(",", ":"))))
+        header_data = "".join(f"{key}:{value}\n" for (key, value) in header).encode(
+            "utf-8"
+        )
+
         os.makedirs(os.path.dirname(cache_file_name), exist_ok=True)
-        with open(cache_file_name, "w") as file:
-            header = [
-                ("hash", self._hash),
-                ("start", serialize_time(self._start_time)),
-                ("end", serialize_time(self._end_time)),
-            ]
-            if self._error is not None:
-                header.append(("error", self._error))
-            if self._distance is not None:
-                header.append(("distance", f"{self._distance:.1f}"))
-            if self._elapsed_time is not None:
-                header.append(
-                    ("elapsed_time", f"{self._elapsed_time.total_seconds():.1f}")
+        with open(cache_file_name, "wb") as file:
+            file.write(
+                _CACHE_HEADER.pack(
+                    CACHE_MAGIC,
+                    CACHE_VERSION,
+                    0,
+                    len(header_data),
+                    self.point_count(),
+                    len(self._segment_ends),
+                    self._base_time,
                 )
-            if self._timer_time is not None:
-                header.append(("timer_time", f"{self._timer_time.total_seconds():.1f}"))
-            if self._location is not None:
-                header.append(("location", self._location))
-            if self._type is not None:
-                header.append(("type", self._type))
-            for (key, value) in header:
-                file.write(f"{key}:{value}\n")
-            file.write("---\n")
-
-            last_point = None
-            for segment in self._segments:
-                for point in segment:
-                    file.write(point.serialize(last_point))
-                    file.write("\n")
-                    last_point = point
-                file.write("---\n")
+            )
+            file.write(header_data)
+            file.write(b"\0" * (_padded(len(header_data)) - len(header_data)))
+            for values in [
+                self._segment_ends,
+                self._times,
+                self._lats,
+                self._lngs,
+                self._altitudes,
+            ]:
+                _write_array(file, values)
 
     @staticmethod
     def _map_track_type(t: Optional[str]) -> Optional[str]:
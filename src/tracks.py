@@ -4,16 +4,53 @@
 # license that can be found in the LICENSE file.
 
 import appdirs
+import bisect
+import concurrent.futures
+import itertools
+import json
 import os
+import queue
+import s2sphere
 import shutil
 import sys
+import threading
+import time
 import traceback
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
+from . import compress
 from .config import __app_name__, __author__
-from .geocoder import Geocoder
+from .coverage import Coverage, track_cells
+from .fingerprint import compute_fingerprint, is_duplicate, start_range
+from .gazetteer import Gazetteer
+from .geocoder import Geocoder, NominatimBackend
+from .heatmap import INFO_FILE, Heatmap
+from .manifest import Manifest
+from .metrics import metrics
 from .pois import Pois
-from .track import Track
-from . import utils
+from .simplify import LEVELS_OF_DETAIL, simplify, tolerance_for_zoom
+from .sources import Sources
+from .track import CACHE_VERSION, Track
+from . import polyline, utils
+
+# tracks per page of the exported index
+INDEX_PAGE_SIZE = 100
+# changes if the files exported per track or their manifest entries change
+EXPORT_VERSION = 2
+# static files referenced by index.html; they are exported with their digest
+# in the name
+STATIC_ASSETS = ["style.css", "map.js"]
 
 
 class Tracks:
@@ -22,8 +59,19 @@ class Tracks:
         self._pois = Pois()
         self._geocoder = Geocoder()
         self._geocoder.set_cache_dir(self._cache_dir)
-        self._tracks = []
+        self._manifest = Manifest()
+        self._sources = Sources()
+        self._coverage = Coverage()
+        # (previous POI digest, hashes of the tracks whose POIs may change)
+        # while loading after the POI file changed
+        self._poi_changes: Optional[Tuple[str, Set[str]]] = None
         self._export_dir = None
+        self._jobs = 1
+        self._compact = False
+        self._heatmap: Optional[Heatmap] = None
+        self._assets_dir = None
+        self._precompress = False
+        self._compress_pending: Set[str] = set()
 
     def set_poi_file(self, file_name: str):
         self._pois.set_poi_file(file_name)
@@ -35,86 +83,631 @@ class Tracks:
     def set_export_dir(self, directory: str):
         self._export_dir = directory
 
+    def set_geocoder_backends(
+        self, gazetteer_file: Optional[str], use_nominatim: bool = True
+    ):
+        backends: List = []
+        if gazetteer_file is not None:
+            gazetteer = Gazetteer()
+            gazetteer.load(gazetteer_file)
+            print(f"gazetteer: {gazetteer.size()} places from {gazetteer_file}")
+            backends.append(gazetteer)
+        if use_nominatim:
+            backends.append(NominatimBackend())
+        self._geocoder.set_backends(backends)
+
+    def set_unknown_location_ttl(self, seconds: Optional[float]):
+        self._geocoder.set_unknown_ttl(seconds)
+
+    def set_jobs(self, jobs: int):
+        self._jobs = max(1, jobs)
+
+    def set_compact_export(self, compact: bool):
+        self._compact = compact
+
+    def set_full_hash(self, full_hash: bool):
+        self._sources.set_full_hash(full_hash)
+
+    def set_heatmap(self, enabled: bool):
+        self._heatmap = Heatmap() if enabled else None
+
+    def set_assets_dir(self, directory: str):
+        self._assets_dir = directory
+
+    def set_precompress(self, enabled: bool):
+        self._precompress = enabled
+
     def clear_cache_dir(self):
         if os.path.isdir(self._cache_dir):
             shutil.rmtree(self._cache_dir)
 
-    def load_tracks(self, directory: str):
+    def load_tracks(self, directory: str, incoming: Optional[Iterable[str]] = None):
+        # Files are streamed from discovery through loading to exporting; the
+        # index is written from the manifest, so memory use does not grow with
+        # the number of tracks. `incoming` yields names of files that are
+        # added to `directory` while loading (e.g. by a running sync); they are
+        # processed as they arrive.
         os.makedirs(os.path.join(self._export_dir, "assets", "tracks"), exist_ok=True)
-        for file_name in utils.collect_files(directory, [".fit", ".gpx"]):
-            print(f"loading: {file_name}")
-            try:
-                t = self.load_track(file_name)
-                if t._start_time is None:
+        os.makedirs(os.path.join(self._export_dir, "assets", "index"), exist_ok=True)
+        self._manifest.load(os.path.join(self._export_dir, ".manifest.sqlite"))
+        self._sources.load(os.path.join(self._cache_dir, "sources.sqlite"))
+        self._coverage.open(os.path.join(self._cache_dir, "coverage.sqlite"))
+        self._poi_changes = self._find_poi_changes()
+        self._manifest.start_scan()
+        pending = self._discover(directory)
+        if incoming is not None:
+            pending = itertools.chain(pending, self._new_files(incoming))
+        if self._jobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self._jobs,
+                initializer=_init_worker,
+                initargs=(self._cache_dir, self._pois),
+            ) as executor:
+                self._export_tracks(
+                    _merge_worker_metrics(
+                        _map_streaming(executor, _load_track_worker, pending)
+                    )
+                )
+        else:
+            self._export_tracks(itertools.starmap(self._try_load_track_data, pending))
+
+        for track_hash in self._manifest.unseen_hashes():
+            self._remove_track(track_hash)
+        self._promote_duplicates()
+
+        self._finish()
+
+    def update_tracks(self, file_names: Iterable[str]):
+        # After load_tracks: re-exports the given added, changed or removed
+        # files and patches the index, without scanning the whole directory.
+        removed = set()
+        pending = []
+        for file_name in sorted({os.path.abspath(f) for f in file_names}):
+            file_hash = None
+            if os.path.isfile(file_name):
+                file_hash = self._sources.get_hash(file_name)
+                if not self._is_up_to_date(file_hash, self._manifest.get(file_hash)):
+                    pending.append((file_name, file_hash))
+            else:
+                self._sources.forget(file_name)
+            previous_hash = self._manifest.find_source(file_name)
+            if previous_hash is not None and previous_hash != file_hash:
+                removed.add(previous_hash)
+        for track_hash in removed:
+            self._remove_track(track_hash)
+        self._export_tracks(itertools.starmap(self._try_load_track_data, pending))
+        self._promote_duplicates()
+        self._finish()
+        print(f"updated: {len(pending)} exported, {len(removed)} removed")
+
+    def query_bbox(
+        self, lat1: float, lng1: float, lat2: float, lng2: float
+    ) -> List[Dict[str, Any]]:
+        # index records of the exported tracks passing through the rectangle
+        # between the two corners, by start time
+        self._open_index()
+        return self._manifest.get_records(
+            self._coverage.query_rect(lat1, lng1, lat2, lng2)
+        )
+
+    def query_radius(
+        self, lat: float, lng: float, meters: float
+    ) -> List[Dict[str, Any]]:
+        # index records of the exported tracks passing within `meters` of the
+        # position, by start time
+        self._open_index()
+        return self._manifest.get_records(
+            self._coverage.query_cap(s2sphere.LatLng.from_degrees(lat, lng), meters)
+        )
+
+    def _open_index(self):
+        self._manifest.load(os.path.join(self._export_dir, ".manifest.sqlite"))
+        self._coverage.open(os.path.join(self._cache_dir, "coverage.sqlite"))
+
+    def _finish(self):
+        if self._heatmap is not None:
+            with metrics.stage("heatmap"):
+                self._update_heatmap()
+        else:
+            self._remove_heatmap()
+        with metrics.stage("coverage"):
+            self._update_coverage()
+
+        with metrics.stage("index"):
+            self._write_index()
+            if self._assets_dir is not None:
+                self._write_static_assets()
+        if self._compress_pending:
+            compress.compress_files(sorted(self._compress_pending), self._jobs)
+            self._compress_pending = set()
+        if self._manifest.get_poi_digest() != self._pois.get_digest():
+            self._manifest.set_pois(self._pois.get_digest(), self._pois.get_entries())
+        self._poi_changes = None
+        self._coverage.save()
+        self._manifest.save()
+        self._sources.save()
+
+    def _discover(self, directory: str) -> Iterator[Tuple[str, str]]:
+        # files below `directory` that need to be exported
+        seconds = 0.0
+        start = time.perf_counter()
+        for file_name, file_hash in self._sources.scan(directory, [".fit", ".gpx"]):
+            self._manifest.mark_seen(file_hash)
+            if self._is_up_to_date(file_hash, self._manifest.get(file_hash)):
+                metrics.count("tracks_up_to_date")
+                continue
+            seconds += time.perf_counter() - start
+            yield file_name, file_hash
+            start = time.perf_counter()
+        metrics.add_time("discover", seconds + time.perf_counter() - start)
+
+    def _new_files(self, file_names: Iterable[str]) -> Iterator[Tuple[str, str]]:
+        for file_name in file_names:
+            # scanned files have absolute names, which are part of the hash
+            file_name = os.path.abspath(file_name)
+            file_hash = self._sources.get_hash(file_name)
+            # already found by the scan; the syncer moves downloads into the
+            # directory when they are complete, so the scan read the whole file
+            if self._manifest.is_seen(file_hash):
+                continue
+            self._manifest.mark_seen(file_hash)
+            if self._is_up_to_date(file_hash, self._manifest.get(file_hash)):
+                continue
+            yield file_name, file_hash
+
+    def _is_up_to_date(self, track_hash: str, entry: Optional[Dict[str, Any]]) -> bool:
+        if (
+            entry is None
+            or entry["cache_version"] != CACHE_VERSION
+            or entry["compact"] != self._compact
+            or entry.get("export_version") != EXPORT_VERSION
+            or (self._precompress and not entry.get("precompressed", False))
+        ):
+            return False
+        return entry["poi_digest"] == self._pois.get_digest() or self._keep_pois(
+            track_hash, entry
+        )
+
+    def _find_poi_changes(self) -> Optional[Tuple[str, Set[str]]]:
+        previous_digest = self._manifest.get_poi_digest()
+        if previous_digest is None or previous_digest == self._pois.get_digest():
+            return None
+        affected = self._pois.get_affected(
+            self._manifest.get_poi_entries(), self._coverage
+        )
+        print(f"POIs changed: {len(affected)} tracks may be affected")
+        return previous_digest, affected
+
+    def _keep_pois(self, track_hash: str, entry: Dict[str, Any]) -> bool:
+        # after the POI file changed, tracks that are not near added, removed
+        # or moved POIs keep their matches and are not exported again
+        if self._poi_changes is None:
+            return False
+        previous_digest, affected = self._poi_changes
+        if entry["poi_digest"] != previous_digest or track_hash in affected:
+            return False
+        if entry["record"] is not None and not self._coverage.has_track(track_hash):
+            return False
+        self._manifest.set(track_hash, dict(entry, poi_digest=self._pois.get_digest()))
+        metrics.count("poi_matches_kept")
+        return True
+
+    def _remove_track(self, track_hash: str):
+        entry = self._manifest.get(track_hash)
+        if entry is not None:
+            print(f"removing: {entry['source']}")
+            for name in entry["outputs"]:
+                self._remove_output(name)
+        self._manifest.remove(track_hash)
+
+    def _find_duplicate(self, t: Track) -> Optional[str]:
+        # hash of the exported track that `t` duplicates, if `t` is not the
+        # preferred source; otherwise the duplicate is demoted
+        if t._fingerprint is None:
+            return None
+        for other_hash, fingerprint in self._manifest.get_candidates(
+            *start_range(t._fingerprint)
+        ):
+            if other_hash != t._hash and is_duplicate(t._fingerprint, fingerprint):
+                break
+        else:
+            return None
+        other = self._manifest.get(other_hash)
+        if _source_rank(other["source"]) <= _source_rank(t._file_name):
+            return other_hash
+        print(f"duplicate: {other['source']} (of {t._file_name})")
+        metrics.count("duplicates")
+        for name in other["outputs"]:
+            self._remove_output(name)
+        self._manifest.set(
+            other_hash,
+            dict(other, outputs={}, record=None, duplicate_of=t._hash),
+        )
+        return None
+
+    def _promote_duplicates(self):
+        # re-exports duplicates of removed tracks
+        pending = []
+        for track_hash, file_name in self._manifest.orphaned_duplicates():
+            if os.path.isfile(file_name):
+                pending.append((file_name, track_hash))
+            else:
+                self._manifest.remove(track_hash)
+        self._export_tracks(
+            self._try_load_track_data(file_name, file_hash)
+            for file_name, file_hash in sorted(pending)
+        )
+
+    def _update_heatmap(self):
+        # brings the heatmap in line with the exported tracks; tracks are read
+        # back from the track cache
+        heatmap = self._heatmap
+        heatmap.open(os.path.join(self._cache_dir, "heatmap.sqlite"))
+        try:
+            removed = [
+                track_hash
+                for track_hash in heatmap.hashes()
+                if not self._manifest.is_exported(track_hash)
+            ]
+            for track_hash in removed:
+                heatmap.remove_track(track_hash)
+            added = 0
+            for track_hash in self._manifest.exported_hashes():
+                if heatmap.has_track(track_hash):
+                    continue
+                file_name = self._manifest.get(track_hash)["source"]
+                t = Track()
+                try:
+                    t.load_from_cache(
+                        os.path.join(self._cache_dir, "tracks", track_hash), file_name
+                    )
+                except Exception as e:
+                    print(f"Error while adding {file_name} to the heatmap: {e}")
                     continue
-                with open(
-                    os.path.join(
-                        self._export_dir, "assets", "tracks", f"{t._hash}.json"
-                    ),
-                    "w",
-                ) as file:
-                    file.write('{"polyline":  [')
-                    first = True
-                    for segment in t._segments:
-                        for point in segment:
-                            if not first:
-                                file.write(",")
-                            else:
-                                first = False
-                            file.write(
-                                f"\n[{point._lat_lng.lat().degrees:.5f},{point._lat_lng.lng().degrees:.5f}]"
-                            )
-                    file.write("\n]}\n")
-                    t._segments = None
-                self._tracks.append(t)
+                heatmap.add_track(track_hash, t)
+                added += 1
+            directory = os.path.join(self._export_dir, "assets", "heatmap")
+            rendered = heatmap.render(directory, self._jobs)
+            info_file_name = os.path.join(directory, INFO_FILE)
+            if not self._precompress:
+                compress.remove_siblings(info_file_name)
+            elif rendered > 0 or not compress.has_siblings(info_file_name):
+                self._compress_pending.add(info_file_name)
+            print(
+                f"heatmap: {added} tracks added, "
+                f"{len(removed)} removed, {rendered} tiles rendered"
+            )
+        finally:
+            heatmap.close()
+
+    def _remove_heatmap(self):
+        # the heatmap of an earlier run with it enabled would not be updated,
+        # but still be shown
+        directory = os.path.join(self._export_dir, "assets", "heatmap")
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        file_name = os.path.join(self._cache_dir, "heatmap.sqlite")
+        if os.path.isfile(file_name):
+            os.remove(file_name)
+
+    def _update_coverage(self):
+        # brings the coverage index in line with the exported tracks; tracks
+        # exported before it existed are read back from the track cache
+        coverage = self._coverage
+        removed = [
+            track_hash
+            for track_hash in coverage.hashes()
+            if not self._manifest.is_exported(track_hash)
+        ]
+        for track_hash in removed:
+            coverage.remove_track(track_hash)
+        for track_hash in self._manifest.exported_hashes():
+            if coverage.has_track(track_hash):
+                continue
+            file_name = self._manifest.get(track_hash)["source"]
+            t = Track()
+            try:
+                t.load_from_cache(
+                    os.path.join(self._cache_dir, "tracks", track_hash), file_name
+                )
             except Exception as e:
-                print(f"Error while loading {file_name}: {e}")
-                traceback.print_exception(*sys.exc_info())
+                print(f"Error while adding {file_name} to the coverage index: {e}")
                 continue
-        self._tracks.sort(key=lambda t: t._start_time, reverse=True)
-
-        with open(os.path.join(self._export_dir, "assets", "data.js"), "w") as file:
-            file.write("const data = [\n")
-            for track in self._tracks:
-                file.write("{\n")
-                self._write_field(file, "hash", track._hash)
-                self._write_field(file, "type", track._type)
-                self._write_field(file, "location", track._location)
-                self._write_field(
-                    file, "distance", track._distance, self._format_distance
+            coverage.add_track(track_hash, track_cells(t))
+
+    def _write_index(self):
+        # assets/index/manifest.json lists pages of INDEX_PAGE_SIZE records in
+        # ascending start time, so a new activity usually changes only the
+        # last page; records are read from the manifest page by page
+        previous_outputs = self._manifest.get_index_outputs()
+        outputs = {}
+        pages = []
+        count = 0
+        records_iterator = self._manifest.records()
+        for number in itertools.count():
+            records = list(itertools.islice(records_iterator, INDEX_PAGE_SIZE))
+            if not records:
+                break
+            count += len(records)
+            name, digest = self._write_hashed_output(
+                f"assets/index/page-{number:05}",
+                ".json",
+                json.dumps({"page": number, "tracks": records}, sort_keys=True) + "\n",
+                previous_outputs,
+            )
+            outputs[name] = digest
+            pages.append(
+                {
+                    "file": name,
+                    "digest": digest[:16],
+                    "count": len(records),
+                    "first_start_time": records[0]["start_time"],
+                    "last_start_time": records[-1]["start_time"],
+                }
+            )
+        name = "assets/index/manifest.json"
+        outputs[name] = self._write_output(
+            name,
+            json.dumps(
+                {
+                    "count": count,
+                    "page_size": INDEX_PAGE_SIZE,
+                    "pages": pages,
+                },
+                indent=1,
+            )
+            + "\n",
+            previous_outputs,
+        )
+        for name in previous_outputs:
+            if name not in outputs:
+                self._remove_output(name)
+        # written by earlier versions
+        self._remove_output("assets/data.js")
+        self._manifest.set_index_outputs(outputs)
+
+    def _write_static_assets(self):
+        # index.html is rewritten to reference the content named assets, so
+        # all files but index.html (and the index manifest) may be cached forever
+        previous_outputs = self._manifest.get_static_outputs()
+        outputs = {}
+        with open(os.path.join(self._assets_dir, "index.html"), "r") as file:
+            html = file.read()
+        for asset in STATIC_ASSETS:
+            with open(os.path.join(self._assets_dir, asset), "r") as file:
+                content = file.read()
+            base, extension = os.path.splitext(asset)
+            name, outputs[name] = self._write_hashed_output(
+                f"assets/{base}", extension, content, previous_outputs
+            )
+            html = html.replace(f"./assets/{asset}", f"./{name}")
+        outputs["index.html"] = self._write_output("index.html", html, previous_outputs)
+        for name in previous_outputs:
+            if name not in outputs:
+                self._remove_output(name)
+        # written by earlier versions
+        for asset in STATIC_ASSETS:
+            self._remove_output(f"assets/{asset}")
+        self._manifest.set_static_outputs(outputs)
+
+    def _export_tracks(self, tracks: Iterable[Optional[Track]]):
+        for t in tracks:
+            if t is None:
+                continue
+            try:
+                entry = {
+                    "source": t._file_name,
+                    "cache_version": CACHE_VERSION,
+                    "poi_digest": self._pois.get_digest(),
+                    "compact": self._compact,
+                    "outputs": {},
+                    "record": None,
+                    "fingerprint": t._fingerprint,
+                    "export_version": EXPORT_VERSION,
+                    "precompressed": self._precompress,
+                }
+                previous = self._manifest.get(t._hash)
+                previous_outputs = previous["outputs"] if previous is not None else {}
+                duplicate_of = None
+                if t._start_time is not None:
+                    duplicate_of = self._find_duplicate(t)
+                if duplicate_of is not None:
+                    print(
+                        f"duplicate: {t._file_name} "
+                        f"(of {self._manifest.get(duplicate_of)['source']})"
+                    )
+                    metrics.count("duplicates")
+                    entry["duplicate_of"] = duplicate_of
+                    for name in previous_outputs:
+                        self._remove_output(name)
+                elif t._start_time is not None:
+                    self._update_location(t)
+                    with metrics.stage("export"):
+                        entry["outputs"], levels, digests = self._export_track(
+                            t, previous_outputs
+                        )
+                    entry["record"] = self._make_record(t)
+                    entry["record"]["lods"] = levels
+                    entry["record"]["digests"] = digests
+                    self._coverage.add_track(t._hash, t._cells)
+                self._manifest.set(t._hash, entry)
+            except Exception as e:
+                print(f"Error while exporting {t._file_name}: {e}")
+                traceback.print_exception(*sys.exc_info())
+
+    def _export_track(
+        self, t: Track, previous_outputs: Dict[str, str]
+    ) -> Tuple[Dict[str, str], List[int], List[str]]:
+        # outputs, levels of detail and the digests in the names of their
+        # files (followed by the one of the full resolution file)
+        outputs = {}
+        levels: List[int] = []
+        digests: List[str] = []
+        if t.point_count() > 0:
+            lat = t._lats[0] / 1000000.0
+            ranges = list(t.segment_ranges())
+            count = t.point_count()
+            for zoom in reversed(LEVELS_OF_DETAIL):
+                indices = simplify(
+                    t._lats, t._lngs, ranges, tolerance_for_zoom(zoom, lat)
                 )
-                self._write_field(
-                    file, "start_time", track._start_time, self._format_time
+                # skip levels that would not save much compared to the next finer one
+                if 2 * len(indices) > count:
+                    continue
+                name, digest = self._write_hashed_output(
+                    f"assets/tracks/{t._hash}.z{zoom}",
+                    ".json",
+                    self._polyline_json(t, indices),
+                    previous_outputs,
                 )
-                self._write_field(
-                    file, "timer_time", track._timer_time, self._format_timedelta
+                outputs[name] = digest
+                levels.insert(0, zoom)
+                digests.insert(0, digest[:16])
+                count = len(indices)
+        name, digest = self._write_hashed_output(
+            f"assets/tracks/{t._hash}",
+            ".json",
+            self._polyline_json(t, range(t.point_count())),
+            previous_outputs,
+        )
+        outputs[name] = digest
+        digests.append(digest[:16])
+        t.release_points()
+        for name in previous_outputs:
+            if name not in outputs:
+                self._remove_output(name)
+        return outputs, levels, digests
+
+    def _polyline_json(self, t: Track, indices: Sequence[int]) -> str:
+        lats = t._lats
+        lngs = t._lngs
+        if not self._compact:
+            return (
+                '{"polyline":  ['
+                + ",".join(
+                    f"\n[{lats[i] / 1000000.0:.5f},{lngs[i] / 1000000.0:.5f}]"
+                    for i in indices
                 )
-                self._write_field(
-                    file, "elapsed_time", track._elapsed_time, self._format_timedelta
+                + "\n]}\n"
+            )
+        segments = []
+        begin = 0
+        for segment_end in t._segment_ends:
+            end = bisect.bisect_left(indices, segment_end, begin)
+            if end > begin:
+                segments.append(polyline.encode(lats, lngs, indices[begin:end]))
+            begin = end
+        return json.dumps({"segments": segments}) + "\n"
+
+    def _remove_output(self, name: str):
+        file_name = os.path.join(self._export_dir, name)
+        if os.path.isfile(file_name):
+            os.remove(file_name)
+        compress.remove_siblings(file_name)
+
+    def _write_output(
+        self, name: str, content: str, previous_outputs: Dict[str, str]
+    ) -> str:
+        data = content.encode("utf-8")
+        return self._write_output_data(
+            name, data, utils.compute_digest(data), previous_outputs
+        )
+
+    def _write_hashed_output(
+        self,
+        prefix: str,
+        extension: str,
+        content: str,
+        previous_outputs: Dict[str, str],
+    ) -> Tuple[str, str]:
+        # writes `content` to "prefix.DIGEST.extension"; returns name and digest
+        data = content.encode("utf-8")
+        digest = utils.compute_digest(data)
+        name = f"{prefix}.{digest[:16]}{extension}"
+        return name, self._write_output_data(name, data, digest, previous_outputs)
+
+    def _write_output_data(
+        self, name: str, data: bytes, digest: str, previous_outputs: Dict[str, str]
+    ) -> str:
+        file_name = os.path.join(self._export_dir, name)
+        if previous_outputs.get(name) != digest or not os.path.isfile(file_name):
+            with open(file_name, "wb") as file:
+                file.write(data)
+            metrics.count("files_written")
+            metrics.count("bytes_written", len(data))
+            if self._precompress and compress.is_compressible(name):
+                self._compress_pending.add(file_name)
+            else:
+                # would be outdated
+                compress.remove_siblings(file_name)
+        else:
+            metrics.count("files_unchanged")
+            if (
+                self._precompress
+                and compress.is_compressible(name)
+                and not compress.has_siblings(file_name)
+            ):
+                self._compress_pending.add(file_name)
+        return digest
+
+    def _make_record(self, t: Track) -> Dict[str, Any]:
+        pois = []
+        for poi in t._pois:
+            latlng = self._pois.get_coordinates(poi)
+            if latlng is not None:
+                pois.append(
+                    {
+                        "name": poi,
+                        "lat": round(latlng.lat().degrees, 5),
+                        "lng": round(latlng.lng().degrees, 5),
+                    }
                 )
-                file.write(f'"pois": [\n')
-                for poi in track._pois:
-                    latlng = self._pois.get_coordinates(poi)
-                    if latlng is not None:
-                        file.write(
-                            f'{{"name": "{poi}", \
-                                    "lat": {latlng.lat().degrees:.5f}, \
-                                    "lng": {latlng.lng().degrees:.5f}}},\n'
-                        )
-                file.write(f"]\n")
-                file.write("},\n")
-            file.write("];\n")
+        return {
+            "hash": t._hash,
+            "type": self._format(t._type),
+            "location": self._format(t._location),
+            "distance": self._format(t._distance, self._format_distance),
+            "start_time": self._format(t._start_time, self._format_time),
+            "timer_time": self._format(t._timer_time, self._format_timedelta),
+            "elapsed_time": self._format(t._elapsed_time, self._format_timedelta),
+            "pois": pois,
+            "stats": t._stats,
+        }
+
+    def _try_load_track_data(self, file_name: str, file_hash: str) -> Optional[Track]:
+        print(f"loading: {file_name}")
+        start = time.perf_counter()
+        try:
+            return self._load_track_data(file_name, file_hash)
+        except Exception as e:
+            print(f"Error while loading {file_name}: {e}")
+            traceback.print_exception(*sys.exc_info())
+            return None
+        finally:
+            metrics.add_track_time(file_name, time.perf_counter() - start)
 
     def load_track(self, file_name: str) -> Track:
-        with open(file_name, "rb") as file:
-            raw_data_1024 = file.read(1024)
-        file_hash = utils.compute_hash(file_name, raw_data_1024)
+        t = self._load_track_data(file_name, self._sources.get_hash(file_name))
+        self._update_location(t)
+        return t
+
+    def _load_track_data(self, file_name: str, file_hash: str) -> Track:
         cache_file_name = os.path.join(self._cache_dir, "tracks", file_hash)
-        t = Track()
+        t: Optional[Track] = None
         if os.path.isfile(cache_file_name):
-            t.load_from_cache(cache_file_name, file_name)
+            t = Track()
+            try:
+                t.load_from_cache(cache_file_name, file_name)
+            except Exception as e:
+                # e.g. written with another cache version
+                print(f"Ignoring track cache of {file_name}: {e}")
+                t = None
+        if t is not None:
+            metrics.count("cache_hits")
             t._hash = file_hash
         else:
+            metrics.count("cache_misses")
+            t = Track()
             try:
                 t.load(file_name)
             except Exception as e:
@@ -124,28 +717,31 @@ class Tracks:
             t.save_to_cache(cache_file_name)
         t._pois = self._pois.get_pois(t)
         print(f"{file_name} -> {t._pois}")
+        t._fingerprint = compute_fingerprint(t)
+        t._cells = track_cells(t)
+        return t
+
+    def _update_location(self, t: Track):
         if t._location is None:
             latlng = t.get_start_pos()
             if latlng is not None:
                 t._location = self._geocoder.get_location(latlng)
-        return t
 
     @staticmethod
-    def _write_field(file, label, value, formatter=None):
+    def _format(value, formatter=None) -> str:
         if value is None:
-            file.write(f'"{label}": "n/a",\n')
-        elif formatter is None:
-            file.write(f'"{label}": "{value}",\n')
-        else:
-            file.write(f'"{label}": {formatter(value)},\n')
+            return "n/a"
+        if formatter is None:
+            return f"{value}"
+        return formatter(value)
 
     @staticmethod
     def _format_distance(value):
-        return f'"{value * 0.001:.2f} km"'
+        return f"{value * 0.001:.2f} km"
 
     @staticmethod
     def _format_time(value):
-        return value.strftime('"%Y-%m-%d %H:%M:%S"')
+        return value.strftime("%Y-%m-%d %H:%M:%S")
 
     @staticmethod
     def _format_timedelta(value):
@@ -154,8 +750,78 @@ class Tracks:
         seconds -= 3600 * hours
         minutes = seconds // 60
         seconds -= 60 * minutes
-        return f'"{hours}:{minutes:02}:{seconds:02}"'
+        return f"{hours}:{minutes:02}:{seconds:02}"
 
     @staticmethod
     def _format_list(value):
         return "[" + ", ".join([f'"{v}"' for v in value]) + "]"
+
+
+def _source_rank(file_name: str) -> Tuple[int, str]:
+    # of several files of the same activity, FIT files (which have the most
+    # details) are preferred, then the first by name
+    return (0 if file_name.lower().endswith(".fit") else 1, file_name)
+
+
+_worker_tracks: Optional[Tracks] = None
+
+
+def _init_worker(cache_dir: str, pois: Pois):
+    global _worker_tracks
+    _worker_tracks = Tracks()
+    _worker_tracks.set_cache_dir(cache_dir)
+    _worker_tracks._pois = pois
+    # forked workers inherit the numbers of the main process
+    metrics.reset()
+
+
+def _load_track_worker(
+    file_name: str, file_hash: str
+) -> Tuple[Optional[Track], Dict[str, Any]]:
+    assert _worker_tracks is not None
+    t = _worker_tracks._try_load_track_data(file_name, file_hash)
+    return t, metrics.take()
+
+
+def _merge_worker_metrics(
+    results: Iterable[Tuple[Optional[Track], Dict[str, Any]]],
+) -> Iterator[Optional[Track]]:
+    for t, worker_metrics in results:
+        metrics.merge(worker_metrics)
+        yield t
+
+
+def _map_streaming(
+    executor: concurrent.futures.Executor,
+    function: Callable,
+    items: Iterable[Tuple[str, str]],
+    window: int = 64,
+) -> Iterator[Any]:
+    # Like executor.map, but submits items while `items` is still producing
+    # them and yields every result as soon as it (and all earlier ones) are done.
+    futures: queue.Queue = queue.Queue(maxsize=window)
+    error: List[BaseException] = []
+    # With the fork start method the first submit forks all worker processes;
+    # that must happen before the feeder thread runs, or a lock it holds may be
+    # copied into the workers.
+    executor.submit(int).result()
+
+    def submit():
+        try:
+            for item in items:
+                futures.put(executor.submit(function, *item))
+        except BaseException as e:
+            error.append(e)
+        finally:
+            futures.put(None)
+
+    feeder = threading.Thread(target=submit, daemon=True)
+    feeder.start()
+    while True:
+        future = futures.get()
+        if future is None:
+            break
+        yield future.result()
+    feeder.join()
+    if error:
+        raise error[0]
@@ -1,9 +1,14 @@
+import calendar
 import datetime
 import hashlib
 import os
 import s2sphere
 from typing import Generator, List
 
+EARTH_RADIUS = 6378100.0
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
 
 def compute_hash(file_name: str, data: bytes) -> str:
     hash_object = hashlib.sha256()
@@ -12,15 +17,39 @@ def compute_hash(file_name: str, data: bytes) -> str:
     return hash_object.hexdigest()
 
 
-def collect_files(directory: str, extensions: List[str]) -> Generator[str, None, None]:
+def compute_file_hash(file_name: str) -> str:
+    with open(file_name, "rb") as file:
+        raw_data_1024 = file.read(1024)
+    return compute_hash(file_name, raw_data_1024)
+
+
+def compute_full_file_hash(file_name: str) -> str:
+    hash_object = hashlib.sha256()
+    hash_object.update(file_name.encode("utf-8"))
+    with open(file_name, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            hash_object.update(chunk)
+    return hash_object.hexdigest()
+
+
+def compute_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def scan_files(
+    directory: str, extensions: List[str]
+) -> Generator[os.DirEntry, None, None]:
     abs_dir = os.path.abspath(directory)
     if not os.path.isdir(abs_dir):
         raise Exception(f"Not a directory: {directory}")
-    for root, dirs, files in os.walk(abs_dir):
-        for file_name in files:
-            for extension in extensions:
-                if file_name.endswith(extension):
-                    yield os.path.join(root, file_name)
+    pending = [abs_dir]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    pending.append(entry.path)
+                elif entry.name.endswith(tuple(extensions)) and entry.is_file():
+                    yield entry
 
 
 def serialize_time(d: datetime.datetime) -> str:
@@ -31,5 +60,13 @@ def deserialize_time(s: str) -> datetime.datetime:
     return datetime.datetime.strptime(s, "%Y-%m-%d %H:%M:%S")
 
 
+def time_to_seconds(d: datetime.datetime) -> int:
+    return calendar.timegm(d.utctimetuple())
+
+
+def seconds_to_time(seconds: float) -> datetime.datetime:
+    return _EPOCH + datetime.timedelta(seconds=seconds)
+
+
 def distance(p0: s2sphere.LatLng, p1: s2sphere.LatLng) -> float:
-    return p0.get_distance(p1).radians * 6378100.0
+    return p0.get_distance(p1).radians * EARTH_RADIUS
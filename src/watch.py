@@ -0,0 +1,221 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import abc
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from . import utils
+
+# Watches a directory tree for added, changed and removed files. Uses inotify
+# (via ctypes) on Linux and falls back to comparing periodic directory scans.
+# A batch of changes is returned once no further change arrived for the
+# debounce period; None means that changes may have been missed and the
+# caller should rescan the whole directory.
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = (
+    _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+    | _IN_DELETE_SELF
+    | _IN_MOVE_SELF
+)
+# a created file is reported once it is written and closed (or moved in),
+# so a slow copy does not yield a partly written file; IN_CREATE is only
+# needed for new directories
+_FILE_EVENTS = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_DELETE
+_EVENT = struct.Struct("iIII")
+
+
+class _Watcher(abc.ABC):
+    def __init__(self, directory: str, extensions: List[str]):
+        self._directory = os.path.abspath(directory)
+        self._extensions = tuple(extensions)
+
+    def next_batch(
+        self, debounce: float = 2.0, max_delay: float = 60.0
+    ) -> Optional[Set[str]]:
+        # blocks until something changed, then collects further changes until
+        # there are none for `debounce` seconds (but at most `max_delay`)
+        changed = self._wait(None)
+        deadline = time.monotonic() + max_delay
+        while changed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            more = self._wait(min(debounce, remaining))
+            if more is None:
+                return None
+            if not more:
+                break
+            changed |= more
+        return changed
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def _wait(self, timeout: Optional[float]) -> Optional[Set[str]]:
+        # changed files within `timeout` seconds (None: until there are any);
+        # None if changes may have been missed
+        pass
+
+    def _matches(self, file_name: str) -> bool:
+        return file_name.endswith(self._extensions)
+
+
+class InotifyWatcher(_Watcher):
+    name = "inotify"
+
+    def __init__(self, directory: str, extensions: List[str]):
+        super().__init__(directory, extensions)
+        libc_name = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories: Dict[int, str] = {}
+        try:
+            self._add_tree(self._directory)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _add_tree(self, directory: str) -> Set[str]:
+        # watches `directory` and its subdirectories; returns the files that
+        # are already in them
+        files = set()
+        pending = [directory]
+        while pending:
+            path = pending.pop()
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"cannot watch {path}")
+            self._directories[wd] = path
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        pending.append(entry.path)
+                    elif self._matches(entry.name):
+                        files.add(entry.path)
+        return files
+
+    def _wait(self, timeout: Optional[float]) -> Optional[Set[str]]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if not readable:
+                return set()
+            changed = self._read_events()
+            # events that are not reported (e.g. the creation of a file that
+            # is still being written) do not end the wait
+            if changed is None or changed:
+                return changed
+
+    def _read_events(self) -> Optional[Set[str]]:
+        changed: Set[str] = set()
+        rescan = False
+        while True:
+            try:
+                data = os.read(self._fd, 1 << 16)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & _IN_Q_OVERFLOW:
+                    rescan = True
+                    continue
+                directory = self._directories.get(wd)
+                if directory is None:
+                    continue
+                if mask & _IN_IGNORED:
+                    del self._directories[wd]
+                    if directory == self._directory:
+                        # the watched directory itself is gone
+                        rescan = True
+                    continue
+                path = os.path.join(directory, name)
+                if mask & _IN_ISDIR:
+                    if mask & (_IN_CREATE | _IN_MOVED_TO) and os.path.isdir(path):
+                        changed |= self._add_tree(path)
+                    elif mask & _IN_MOVED_FROM:
+                        # files of a moved away directory are not reported
+                        rescan = True
+                elif mask & _FILE_EVENTS and name and self._matches(name):
+                    changed.add(path)
+        return None if rescan else changed
+
+
+class PollingWatcher(_Watcher):
+    name = "polling"
+
+    def __init__(self, directory: str, extensions: List[str], interval: float = 5.0):
+        super().__init__(directory, extensions)
+        self._interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for entry in utils.scan_files(self._directory, list(self._extensions)):
+            stat = entry.stat()
+            snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def _wait(self, timeout: Optional[float]) -> Optional[Set[str]]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self._interval
+            if deadline is not None:
+                delay = min(delay, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+            snapshot = self._scan()
+            changed = {
+                file_name
+                for file_name in snapshot.keys() | self._snapshot.keys()
+                if snapshot.get(file_name) != self._snapshot.get(file_name)
+            }
+            self._snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+
+def create_watcher(
+    directory: str, extensions: List[str], poll_interval: float = 5.0
+) -> _Watcher:
+    try:
+        return InotifyWatcher(directory, extensions)
+    except (AttributeError, OSError) as e:
+        # no inotify (not Linux, or out of watches)
+        print(f"inotify is not available ({e}), polling every {poll_interval}s")
+        return PollingWatcher(directory, extensions, poll_interval)
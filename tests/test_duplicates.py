@@ -0,0 +1,59 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import os
+import tempfile
+import unittest
+
+from benchmarks.synthetic import write_fit, write_gpx
+from src.fingerprint import compute_fingerprint, is_duplicate
+from src.track import Track
+from src.tracks import Tracks
+
+# the same activity as a FIT file and as a GPX export with local times
+_START = datetime.datetime(2019, 6, 1, 8, 0, tzinfo=datetime.timezone.utc)
+_LOCAL_START = _START.astimezone(datetime.timezone(datetime.timedelta(hours=2)))
+
+
+class DuplicatesTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self._tmp.name, "cache")
+        self.directory = os.path.join(self.cache_dir, "garmin-connect")
+        os.makedirs(self.directory)
+        self.fit_file = os.path.join(self.directory, "activity.fit")
+        self.gpx_file = os.path.join(self.directory, "activity.gpx")
+        write_fit(self.fit_file, points=1200, seed=3, start=_START)
+        write_gpx(self.gpx_file, points=1200, seed=3, start=_LOCAL_START)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_fingerprints_match(self):
+        fingerprints = []
+        for file_name in [self.fit_file, self.gpx_file]:
+            t = Track()
+            t.load(file_name)
+            fingerprints.append(compute_fingerprint(t))
+        self.assertEqual(fingerprints[0]["start"], fingerprints[1]["start"])
+        self.assertTrue(is_duplicate(*fingerprints))
+
+    def test_gpx_export_is_demoted(self):
+        tracks = Tracks()
+        tracks.set_cache_dir(self.cache_dir)
+        tracks.set_export_dir(os.path.join(self._tmp.name, "export"))
+        tracks.set_geocoder_backends(None, use_nominatim=False)
+        tracks.load_tracks(self.directory)
+
+        manifest = tracks._manifest
+        fit_hash = manifest.find_source(self.fit_file)
+        gpx_hash = manifest.find_source(self.gpx_file)
+        self.assertEqual(list(manifest.exported_hashes()), [fit_hash])
+        self.assertEqual(manifest.get(gpx_hash)["duplicate_of"], fit_hash)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+# Copyright 2018 Florian Pigorsch. All rights reserved.
+#
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import os
+import tempfile
+import threading
+import time
+import unittest
+from typing import Dict, List, Set
+
+from src.sync import RateLimiter, SyncFeed, Syncer
+from vendor.garminexport.garminexport import retryer
+
+
+class FakeClient:
+    # stands in for a connected GarminClient; downloads of the activities in
+    # `failing` raise, those in `unavailable` have no FIT file, and every
+    # call is recorded with its time
+    def __init__(self, count: int):
+        start = datetime.datetime(2019, 5, 1, 8, 0, tzinfo=datetime.timezone.utc)
+        self.activities = [
+            (1000 + i, start + datetime.timedelta(days=i)) for i in range(count)
+        ]
+        self.failing: Set[int] = set()
+        self.unavailable: Set[int] = set()
+        self.calls: List[str] = []
+        self.call_times: List[float] = []
+        self.downloads: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def list_activities(self):
+        self._record("list_activities")
+        return list(self.activities)
+
+    def get_activity_fit(self, activity_id: int):
+        self._record("get_activity_fit")
+        with self._lock:
+            self.downloads[activity_id] = self.downloads.get(activity_id, 0) + 1
+        if activity_id in self.failing:
+            raise IOError(f"cannot download {activity_id}")
+        if activity_id in self.unavailable:
+            return None
+        return f"fit {activity_id}".encode()
+
+    def _record(self, name: str):
+        with self._lock:
+            self.calls.append(name)
+            self.call_times.append(time.monotonic())
+
+
+class Interrupted(Exception):
+    pass
+
+
+class SyncerTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self._tmp.name, "garmin-connect")
+        self.journal_file = os.path.join(self._tmp.name, "sync-journal.jsonl")
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _syncer(self, client: FakeClient, jobs: int = 1) -> Syncer:
+        syncer = Syncer(client, self.directory, self.journal_file)
+        syncer.set_jobs(jobs)
+        # retry failing calls without backing off
+        syncer._retry = retryer.Retryer(stop_strategy=retryer.MaxRetriesStopStrategy(2))
+        return syncer
+
+    def test_downloads_all_activities(self):
+        client = FakeClient(5)
+        names = self._syncer(client, jobs=3).sync()
+        self.assertEqual(len(names), 5)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)), sorted(names + [".not_found"])
+        )
+        self.assertEqual(client.calls.count("list_activities"), 1)
+        self.assertFalse(os.path.exists(self.journal_file))
+
+    def test_resume_after_interruption(self):
+        client = FakeClient(6)
+        downloaded: List[str] = []
+
+        def interrupt(file_name: str):
+            downloaded.append(file_name)
+            if len(downloaded) == 2:
+                raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            self._syncer(client).sync(interrupt)
+        self.assertTrue(os.path.isfile(self.journal_file))
+        # at most the download running at the interruption finished, too
+        self.assertLessEqual(len(client.downloads), 3)
+
+        resumed = FakeClient(6)
+        names = self._syncer(resumed).sync()
+        self.assertNotIn("list_activities", resumed.calls)
+        self.assertEqual(len(names), 6 - len(client.downloads))
+        # every activity was downloaded exactly once
+        self.assertEqual(
+            sorted(list(client.downloads) + list(resumed.downloads)),
+            [activity[0] for activity in client.activities],
+        )
+        self.assertEqual(len(os.listdir(self.directory)), 7)
+        self.assertFalse(os.path.exists(self.journal_file))
+
+    def test_failed_download(self):
+        client = FakeClient(4)
+        client.failing.add(1002)
+        names = self._syncer(client, jobs=2).sync()
+        self.assertEqual(len(names), 3)
+        self.assertFalse(any("_1002." in name for name in names))
+        self.assertEqual(client.downloads[1002], 3)
+        self.assertTrue(os.path.isfile(self.journal_file))
+
+        # the next sync fetches only the failed activity and finishes the journal
+        client = FakeClient(4)
+        names = self._syncer(client).sync()
+        self.assertNotIn("list_activities", client.calls)
+        self.assertEqual(client.downloads, {1002: 1})
+        self.assertEqual(len(names), 1)
+        self.assertFalse(os.path.exists(self.journal_file))
+
+    def test_persistent_failure(self):
+        # an activity that cannot be downloaded does not keep the next syncs
+        # from listing new activities
+        for attempt in range(3):
+            client = FakeClient(3)
+            client.failing.add(1001)
+            names = self._syncer(client).sync()
+            self.assertEqual(len(names), 2 if attempt == 0 else 0)
+            self.assertEqual(client.downloads[1001], 3)
+            self.assertEqual("list_activities" in client.calls, attempt == 0)
+        self.assertFalse(os.path.exists(self.journal_file))
+
+        client = FakeClient(4)
+        names = self._syncer(client).sync()
+        self.assertIn("list_activities", client.calls)
+        self.assertEqual(client.downloads, {1001: 1, 1003: 1})
+        self.assertEqual(len(names), 2)
+        self.assertFalse(os.path.exists(self.journal_file))
+
+    def test_unavailable_format(self):
+        client = FakeClient(3)
+        client.unavailable.add(1001)
+        names = self._syncer(client, jobs=2).sync()
+        self.assertEqual(len(names), 2)
+        # downloads are staged next to the directory and moved when complete
+        self.assertEqual(sorted(os.listdir(self._tmp.name)), ["garmin-connect"])
+        with open(os.path.join(self.directory, ".not_found")) as f:
+            not_found = f.read().split()
+        self.assertEqual(len(not_found), 1)
+        self.assertIn("_1001.fit", not_found[0])
+
+        client = FakeClient(3)
+        self.assertEqual(self._syncer(client).sync(), [])
+        self.assertEqual(client.downloads, {})
+
+    def test_rate_limited_calls(self):
+        client = FakeClient(4)
+        syncer = self._syncer(client, jobs=4)
+        syncer.set_rate(20)
+        syncer.sync()
+        self.assertEqual(len(client.call_times), 5)
+        times = sorted(client.call_times)
+        for before, after in zip(times[:-1], times[1:]):
+            self.assertGreaterEqual(after - before, 0.04)
+
+    def test_sync_feed(self):
+        client = FakeClient(3)
+        syncer = self._syncer(client)
+        files = list(SyncFeed(syncer.sync))
+        self.assertEqual(len(files), 3)
+        self.assertTrue(all(os.path.isfile(f) for f in files))
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_spacing(self):
+        limiter = RateLimiter(20)
+        times = []
+        for _ in range(5):
+            limiter.wait()
+            times.append(time.monotonic())
+        for before, after in zip(times[:-1], times[1:]):
+            self.assertGreaterEqual(after - before, 0.04)
+        self.assertLess(times[-1] - times[0], 1.0)
+
+    def test_spacing_over_threads(self):
+        limiter = RateLimiter(20)
+        times: List[float] = []
+        lock = threading.Lock()
+
+        def run():
+            for _ in range(3):
+                limiter.wait()
+                with lock:
+                    times.append(time.monotonic())
+
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        times.sort()
+        self.assertEqual(len(times), 9)
+        for before, after in zip(times[:-1], times[1:]):
+            self.assertGreaterEqual(after - before, 0.04)
+
+    def test_unlimited(self):
+        limiter = RateLimiter(None)
+        start = time.monotonic()
+        for _ in range(100):
+            limiter.wait()
+        self.assertLess(time.monotonic() - start, 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()